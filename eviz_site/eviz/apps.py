@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class EvizConfig(AppConfig):
@@ -6,3 +7,39 @@ class EvizConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     # The name of the app. This should match the name of the directory containg the app's code
     name = 'eviz'
+
+    def ready(self):
+        from utils.translator import Translator, MODEL_MAPPINGS
+
+        # translations changed through the site (e.g. the admin pages)
+        # should show up in every process
+        def bump_translations(sender, **kwargs):
+            Translator.bump_generation()
+
+        for model_name, _, _ in MODEL_MAPPINGS.values():
+            model = self.get_model(model_name)
+            post_save.connect(bump_translations, sender=model, dispatch_uid=f"bump_translations_{model_name}", weak=False)
+            post_delete.connect(bump_translations, sender=model, dispatch_uid=f"bump_translations_delete_{model_name}", weak=False)
+
+    def warm_up(self):
+        '''Get translations, the availability index, the efficiency cube and static files ready before the first request needs them
+
+        Called by the server entry points (eviz_site/wsgi.py and eviz_site/asgi.py) once per serving process,
+        so management commands and the runserver autoreloader's watching process don't warm up;
+        each part can be turned off with its setting (e.g. TRANSLATOR_WARMUP)
+        '''
+
+        from utils.translator import Translator
+        from utils.availability import warm_availability
+        from utils.cube import warm_cubes
+        from utils.static import STATIC_FILES
+        from eviz_site.settings import TRANSLATOR_WARMUP, AVAILABILITY_WARMUP, CUBE_WARMUP, TRANSLATION_DATABASES
+
+        if TRANSLATOR_WARMUP:
+            Translator.warm(TRANSLATION_DATABASES)
+        if AVAILABILITY_WARMUP:
+            warm_availability(TRANSLATION_DATABASES)
+        if CUBE_WARMUP:
+            warm_cubes(TRANSLATION_DATABASES)
+        # static files are read in and compressed once, up front
+        STATIC_FILES.warm()
@@ -0,0 +1,337 @@
+import json
+import asyncio
+from unittest import mock
+import tracemalloc
+import numpy as np
+import pandas as pd
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections, close_old_connections
+from django.http import QueryDict
+from django.test import RequestFactory
+from django.contrib.auth.models import AnonymousUser
+from plotly.offline import plot
+from scipy.sparse import coo_matrix
+from utils.xy_plot import xy_figure
+from utils.colors import Palette
+from eviz_site.settings import XY_POINT_BUDGET, SANKEY_PALETTES, PLOT_DB_THREADS, PLOT_RENDER_THREADS, MATRIX_TILE_SIZE
+
+def _timed(func, *args, repeats: int = 1, **kwargs) -> tuple[float, object]:
+    # the average seconds a call takes, and what the last call gave back
+    start = perf_counter()
+    for _ in range(repeats):
+        result = func(*args, **kwargs)
+    return (perf_counter() - start) / repeats, result
+
+def _percentile(samples: list[float], percent: float) -> float:
+    # the sample that percent of the samples are at or below
+    return float(np.percentile(samples, percent, method="higher"))
+
+def _plot_requests(factory: RequestFactory, options: dict, count: int) -> list:
+    # count POST requests for /plot from anonymous users, going through the forms given (and years, if given)
+    forms = [QueryDict(post, mutable=True) for post in options["post"]]
+    years = range(int(options["years"].split("-")[0]), int(options["years"].split("-")[1]) + 1) if options["years"] else [None]
+
+    requests = []
+    for k in range(count):
+        form = forms[k % len(forms)].copy()
+        if (year := years[k // len(forms) % len(years)]) is not None:
+            form["year"] = str(year)
+        request = factory.post("/plot", form.urlencode(), content_type="application/x-www-form-urlencoded", REMOTE_ADDR=f"10.0.{k // 250 % 250}.{k % 250}")
+        request.user = AnonymousUser()
+        async def auser(user = request.user):
+            return user
+        request.auser = auser
+        requests.append(request)
+    return requests
+
+def _peak(func, *args, **kwargs) -> tuple[int, object]:
+    # the most bytes held at once during a call (as tracemalloc sees them), and what the call gave back
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+class Command(BaseCommand):
+    help = "Measure how parts of the site perform, on made up data unless a benchmark says otherwise"
+
+    # keys are benchmark names, values are the methods that run them
+    BENCHMARKS = {
+        "xy": "xy",
+        "colors": "colors",
+        "columns": "columns",
+        "pool": "pool",
+        "views": "views",
+        "matrix": "matrix",
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", choices=self.BENCHMARKS, help="what to measure")
+        parser.add_argument("--repeats", type=int, default=3, help="how many times to repeat each measurement")
+        parser.add_argument("--size", type=int, help="how big to make the made up data (what that means depends on the benchmark)")
+        parser.add_argument("--database", default="default", help="the database to run against, for benchmarks that need one")
+        parser.add_argument("--post", action="append", help="the form of a plot request (e.g. plot_type=sankey&dataset=...), for the pool and views benchmarks; give it more than once to mix requests")
+        parser.add_argument("--years", help="a range of years (e.g. 1960-2020) to spread the plot requests over, so they aren't all answered from the cache")
+
+    def handle(self, *args, **options):
+        getattr(self, self.BENCHMARKS[options["benchmark"]])(options)
+
+    def xy(self, options):
+        '''Large xy plots drawn with every point in SVG (as before) and with WebGL, downsampled to the point budget'''
+
+        countries = options["size"] or 400
+        years = np.arange(1960, 2021)
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({
+            "Year": np.tile(years, countries * 2),
+            "EXp": rng.random(countries * 2 * len(years)).cumsum(),
+            "Country": np.repeat([f"Country {c}" for c in range(countries)], 2 * len(years)),
+            "EnergyType": np.tile(np.repeat(["Energy", "Exergy"], len(years)), countries),
+        })
+        self.stdout.write(f"{len(df):,} points in {countries * 2} lines")
+
+        for name, budget in (("every point, SVG", None), ("downsampled, WebGL", XY_POINT_BUDGET)):
+            seconds, fig = _timed(xy_figure, df.copy(), "EXp", "country", "energy_type",
+                                  energy_type="Energy", point_budget=budget, repeats=options["repeats"])
+            div = plot(fig, output_type="div", include_plotlyjs=False)
+            points = sum(len(trace.x) for trace in fig.data)
+            self.stdout.write(f"{name}: {points:,} points drawn, {len(div) / 1e6:.2f} MB of HTML, {seconds:.2f} s to build")
+
+    def colors(self, options):
+        '''Carrier colors from the category palette, by the old linear scan and by the compiled (and remembered) palette'''
+
+        with open(SANKEY_PALETTES["categories"]) as f:
+            categories = json.loads(f.read())
+        with open(SANKEY_PALETTES["carriers"]) as f:
+            carriers = json.loads(f.read())
+
+        # like a Sankey diagram, where each carrier's color is looked up once per flow
+        flows_per_carrier = options["size"] or 20
+        names = carriers * flows_per_carrier
+        ids = list(range(len(carriers))) * flows_per_carrier
+
+        def linear_scan():
+            # how colors were found before utils/colors.py
+            colors = []
+            for name in names:
+                color = None
+                for category in categories:
+                    if category in name.lower():
+                        color = categories[category]
+                        break
+                colors.append(color)
+            return colors
+
+        scan_seconds, expected = _timed(linear_scan, repeats=options["repeats"])
+        # a new palette every time, so nothing is remembered yet
+        compiled_seconds, colors = _timed(lambda: Palette("benchmark", categories=categories).index_colors("benchmark", ids, names), repeats=options["repeats"])
+        palette = Palette("benchmark", categories=categories)
+        palette.index_colors("benchmark", ids, names)
+        remembered_seconds, _ = _timed(palette.index_colors, "benchmark", ids, names, repeats=options["repeats"])
+
+        if colors != expected:
+            self.stderr.write("The compiled palette gave different colors than the linear scan")
+
+        self.stdout.write(f"{len(names):,} lookups of {len(carriers)} carriers against {len(categories)} categories")
+        for name, seconds in (("linear scan", scan_seconds), ("compiled", compiled_seconds), ("remembered", remembered_seconds)):
+            self.stdout.write(f"{name}: {seconds * 1000:.2f} ms ({seconds / len(names) * 1e6:.2f} us per lookup)")
+
+    def columns(self, options):
+        '''Sparse matrices built from a query's rows as tuples of Python values (as before) and from its numpy columns'''
+
+        rows = options["size"] or 500_000
+        size = 2_000
+        rng = np.random.default_rng(0)
+        # the types the binary COPY path decodes PSUT columns to
+        data = {
+            "i": rng.integers(0, size, rows).astype(np.int16),
+            "j": rng.integers(0, size, rows).astype(np.int16),
+            "value": rng.random(rows),
+            "matname": rng.integers(0, 4, rows).astype(np.int16),
+        }
+        values = ["i", "j", "value", "matname"]
+
+        def from_tuples():
+            # how _query_database handed rows to get_ruvy_matrix
+            result = list(zip(*(data[value].tolist() for value in values)))
+            row, col, val, matname = zip(*result)
+            return coo_matrix((val, (row, col)), shape=(size, size)), matname
+
+        def from_arrays():
+            return coo_matrix((data["value"], (data["i"], data["j"])), shape=(size, size)), data["matname"]
+
+        self.stdout.write(f"{rows:,} rows of {', '.join(values)}")
+        for name, build in (("tuples", from_tuples), ("numpy columns", from_arrays)):
+            seconds, (mat, _) = _timed(build, repeats=options["repeats"])
+            peak, _ = _peak(build)
+            self.stdout.write(f"{name}: {seconds * 1000:.1f} ms, {peak / 1e6:.1f} MB at most ({mat.nnz:,} values)")
+
+    def pool(self, options):
+        '''Many /plot requests at once with pooled connections, with persistent connections and with a new connection for every request
+
+        Runs against the real databases with the plot requests given (--post, spread over --years);
+        the query result cache is emptied before each run so requests go to the database.
+        '''
+
+        # imported here so the other benchmarks don't load every view
+        from eviz.views import visualizer
+        from utils.data import RESULT_CACHE
+
+        if not options["post"]:
+            self.stderr.write("Give at least one plot request to make with --post")
+            return
+
+        concurrency = options["size"] or 16
+        count = concurrency * options["repeats"] * 10
+        factory = RequestFactory()
+
+        def request(plot_request):
+            start = perf_counter()
+            response = visualizer.get_plot(plot_request)
+            # what Django does when a request finishes
+            close_old_connections()
+            return perf_counter() - start, response.content.startswith(b"Error")
+
+        # the modes put the databases' settings back how they were afterwards
+        configured = {alias: (connections.settings[alias]["OPTIONS"].get("pool"), connections.settings[alias].get("CONN_MAX_AGE", 0)) for alias in connections}
+        modes = (
+            ("pooled", True, 0),
+            ("not pooled, persistent connections", False, None),
+            ("not pooled, CONN_MAX_AGE=0", False, 0),
+        )
+
+        self.stdout.write(f"{count:,} plot requests, {concurrency} at once, {len(options['post'])} forms over {options['years'] or 'one year'}")
+        try:
+            for name, pooled, max_age in modes:
+                for alias in connections:
+                    connections[alias].close_pool()
+                    connections[alias].close()
+                    settings = connections.settings[alias]
+                    settings["OPTIONS"].pop("pool", None)
+                    if pooled and configured[alias][0]:
+                        settings["OPTIONS"]["pool"] = configured[alias][0]
+                    settings["CONN_MAX_AGE"] = max_age
+
+                # fresh threads, so every thread connects with this mode's settings
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    # warm up (translations, the Index table, the pool), then start from an empty cache
+                    list(executor.map(request, _plot_requests(factory, options, concurrency)))
+                    RESULT_CACHE.clear()
+                    seconds, results = _timed(lambda: list(executor.map(request, _plot_requests(factory, options, count))))
+                    # persistent connections are held by the threads until they are closed there
+                    list(executor.map(lambda _: connections.close_all(), range(concurrency)))
+
+                latencies, errors = zip(*results)
+                self.stdout.write(
+                    f"{name}: {count / seconds:.1f} requests per second, "
+                    f"p50 {_percentile(latencies, 50) * 1000:.1f} ms, p99 {_percentile(latencies, 99) * 1000:.1f} ms, "
+                    f"max {max(latencies) * 1000:.1f} ms" + (f", {sum(errors)} errors" if any(errors) else "")
+                )
+        finally:
+            for alias, (pool, max_age) in configured.items():
+                connections[alias].close_pool()
+                connections[alias].close()
+                connections.settings[alias]["OPTIONS"].pop("pool", None)
+                if pool:
+                    connections.settings[alias]["OPTIONS"]["pool"] = pool
+                connections.settings[alias]["CONN_MAX_AGE"] = max_age
+
+    def views(self, options):
+        '''Many plot requests at once through the sync view (a thread per request, as under WSGI)
+        and through the async view (one event loop, as under ASGI)
+
+        Runs against the real databases with the plot requests given (--post);
+        the query result cache is emptied before each, so both start cold.
+        '''
+
+        # imported here so the other benchmarks don't load every view
+        from eviz.views import visualizer
+        from utils.data import RESULT_CACHE
+
+        if not options["post"]:
+            self.stderr.write("Give at least one plot request to make with --post")
+            return
+
+        concurrency = options["size"] or 32
+        factory = RequestFactory()
+
+        def sync_request(plot_request):
+            start = perf_counter()
+            visualizer.get_plot(plot_request)
+            connections.close_all()
+            return perf_counter() - start
+
+        async def async_request(plot_request):
+            start = perf_counter()
+            await visualizer.async_get_plot(plot_request)
+            return perf_counter() - start
+
+        def run_sync():
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                return list(executor.map(sync_request, _plot_requests(factory, options, concurrency)))
+
+        def run_async():
+            async def gather():
+                return await asyncio.gather(*(async_request(plot_request) for plot_request in _plot_requests(factory, options, concurrency)))
+            return asyncio.run(gather())
+
+        self.stdout.write(f"{concurrency} plot requests at once, {len(options['post'])} different")
+        modes = (
+            ("sync views (WSGI)", run_sync, concurrency),
+            ("async views (ASGI)", run_async, PLOT_DB_THREADS + PLOT_RENDER_THREADS),
+        )
+        for name, run, threads in modes:
+            RESULT_CACHE.clear()
+            seconds, latencies = _timed(run)
+            self.stdout.write(
+                f"{name}: {seconds:.2f} s, {concurrency / seconds:.1f} requests per second, "
+                f"p50 {_percentile(latencies, 50) * 1000:.0f} ms, p99 {_percentile(latencies, 99) * 1000:.0f} ms, "
+                f"at most {threads} threads"
+            )
+
+    def matrix(self, options):
+        '''Matrix heatmaps drawn with Altair (every cell labelled), compactly and in tiles'''
+
+        # imported here so the other benchmarks don't need the matrix module's dependencies
+        from altair import MaxRowsError
+        from utils import matrix, plot_json
+
+        size = options["size"] or 3_000
+        rng = np.random.default_rng(0)
+        # a made up Index table in place of the database's
+        index = matrix.IndexTable(np.arange(size), np.array([f"Index entry {k}" for k in range(size)], dtype=object), rng.permutation(size))
+        target = ("benchmark", None)
+
+        def altair(mat):
+            frame = matrix.matrix_frame(target, mat)
+            return matrix.visualize_matrix(frame).properties(autosize = {"type": "fit", "contains": "padding"}).to_html()
+
+        def compact(mat):
+            return plot_json.inline(plot_json.matrix_spec(matrix.matrix_frame(target, mat), "inferno", "weight"))
+
+        def tiled(mat):
+            return plot_json.inline(matrix.publish_matrix_tiles(target, dict(benchmark = mat.nnz), mat))
+
+        with mock.patch.object(matrix, "get_index_table", return_value=index), mock.patch.object(matrix, "current_versions", return_value=()):
+            for cells in (size, size * 20):
+                mat = coo_matrix((rng.random(cells), (rng.integers(0, size, cells), rng.integers(0, size, cells))), shape=(size, size))
+                mat.sum_duplicates()
+                mat = mat.tocoo()
+                self.stdout.write(f"{mat.nnz:,} values in a {size:,} by {size:,} matrix")
+
+                for name, draw in (("altair", altair), ("compact", compact), ("tiled", tiled)):
+                    try:
+                        seconds, html = _timed(draw, mat, repeats=options["repeats"])
+                    except MaxRowsError:
+                        self.stdout.write(f"  {name}: refused, too many cells for Altair")
+                        continue
+                    self.stdout.write(f"  {name}: {len(html) / 1e3:,.0f} kB, {seconds * 1000:.1f} ms")
+
+                # what the page fetches for each tile it shows
+                name = matrix.publish_matrix_tiles(target, dict(benchmark = mat.nnz), mat)["name"]
+                tiles = [(r, c) for r in range(-(-size // MATRIX_TILE_SIZE)) for c in range(-(-size // MATRIX_TILE_SIZE))]
+                seconds, sizes = _timed(lambda: [len(plot_json.dumps(plot_json.matrix_tile_spec(matrix.get_matrix_tile(name, r, c)))) for r, c in tiles])
+                self.stdout.write(f"  each tile: {np.mean(sizes) / 1e3:.1f} kB, {seconds / len(tiles) * 1000:.2f} ms")
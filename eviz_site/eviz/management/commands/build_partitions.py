@@ -0,0 +1,85 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from eviz.models import PSUT, AggEtaPFU
+from utils.translator import Translator
+from utils.partitions import partition_fields
+from utils.data import PARTITIONS, _fetch_columns_from_database
+
+MODELS = {"psut": PSUT, "aggetapfu": AggEtaPFU}
+
+class Command(BaseCommand):
+    help = "Build (or refresh) the local partition store of hot slices of data, see utils/partitions.py"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="the database to build partitions from")
+        parser.add_argument("--table", choices=MODELS, default="psut", help="the table to build partitions of")
+        parser.add_argument("--dataset", help="the dataset to build partitions for, e.g. 'CL-PFU MW'")
+        parser.add_argument("--data-version", dest="data_version", help="the version to build partitions for, e.g. 'v2.0'")
+        parser.add_argument("--country", nargs="*", help="the countries to build partitions for (every country with data if not given)")
+        parser.add_argument("--refresh", action="store_true", help="rebuild every partition already in the store")
+        parser.add_argument("--benchmark", action="store_true", help="compare how long queries take from partitions and from the database")
+
+    def handle(self, *args, **options):
+        if PARTITIONS is None:
+            raise CommandError("No partition store set up, set the partition_dir environment variable")
+
+        database = options["database"]
+        model = MODELS[options["table"]]
+
+        if options["refresh"]:
+            slices = PARTITIONS.partitions(database, model)
+        else:
+            if not options["dataset"] or not options["data_version"]:
+                raise CommandError("--dataset and --data-version are needed unless refreshing")
+            slices = self.__slices(database, model, options["dataset"], options["data_version"], options["country"])
+
+        for dataset, version, country in slices:
+            self.__build(database, model, dataset, version, country)
+
+        if options["benchmark"]:
+            self.__benchmark(database, model, slices)
+
+    def __slices(self, database, model, dataset, version, countries) -> list[tuple[int, int, int]]:
+        translator = Translator(database)
+        dataset = translator.dataset_translate(dataset)
+        version = translator.version_translate(version)
+
+        if countries:
+            country_ids = [translator.country_translate(country) for country in countries]
+        else:
+            country_ids = (
+                model.objects.using(database)
+                .filter(Dataset = dataset, ValidFromVersion__gte = version, ValidToVersion__lte = version)
+                .order_by().values_list("Country", flat = True).distinct()
+            )
+
+        return [(dataset, version, country) for country in country_ids]
+
+    def __query(self, dataset, version, country) -> dict:
+        # the same query translate_query() makes for the slice
+        return dict(Dataset = dataset, ValidFromVersion__gte = version, ValidToVersion__lte = version, Country = country)
+
+    def __build(self, database, model, dataset, version, country):
+        data = _fetch_columns_from_database((database, model), self.__query(dataset, version, country), partition_fields(model))
+        PARTITIONS.write(database, model, dataset, version, country, data)
+        self.stdout.write(f"Built partition d{dataset}-v{version}-c{country} ({len(data['Year'])} rows)")
+
+    def __benchmark(self, database, model, slices, repeats = 5):
+        columns = partition_fields(model)
+        for dataset, version, country in slices:
+            query = self.__query(dataset, version, country)
+
+            start = perf_counter()
+            for _ in range(repeats):
+                PARTITIONS.fetch((database, model), query, columns)
+            store_time = (perf_counter() - start) / repeats
+
+            start = perf_counter()
+            for _ in range(repeats):
+                _fetch_columns_from_database((database, model), query, columns)
+            database_time = (perf_counter() - start) / repeats
+
+            self.stdout.write(
+                f"d{dataset}-v{version}-c{country}: store {store_time * 1000:.2f} ms, "
+                f"database {database_time * 1000:.2f} ms ({database_time / max(store_time, 1e-9):.0f}x)"
+            )
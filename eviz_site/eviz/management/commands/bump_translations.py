@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from utils.translator import Translator
+
+class Command(BaseCommand):
+    help = "Make every server process reload its translations, e.g. after publishing a new Version or Country"
+
+    def handle(self, *args, **options):
+        Translator.bump_generation()
+        self.stdout.write("Translations will be reloaded by every process")
@@ -0,0 +1,25 @@
+####################################################################
+# static_files.py contains the template tags for linking to static files
+#
+# Usage:
+#   {% load static_files %}
+#   <link rel="stylesheet" href="{% static_url 'css/toolbar.css' %}">
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+from django import template
+from utils.static import STATIC_FILES
+
+register = template.Library()
+
+@register.simple_tag
+def static_url(path: str) -> str:
+    '''Get the hashed URL of a static file (see StaticFiles.url()), which browsers can cache forever
+
+    Inputs:
+        path: the path of the file relative to the static directory, e.g. css/toolbar.css
+    '''
+
+    return STATIC_FILES.url(path)
@@ -1,4 +1,30 @@
-from django.test import TestCase
+import gzip
+import sys
+import json
+import importlib
+import tempfile
+import tracemalloc
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from unittest import mock
+from scipy.sparse import coo_matrix
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from eviz_site.settings import SANKEY_PALETTES
+from eviz.views import visualizer
+from utils import data, matrix, matrix_algebra, sankey, xy_plot
+from utils.availability import AvailabilityIndex
+from utils.colors import Palette
+from utils.filters import merge_queries
+from utils.matrix import IndexTable
+from utils.shared import SharedArrays
+from utils.singleflight import SingleFlight
+from utils.static import StaticFiles
+from utils.xy_plot import lttb
 
 def test_matrix_sum(m):
 
@@ -30,4 +56,575 @@ def test_matrix_sum(m):
     assert(round(m.get("Primary solid biofuels [from Resources]", "Manufacture [of Primary solid biofuels]")) == 175218)
     assert(round(m.get("Refinery gas", "Oil refineries")) == 1732)
 
-    return "Passed all tests"
\ No newline at end of file
+    return "Passed all tests"
+
+class WarmUpTests(SimpleTestCase):
+    '''Only the processes that serve requests warm up, once each'''
+
+    def test_serving_warms_up(self):
+        with mock.patch.object(apps.get_app_config("eviz"), "warm_up") as warm_up, mock.patch.dict(sys.modules):
+            sys.modules.pop("eviz_site.wsgi", None)
+            # what a server (or runserver's serving process) does to get the application
+            importlib.import_module("eviz_site.wsgi")
+        warm_up.assert_called_once()
+
+    def test_setup_does_not_warm_up(self):
+        # management commands (and the test runner) set up the apps without serving
+        with mock.patch("utils.static.STATIC_FILES.warm") as warm:
+            apps.get_app_config("eviz").ready()
+        warm.assert_not_called()
+
+class CsvStreamingTests(SimpleTestCase):
+    '''Streaming a CSV download holds one chunk of rows at a time, however many rows there are'''
+
+    CHUNK_ROWS = 2_000
+
+    def chunks(self, target, query, columns, chunk_size = None):
+        # made up rows, built as they are asked for like a server-side cursor's
+        for k in range(self.chunk_count):
+            yield {"Year": np.full(self.CHUNK_ROWS, 1960 + k, dtype=np.int16), "value": np.arange(self.CHUNK_ROWS) * 1.5}
+
+    def peak_bytes(self, chunk_count, stream = True) -> int:
+        self.chunk_count = chunk_count
+        with mock.patch.object(data, "_iter_column_chunks", self.chunks), mock.patch.object(data, "Translator"):
+            tracemalloc.start()
+            if stream:
+                for _ in data.iter_csv_from_query(("default", None), {}, ["Year", "value"]):
+                    pass
+            else:
+                # everything at once, the way downloads were made before streaming
+                pd.concat(data.iter_translated_dataframes(("default", None), {}, ["Year", "value"])).to_csv(index=False)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return peak
+
+    def test_flat_peak_memory(self):
+        small, large = self.peak_bytes(4), self.peak_bytes(32)
+        # 8 times the rows, about the same peak
+        self.assertLess(large, small * 1.5)
+        self.assertLess(large * 4, self.peak_bytes(32, stream=False))
+
+class AvailabilityIndexTests(SimpleTestCase):
+    '''The availability index must never say a query has no data when it does'''
+
+    COMBINATION_COLUMNS = ["Dataset", "ValidFromVersion", "ValidToVersion", "Country", "LastStage"]
+    BITSET_COLUMNS = ["Year", "matname"]
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 5000
+        self.rows = np.unique(np.column_stack([
+            rng.integers(1, 4, n), rng.integers(1, 5, n), rng.integers(1, 5, n),
+            rng.integers(1, 60, n), rng.integers(1, 3, n),
+            rng.integers(1960, 2100, n), rng.integers(1, 12, n),
+        ]), axis=0)
+        self.index = AvailabilityIndex(self.COMBINATION_COLUMNS, self.BITSET_COLUMNS, self.rows)
+        self.rng = rng
+
+    def matches(self, query: dict) -> np.ndarray:
+        # which rows a translated query matches, worked out the slow way
+        columns = self.COMBINATION_COLUMNS + self.BITSET_COLUMNS
+        mask = np.ones(len(self.rows), dtype=bool)
+        for key, v in query.items():
+            col, _, lookup = key.partition("__")
+            values = self.rows[:, columns.index(col)]
+            if lookup == "in":
+                mask &= np.isin(values, v)
+            elif lookup == "gte":
+                mask &= values >= v
+            elif lookup == "lte":
+                mask &= values <= v
+            else:
+                mask &= values == v
+        return mask
+
+    def random_query(self) -> dict:
+        rng = self.rng
+        version = int(rng.integers(0, 6))
+        query = {
+            "Dataset": int(rng.integers(0, 5)),
+            "ValidFromVersion__gte": version,
+            "ValidToVersion__lte": version,
+            "Country__in": [int(c) for c in rng.integers(0, 70, rng.integers(1, 4))],
+            "LastStage": int(rng.integers(1, 3)),
+        }
+        if rng.random() < 0.5:
+            query["Year"] = int(rng.integers(1950, 2110))
+        else:
+            query["Year__gte"] = int(rng.integers(1950, 2110))
+            query["Year__lte"] = int(rng.integers(1950, 2110))
+        if rng.random() < 0.5:
+            query["matname__in"] = [int(m) for m in rng.integers(0, 14, 4)]
+        # columns that aren't indexed are ignored
+        query["ChoppedVar"] = 1
+        return query
+
+    def test_no_false_negatives(self):
+        for _ in range(3000):
+            query = self.random_query()
+            indexed_query = {k: v for k, v in query.items() if k != "ChoppedVar"}
+            if self.matches(indexed_query).any():
+                self.assertTrue(self.index.any(query), query)
+
+    def test_exact_without_matname(self):
+        # with only one bitset column in a query, the index is exact
+        for _ in range(1000):
+            query = {k: v for k, v in self.random_query().items() if not k.startswith(("matname", "ChoppedVar"))}
+            self.assertEqual(self.index.any(query), bool(self.matches(query).any()), query)
+
+    def test_values(self):
+        query = {"Dataset": 1, "Country": 5, "Year": 2000}
+        for col in ["Country", "Year"]:
+            without_col = {k: v for k, v in query.items() if k != col}
+            expected = np.unique(self.rows[self.matches(without_col), (self.COMBINATION_COLUMNS + self.BITSET_COLUMNS).index(col)])
+            np.testing.assert_array_equal(self.index.values(col, query), expected)
+
+class SankeyGoldenTests(SimpleTestCase):
+    '''get_sankey() must give exactly what the per-row loop it replaced gave'''
+
+    NAMES = {1: "Crude oil", 2: "Oil refineries", 3: "Electricity", 4: "Power plants", 5: "Natural gas",
+             6: "Households", 7: "Resources [of Crude oil]", 8: "Unobtainium", 9: "Gas works"}
+    MATNAMES = {"R": 1, "U": 2, "V": 3, "Y": 4}
+    # matname, i, j, value, with duplicates and a carrier no palette category matches
+    ROWS = [
+        (1, 7, 1, 100.0), (1, 7, 1, 100.0),
+        (2, 1, 2, 100.0), (2, 5, 4, 30.0), (2, 3, 2, 5.5), (2, 8, 9, 2.0),
+        (3, 2, 3, 10.0), (3, 4, 3, 25.0), (3, 9, 5, 1.25),
+        (4, 3, 6, 30.0), (4, 5, 6, 12.0), (4, 8, 6, 0.5), (4, 3, 6, 30.0),
+    ]
+
+    # recorded from the per-row loop over these rows in sorted order
+    # (it deduplicated them with set(), so its own order wasn't fixed)
+    NODES = (
+        '[[{"label": "Resources [of Crude oil]", "color": "midnightblue"}], '
+        '[{"label": "Crude oil", "color": "black"}, {"label": "Electricity", "color": "yellow"}, '
+        '{"label": "Natural gas", "color": "limegreen"}, {"label": "Unobtainium", "color": "red"}], '
+        '[{"label": "Oil refineries", "color": "midnightblue"}, {"label": "Power plants", "color": "midnightblue"}, '
+        '{"label": "Gas works", "color": "midnightblue"}], [], [{"label": "Households", "color": "midnightblue"}]]'
+    )
+    LINKS = (
+        '[{"from": {"column": 0, "node": 0}, "to": {"column": 1, "node": 0}, "value": 100.0, "color": "black"}, '
+        '{"from": {"column": 1, "node": 0}, "to": {"column": 2, "node": 0}, "value": 100.0, "color": "black"}, '
+        '{"from": {"column": 1, "node": 1}, "to": {"column": 2, "node": 0}, "value": 5.5, "color": "yellow"}, '
+        '{"from": {"column": 1, "node": 2}, "to": {"column": 2, "node": 1}, "value": 30.0, "color": "limegreen"}, '
+        '{"from": {"column": 1, "node": 3}, "to": {"column": 2, "node": 2}, "value": 2.0, "color": null}, '
+        '{"from": {"column": 2, "node": 0}, "to": {"column": 1, "node": 1}, "value": 10.0, "color": "yellow"}, '
+        '{"from": {"column": 2, "node": 1}, "to": {"column": 1, "node": 1}, "value": 25.0, "color": "yellow"}, '
+        '{"from": {"column": 2, "node": 2}, "to": {"column": 1, "node": 2}, "value": 1.25, "color": "limegreen"}, '
+        '{"from": {"column": 1, "node": 1}, "to": {"column": 4, "node": 0}, "value": 30.0, "color": "yellow"}, '
+        '{"from": {"column": 1, "node": 2}, "to": {"column": 4, "node": 0}, "value": 12.0, "color": "limegreen"}, '
+        '{"from": {"column": 1, "node": 3}, "to": {"column": 4, "node": 0}, "value": 0.5, "color": null}]'
+    )
+    OPTIONS = (
+        '{"plot_background_color": "#f4edf7", "default_links_opacity": 0.8, "default_gradient_links_opacity": 0.8, '
+        '"show_column_lines": false, "show_column_names": false, "linear_gradient_links": false}'
+    )
+
+    def test_golden(self):
+        matnames, i, j, values = (np.array(col) for col in zip(*self.ROWS))
+        data = {"matname": matnames.astype(np.int16), "i": i.astype(np.int32), "j": j.astype(np.int32), "value": values}
+
+        translator = mock.Mock()
+        translator.matname_translate.side_effect = lambda name: self.MATNAMES[name]
+        translator.decode.side_effect = lambda attribute, ids: np.array([self.NAMES[int(k)] for k in ids], dtype=object)
+
+        with mock.patch.object(sankey, "Translator", return_value=translator), \
+             mock.patch.object(sankey, "_query_database_arrays", side_effect=lambda target, query, columns: data):
+            nodes, links, options = sankey.get_sankey(("sankey-golden", None), {"matname": 2})
+
+        self.assertEqual(nodes, self.NODES)
+        self.assertEqual(links, self.LINKS)
+        self.assertEqual(options, self.OPTIONS)
+
+class PaletteTests(SimpleTestCase):
+    '''Carrier colors from the compiled palettes'''
+
+    def setUp(self):
+        with open(SANKEY_PALETTES["categories"]) as f:
+            self.categories = json.loads(f.read())
+        with open(SANKEY_PALETTES["carriers"]) as f:
+            self.carriers = json.loads(f.read())
+
+    def test_categories_match_linear_scan(self):
+        # the first category (in file order) in the name wins
+        palette = Palette("test", categories=self.categories)
+        for name in self.carriers + ["Unobtainium"]:
+            expected = next((color for category, color in self.categories.items() if category in name.lower()), None)
+            self.assertEqual(palette.color(name), expected, name)
+
+    def test_carriers_get_made_up_colors(self):
+        palette = Palette("test", carriers=self.carriers)
+        colors = [palette.color(name) for name in self.carriers[:10]]
+        self.assertNotIn(None, colors)
+        self.assertEqual(len(set(colors)), 10)
+        self.assertIsNone(palette.color("Unobtainium"))
+
+    def test_unknown_palette_is_a_bad_request(self):
+        form = "plot_type=sankey&dataset=CL-PFU+MW&version=v1.1&country=GHA&palette=bogus"
+        for view in (visualizer.get_plot, visualizer.get_plot_json):
+            request = RequestFactory().post("/plot", form, content_type="application/x-www-form-urlencoded")
+            request.user = AnonymousUser()
+            # turned away before anything goes to the database
+            with mock.patch.object(visualizer, "translate_query") as translate_query:
+                response = view(request)
+            translate_query.assert_not_called()
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(b"Unknown palette", response.content)
+
+class LttbTests(SimpleTestCase):
+    '''Downsampling must keep the ends of a line and stay within the threshold'''
+
+    def test_threshold(self):
+        x = np.arange(1000)
+        y = np.sin(x / 50)
+        kept = lttb(x, y, 100)
+        self.assertEqual(len(kept), 100)
+        self.assertEqual((kept[0], kept[-1]), (0, 999))
+        self.assertTrue(np.all(np.diff(kept) > 0))
+
+    def test_keeps_peaks(self):
+        x = np.arange(500)
+        y = np.zeros(500)
+        y[123] = 10
+        self.assertIn(123, lttb(x, y, 20))
+
+    def test_short_lines_untouched(self):
+        self.assertTrue(np.array_equal(lttb(np.arange(10), np.arange(10), 50), np.arange(10)))
+
+class XyPlotTests(SimpleTestCase):
+    '''xy plots of made up data, split by country and energy type'''
+
+    def frame(self, countries, years = 60):
+        rows = [(year, float(c + year % 7), f"C{c}", energy_type)
+                for c in range(countries) for energy_type in ("Energy", "Exergy") for year in range(1960, 1960 + years)]
+        return pd.DataFrame(rows, columns=["Year", "EXp", "Country", "EnergyType"])
+
+    def xy(self, frame):
+        with mock.patch.object(xy_plot, "get_translated_dataframe", return_value=frame):
+            return xy_plot.get_xy("EXp", ("default", None), {}, "country", "energy_type", energy_type="Energy")
+
+    def test_lines(self):
+        fig = self.xy(self.frame(3))
+        self.assertEqual(len(fig.data), 6)
+        self.assertEqual(fig.data[0].type, "scatter")
+
+    def test_downsampled_hover(self):
+        fig = xy_plot.xy_figure(self.frame(60), "EXp", "country", "energy_type", energy_type="Energy", point_budget=1000)
+        self.assertEqual(fig.data[0].type, "scattergl")
+        self.assertLessEqual(sum(len(trace.x) for trace in fig.data), 1000)
+        # the note is added to what the hover already showed
+        self.assertIn("Country=C0", fig.data[0].hovertemplate)
+        self.assertIn("%{meta}", fig.data[0].hovertemplate)
+        self.assertIn("7,200 points", fig.data[0].meta)
+
+class MatrixAlgebraTests(SimpleTestCase):
+    '''Quantities worked out from a small, balanced economy'''
+
+    # index entries: 1-2 resources, 3-5 products, 6-8 industries, 9 final demand
+    NAMES = ["Oil", "Sun", "Crude oil", "Electricity", "Fuel oil", "Oil refineries", "Power plants", "Wells", "Households"]
+    MATNAMES = {"R": 1, "U": 2, "V": 3, "Y": 4}
+
+    def setUp(self):
+        index = IndexTable(np.arange(1, 10), np.array(self.NAMES, dtype=object), np.arange(9))
+
+        R = [(1, 8, 100.0)]
+        # products used by industries, then products used by final demand
+        U = [(3, 6, 100.0), (5, 7, 30.0), (4, 6, 10.0), (4, 8, 5.0)]
+        Y = [(4, 9, 25.0), (5, 9, 60.0)]
+        # each product made by one industry, as much as is used
+        V = [(8, 3, 100.0), (7, 4, 40.0), (6, 5, 90.0)]
+
+        cells = [(self.MATNAMES[name], i, j, v) for name, rows in zip("RUVY", (R, U, V, Y)) for i, j, v in rows]
+        matnames, i, j, values = (np.array(col) for col in zip(*cells))
+        mat = coo_matrix((values, (i, j)), shape=(index.size, index.size))
+
+        translator = mock.Mock()
+        translator.matname_translate.side_effect = self.MATNAMES.get
+        self.patches = [
+            mock.patch.object(matrix_algebra, "get_ruvy_matrix", return_value=(mat, matnames)),
+            mock.patch.object(matrix_algebra, "get_index_table", return_value=index),
+            mock.patch.object(matrix_algebra, "Translator", return_value=translator),
+            mock.patch.object(matrix_algebra, "current_versions", side_effect=lambda database: self.versions),
+        ]
+        self.versions = (1, 1)
+        for patch in self.patches:
+            patch.start()
+        matrix_algebra._CACHE.clear()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def quantity(self, quantity):
+        return matrix_algebra.get_quantity(("default", None), {}, quantity)
+
+    def test_sum(self):
+        m = self.quantity("sum")
+        self.assertEqual(m.size, 10)
+        self.assertEqual(round(m.get("Crude oil", "Oil refineries")), 100)
+        self.assertEqual(round(m.get("Oil refineries", "Fuel oil")), 90)
+        self.assertEqual(m.get("Sun", "Households"), 0)
+
+    def test_new_versions_are_refetched(self):
+        self.quantity("sum")
+        self.quantity("q")
+        # the matrices are fetched once for every quantity
+        self.assertEqual(matrix_algebra.get_ruvy_matrix.call_count, 1)
+
+        self.versions = (2, 2)
+        self.quantity("sum")
+        self.assertEqual(matrix_algebra.get_ruvy_matrix.call_count, 2)
+
+    def test_vectors(self):
+        self.assertEqual(self.quantity("q").get("Electricity"), 40)
+        self.assertEqual(self.quantity("g").get("Oil refineries"), 90)
+        self.assertAlmostEqual(self.quantity("efficiency").get("Oil refineries"), 90 / 110)
+
+    def test_leontief(self):
+        # in a balanced economy, the Leontief inverse turns final demand into supply
+        L = self.quantity("leontief")
+        products = ["Crude oil", "Electricity", "Fuel oil"]
+        y = np.array([self.quantity("y").get(p) for p in products])
+        q = np.array([self.quantity("q").get(p) for p in products])
+        L_dense = np.array([[L.get(p, r) for r in products] for p in products])
+        self.assertTrue(np.allclose(L_dense @ y, q))
+
+    def test_matrix_market(self):
+        self.assertIn("% row 2: Crude oil", self.quantity("sum").to_matrix_market())
+
+class MatrixDiffTests(SimpleTestCase):
+    '''Two matrices fetched in one query and compared cell by cell'''
+
+    FIRST = {"Country": 3, "Year": 2000, "matname": 1}
+    SECOND = {"Country": 3, "Year": 2010, "matname": 1}
+
+    def test_merge_queries(self):
+        self.assertEqual(merge_queries(self.FIRST, self.SECOND), ({"Country": 3, "Year__in": [2000, 2010], "matname": 1}, ["Year"]))
+        self.assertEqual(merge_queries({"Year__gte": 2000}, {"Year__gte": 1990}), ({"Year__gte": 1990}, ["Year"]))
+
+    def test_diff(self):
+        data = {
+            "i": np.array([0, 1, 0, 1, 2]),
+            "j": np.array([0, 1, 0, 1, 2]),
+            "value": np.array([1.0, 2.0, 1.0, 3.0, 4.0]),
+            "Year": np.array([2000, 2000, 2010, 2010, 2010]),
+        }
+        fetch = mock.Mock(side_effect=lambda target, query, values: {col: data[col] for col in values})
+
+        with mock.patch.object(matrix, "_query_database_arrays", fetch), \
+             mock.patch.object(matrix, "get_index_table", return_value=IndexTable(np.arange(3), np.array(["a", "b", "c"], dtype=object), np.arange(3))):
+            diff, relative = matrix.get_matrix_diff(("default", None), self.FIRST, self.SECOND)
+
+        # both matrices in one query
+        fetch.assert_called_once()
+        # the unchanged cell is left out, the new one has no relative change
+        self.assertEqual(diff.toarray().tolist(), [[0, 0, 0], [0, 1, 0], [0, 0, 4]])
+        self.assertEqual(relative.tolist(), [0.5, np.inf])
+
+class MatrixHeatmapTests(SimpleTestCase):
+    '''Matrix heatmaps drawn compactly or with Altair, from the same cells'''
+
+    INDEX = IndexTable(np.arange(3), np.array(["a", "b", "c"], dtype=object), np.array([2, 1, 0]))
+    QUERY = {"plot_type": "matrices", "matname": "U", "country": "GHA", "year": "2000"}
+
+    def setUp(self):
+        patcher = mock.patch.object(matrix, "get_index_table", return_value=self.INDEX)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.frame = matrix.matrix_frame(("default", None), coo_matrix(([1.0, 2.0], ([0, 2], [1, 2])), shape=(3, 3)))
+
+    def test_frame(self):
+        self.assertEqual(self.frame.to_dict("list"), {
+            "x": ["b", "c"], "y": ["a", "c"], "value": [1.0, 2.0], "x_order": [1, 0], "y_order": [2, 0],
+        })
+
+    def test_compact(self):
+        spec = visualizer._matrix_spec(self.QUERY, dict(frame = self.frame))
+        # labels in the Index table's order
+        self.assertEqual(spec["labels"], ["c", "b", "a"])
+        with mock.patch.object(visualizer, "MATRIX_HEATMAPS", "compact"):
+            self.assertNotIn("vega", visualizer._render_plot("matrices", self.QUERY, dict(frame = self.frame)))
+
+    def test_altair(self):
+        with mock.patch.object(visualizer, "MATRIX_HEATMAPS", "altair"):
+            html = visualizer._render_plot("matrices", self.QUERY, dict(frame = self.frame))
+            self.assertIn("vega", html)
+            self.assertIn("U Matrix: ", html)
+            # no data is still an error, not an empty chart
+            self.assertEqual(visualizer._render_plot("matrices", self.QUERY, dict(frame = None)), "Error: No corresponding data")
+
+class SharedArraysTests(SimpleTestCase):
+    '''Arrays shared between processes, rebuilt when what they were built from changes'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SharedArrays(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_survives_replacement(self):
+        # another process replaced (and cleaned up) the new generation before it could be read
+        with mock.patch.object(self.store, "read", return_value=None):
+            meta, arrays = self.store.load("set", lambda meta: True, lambda: ({"n": 1}, {"a": np.arange(3)}))
+        self.assertEqual(meta, {"n": 1})
+        self.assertEqual(arrays["a"].tolist(), [0, 1, 2])
+
+    def test_matrix_tiles_follow_versions(self):
+        index = IndexTable(np.arange(3), np.array(["a", "b", "c"], dtype=object), np.arange(3))
+        versions = [(1, 1)]
+
+        def publish(values):
+            mat = coo_matrix((values, ([0, 1], [1, 2])), shape=(3, 3))
+            return matrix.publish_matrix_tiles(("default", None), {"Year": 2000}, mat)
+
+        with mock.patch.object(matrix, "SHARED", self.store), \
+             mock.patch.object(self.store, "remove_older") as remove_older, \
+             mock.patch.dict(matrix._PRUNED_VERSIONS, clear=True), \
+             mock.patch.object(matrix, "get_index_table", return_value=index), \
+             mock.patch.object(matrix, "current_versions", side_effect=lambda database: versions[0]):
+            self.assertEqual(publish([1.0, 2.0])["max"], 2)
+            # same data version, the stored matrix is reused
+            self.assertEqual(publish([1.0, 5.0])["max"], 2)
+            # and old matrices aren't looked for again
+            self.assertEqual(remove_older.call_count, 1)
+            # new data, the matrix is stored again
+            versions[0] = (2, 2)
+            self.assertEqual(publish([1.0, 5.0])["max"], 5)
+            self.assertEqual(remove_older.call_count, 2)
+
+class SingleFlightTests(SimpleTestCase):
+    '''Identical calls coalesced across processes through the lock directory'''
+
+    def test_one_call_across_processes(self):
+        calls = []
+        def make():
+            calls.append(1)
+            sleep(0.05)
+            return "plot"
+
+        with tempfile.TemporaryDirectory() as lock_dir:
+            # one per process
+            flights = [SingleFlight(lock_dir, result_ttl=10), SingleFlight(lock_dir, result_ttl=10)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda k: flights[k % 2].do("key", make), range(8)))
+
+        self.assertEqual(results, ["plot"] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_lock_dir_stays_bounded(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            flights = SingleFlight(lock_dir, result_ttl=0.2)
+            for k in range(100):
+                flights.do(f"key{k}", lambda k: k, k)
+            # lock files go as they are released, results stay to be shared for a while
+            self.assertEqual({path.suffix for path in Path(lock_dir).iterdir()}, {".result"})
+
+            sleep(0.3)
+            flights.do("last", lambda: None)
+            self.assertEqual([path.name for path in Path(lock_dir).iterdir()], ["last.result"])
+
+class PlotJobTests(SimpleTestCase):
+    '''Only plots that aren't in memory are sized up, and only their requesters can poll for them'''
+
+    QUERY = {"matname": "U", "coloring_method": "weight"}
+    TARGET = ("default", None)
+
+    def submit(self, key = "0" * 64):
+        return visualizer._submit_plot_job("someone", key, "matrices", self.QUERY, self.TARGET, {"matname": 2})
+
+    def test_cached_plots_skip_the_estimate(self):
+        with mock.patch.object(visualizer, "is_cached", return_value=True), \
+             mock.patch.object(visualizer, "estimate_rows") as estimate_rows:
+            self.assertIsNone(self.submit())
+        estimate_rows.assert_not_called()
+
+    def test_job_ids_are_unguessable(self):
+        with mock.patch.object(visualizer, "is_cached", return_value=False), \
+             mock.patch.object(visualizer, "estimate_rows", return_value=10**9), \
+             mock.patch.object(visualizer.PLOT_JOBS, "submit", side_effect=lambda job_id, *args: job_id) as submit:
+            self.assertIn("hx-get", self.submit())
+
+        job_id = submit.call_args.args[0]
+        self.assertRegex(job_id, r"^[0-9a-f]{64}$")
+        self.assertNotEqual(job_id, "0" * 64)
+
+    def test_poll_checks_iea_access(self):
+        state = dict(status = "done", info = dict(plot_type = "matrices", query = self.QUERY), result = "<div>plot</div>")
+        request = RequestFactory().get("/plot/job/x")
+        request.user = mock.Mock()
+        with mock.patch.object(visualizer.PLOT_JOBS, "get", return_value=state), \
+             mock.patch.object(visualizer, "iea_valid", return_value=False):
+            response = visualizer.get_plot_job(request, "x")
+        self.assertNotIn(b"plot</div>", response.content)
+        self.assertIn(b"access to IEA data", response.content)
+
+    def test_plot_json_hands_back_the_poller(self):
+        form = "plot_type=matrices&dataset=CL-PFU+MW&version=v1.1&country=GHA&matname=U"
+        request = RequestFactory().post("/plot.json", form, content_type="application/x-www-form-urlencoded")
+        request.user = AnonymousUser()
+        with mock.patch.object(visualizer, "_plot_request_error", return_value=None), \
+             mock.patch.object(visualizer, "translate_query", return_value={"matname": 2}), \
+             mock.patch.object(visualizer, "might_have_data", return_value=True), \
+             mock.patch.object(visualizer, "_submit_plot_job", return_value="<div hx-get='/plot/job/x'></div>") as submit, \
+             mock.patch.object(visualizer, "_make_plot_json") as make_plot_json:
+            response = visualizer.get_plot_json(request)
+        make_plot_json.assert_not_called()
+        # the job is shared with /plot, which makes the HTML the poller swaps in
+        self.assertEqual(submit.call_args.args[1], visualizer._plot_key("matrices", *submit.call_args.args[3:]))
+        self.assertEqual(json.loads(response.content), {"job": "<div hx-get='/plot/job/x'></div>"})
+
+class StaticFilesTests(SimpleTestCase):
+    '''Static files served from memory, with caching headers, compression and ranges'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        root = Path(self.directory.name)
+        (root / "css").mkdir()
+        (root / "css" / "site.css").write_text("body { margin: 0; }\n" * 100)
+        (root / "images").mkdir()
+        (root / "images" / "logo.png").write_bytes(b"\x89PNG" + bytes(range(256)))
+        self.files = StaticFiles(root)
+        self.requests = RequestFactory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get(self, path, **headers):
+        return self.files.response(self.requests.get("/static/" + path, **headers), path)
+
+    def test_hashed_urls(self):
+        url = self.files.url("css/site.css")
+        self.assertRegex(url, r"^/static/css/site\.[0-9a-f]{12}\.css$")
+        self.assertIn("immutable", self.get(url[len("/static/"):])["Cache-Control"])
+        # plain and out of date URLs are revalidated instead
+        self.assertEqual(self.get("css/site.css")["Cache-Control"], "no-cache")
+        self.assertEqual(self.get("css/site.000000000000.css")["Cache-Control"], "no-cache")
+        self.assertIsNone(self.get("css/missing.css"))
+
+    def test_content_types(self):
+        self.assertEqual(self.get("images/logo.png")["Content-Type"], "image/png")
+        self.assertEqual(self.get("css/site.css")["Content-Type"], "text/css; charset=utf-8")
+
+    def test_not_modified(self):
+        etag = self.get("css/site.css")["ETag"]
+        response = self.get("css/site.css", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_compression(self):
+        response = self.get("css/site.css", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), self.files.files["css/site.css"].data)
+        self.assertNotIn("Content-Encoding", self.get("css/site.css"))
+        self.assertNotIn("Content-Encoding", self.get("images/logo.png", HTTP_ACCEPT_ENCODING="gzip"))
+
+    def test_ranges(self):
+        response = self.get("images/logo.png", HTTP_RANGE="bytes=4-7")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, bytes(range(4)))
+        self.assertEqual(response["Content-Range"], "bytes 4-7/260")
+        self.assertEqual(self.get("images/logo.png", HTTP_RANGE="bytes=-2").content, bytes([254, 255]))
+        self.assertEqual(self.get("images/logo.png", HTTP_RANGE="bytes=300-").status_code, 416)
+        # the file changed since the client got the rest of it
+        self.assertEqual(self.get("images/logo.png", HTTP_RANGE="bytes=4-7", HTTP_IF_RANGE='"stale"').status_code, 200)
@@ -4,6 +4,7 @@ import eviz.views.history as history_views
 import eviz.views.misc as misc_views
 import eviz.views.user_accounts as accounts_views
 import eviz.views.visualizer as visualizer_views
+from eviz_site.settings import ASYNC_VIEWS
 
 favicon_view = RedirectView.as_view(url='/static/images/favicon.png', permanent=True)
 
@@ -21,8 +22,13 @@ urlpatterns = [
     path("verify", accounts_views.verify_email),
     
     # visualizer tool pages
-    path("plot", visualizer_views.get_plot),
-    path("data", visualizer_views.get_data),
+    path("plot", visualizer_views.async_get_plot if ASYNC_VIEWS else visualizer_views.get_plot),
+    path("plot.json", visualizer_views.async_get_plot_json if ASYNC_VIEWS else visualizer_views.get_plot_json),
+    path("plot/job/<str:job_id>", visualizer_views.get_plot_job),
+    path("available", visualizer_views.get_available),
+    path("matrix/quantity", visualizer_views.get_matrix_quantity),
+    path("matrix/tile/<str:name>/<int:tile_row>/<int:tile_col>", visualizer_views.get_heatmap_tile),
+    path("data", visualizer_views.async_get_data if ASYNC_VIEWS else visualizer_views.get_data),
 
     # history tool pages
     path("history", history_views.render_history),
@@ -36,4 +42,5 @@ urlpatterns = [
     re_path(r"static/(.*/[^(\.)]*\..*)", misc_views.handle_static),
     path("favicon.ico", favicon_view),
     path("plot-stage/", misc_views.plot_stage),
+    path("stats", misc_views.server_stats),
 ]
\ No newline at end of file
@@ -54,41 +54,48 @@ def matrix_info(request):
     matricies = matname.objects.all()
     return render(request, 'matrix_info.html', context = {"matricies":matricies})
 
-from eviz_site.settings import STATIC_BASE
-def handle_static(request, filepath: str):
-    """Serve CSS static files directly from a specified directory.
+from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from utils.data import RESULT_CACHE, PARTITIONS
+from utils.translator import Translator
+from utils.availability import AVAILABILITY_STATS
+from eviz.views.visualizer import PLOT_FLIGHTS, PLOT_JOBS
+@staff_member_required
+def server_stats(request):
+    ''' Give the counters of the server's caches and connection pools as JSON, for sizing them '''
+    return JsonResponse({
+        "result_cache": RESULT_CACHE.stats(),
+        "translations": Translator.stats(),
+        "availability": AVAILABILITY_STATS,
+        "partitions": PARTITIONS.stats() if PARTITIONS is not None else None,
+        "plot_coalescing": PLOT_FLIGHTS.stats(),
+        "plot_jobs": PLOT_JOBS.stats(),
+        # how long requests have waited for database connections, etc.
+        "connection_pools": {
+            alias: connections[alias].pool.get_stats()
+            for alias in connections
+            if connections[alias].pool is not None
+        },
+    })
 
-    This function reads a CSS file from a static files directory
-    and serves it as an HTTP response with the appropriate content type.
+from utils.static import STATIC_FILES
+from django.views.decorators.http import require_safe
+@require_safe
+def handle_static(request, filepath: str):
+    """Serve a static file from memory (see utils/static.py)
 
     Inputs:
-        request: The HTTP request object (not used in this function, but typically included for view functions)
-        filepath: The path to the CSS file relative to the static files directory
+        request: the GET or HEAD request, whose conditional (If-None-Match, If-Modified-Since)
+                 and Range headers are answered
+        filepath: the path of the file relative to the static directory, plain or hashed
+                  example filepath: css/toolbar.css OR admin/css/toolbar.css OR css/toolbar.3f2a9c1b7d4e.css
 
     Outputs:
-        HttpResponse containing the contents of the CSS file
+        HttpResponse containing the file (or a part of it, or nothing if the client already has it)
     """
-    # example filepath: css/toolbar.css OR admin/css/toolbar.css
-    
-    # the type of static file to serve is used in the match case
-    # so that the correct mime type is attached
-    # other than that, the whole filepath asked for (besides static/) is used to find the file
-    file_type = filepath.split("/")[0] if filepath.split("/")[0] != "admin" else filepath.split("/")[1]
-    match(file_type):
-        case "css":
-            mime_type = "text/css"
-        
-        case "images" | "img":
-            mime_type = "image/svg" if filepath.endswith("svg") else "image"
-            
-        case "js":
-            mime_type = "text/javascript"
-        
-        case _:
-            return error_404(request, f"Couldn't figure out content type of {filepath}")
-    
-    try:
-        with open(f"{STATIC_BASE}/{filepath}", "rb") as f:
-                return HttpResponse(f.read(), headers = {"Content-Type": mime_type})
-    except Exception as e:
-        return error_404(request, e)
\ No newline at end of file
+
+    response = STATIC_FILES.response(request, filepath)
+    if response is None:
+        return error_404(request, f"Couldn't find static file {filepath}")
+    return response
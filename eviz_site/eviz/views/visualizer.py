@@ -16,15 +16,32 @@ from utils.misc import time_view, iea_valid, get_plot_title
 from utils.logging import LOGGER
 from eviz.models import EvizUser, Version, AggEtaPFU
 from utils.translator import Translator
-from eviz_site.settings import SANDBOX_PREFIX
+from eviz_site.settings import SANDBOX_PREFIX, SECRET_KEY
 from django.shortcuts import render
 from utils.data import *
-from django.http import HttpResponse
-from utils.sankey import get_sankey
-from utils.xy_plot import get_xy
-from utils.matrix import get_matrix, get_ruvy_matrix, visualize_matrix
+from django.http import HttpResponse, StreamingHttpResponse
+from utils.sankey import get_sankey, sankey_query, SANKEY_COLUMNS
+from utils.xy_plot import get_xy, xy_columns
+from utils.matrix import get_matrix, get_ruvy_matrix, get_matrix_diff, matrix_frame, visualize_matrix, publish_matrix_tiles, get_matrix_tile
 from plotly.offline import plot
 from utils.history import update_user_history
+from utils.concurrency import run_in_db_thread, run_in_render_thread, iterate_in_thread
+from utils.singleflight import SingleFlight
+from utils.cache import canonical_key
+from utils.jobs import JobQueue
+from utils import plot_json
+from utils.matrix_algebra import get_quantity, QUANTITIES
+from utils.colors import PALETTES
+import json
+from utils.availability import might_have_data, INDEXED_COLUMNS
+from django.http import JsonResponse
+from eviz_site.settings import SINGLE_FLIGHT_LOCK_DIR, SINGLE_FLIGHT_RESULT_TTL
+from eviz_site.settings import (
+    PLOT_JOB_ROW_THRESHOLD, PLOT_JOB_DIR, PLOT_JOB_WORKERS, PLOT_JOB_PER_USER,
+    PLOT_JOB_RESULT_TTL, PLOT_JOB_TIMEOUT, PLOT_JOB_POLL_INTERVAL
+)
+from eviz_site.settings import MATRIX_TILE_CELLS, MATRIX_TILE_TTL, MATRIX_HEATMAPS
+import re
 
 
 @login_required(login_url="/login")
@@ -116,6 +133,572 @@ def visualizer(request):
 
     return render(request, "visualizer.html", context)
 
+# what users who aren't allowed IEA data get instead
+IEA_ACCESS_MESSAGE = ("You do not have access to IEA data. Please contact <a style='color: #00adb5' :visited='{color: #87CEEB}' href='mailto:matthew.heun@calvin.edu'>matthew.heun@calvin.edu</a> with questions."
+                      "You can also purchase WEB data at <a style='color: #00adb5':visited='{color: #87CEEB}' href='https://www.iea.org/data-and-statistics/data-product/world-energy-balances'> World Energy Balances</a>.")
+
+def _plot_form_error(query: dict) -> str | None:
+    """Check that a plot request's form only has options the site knows.
+
+    Inputs:
+        query (dict): the shaped (not translated) query
+
+    Outputs:
+        str: the message to give back (as a bad request) if the form has an unknown option
+        or None if it doesn't
+    """
+
+    if (palette := query.get("palette")) and palette not in PALETTES:
+        return f"Error: Unknown palette, must be one of {', '.join(PALETTES)}"
+
+    return None
+
+def _plot_request_error(user, query: dict) -> str | None:
+    """Check that a user's plot request can be served.
+
+    Inputs:
+        user: the user making the request
+        query (dict): the shaped (not translated) query
+
+    Outputs:
+        str: the message to give back if the request can't be served
+        or None if it can be
+    """
+
+    try:
+        if query["dataset"].startswith(SANDBOX_PREFIX) != query["version"].startswith(SANDBOX_PREFIX):
+            return "Error: Dataset and version must both be from sandbox or both not be from sandbox!"
+    except:
+        pass
+
+    # Check if the user has access to IEA data
+    # TODO: make this work with status = 403, problem is HTMX won't show anything
+    if not iea_valid(user, query):
+        LOGGER.warning(f"IEA data requested by unauthorized user {user.get_username() or 'anonymous user'}")
+        return IEA_ACCESS_MESSAGE
+
+    return None
+
+# how matrix differences are colored, either side of no change
+DIFF_COLOR_SCALE = "redblue"
+
+# what the second matrix of a matrix difference can differ in, and the form field with its value
+COMPARISONS = {"year": "compare_year", "version": "compare_version", "country": "compare_country"}
+
+def _comparison_query(target: DatabaseTarget, query: dict) -> dict | None:
+    """Get the translated query for the matrix a matrix difference compares against.
+
+    Inputs:
+        target (DatabaseTarget): the database target of the query
+        query (dict): the shaped (not translated) query of the first matrix
+
+    Outputs:
+        dict: the translated query of the second matrix
+        or None if the form doesn't say what to compare against
+    """
+
+    field = COMPARISONS.get(query.get("compare_by"))
+    if field is None or not (value := query.get(field)):
+        return None
+
+    match query["compare_by"]:
+        case "year":
+            other = dict(query, year = value, to_year = value)
+        case "version":
+            other = dict(query, version = value)
+        case "country":
+            other = dict(query, country = value)
+
+    try:
+        return translate_query(target, other)
+    except Exception as e:
+        LOGGER.warning(f"Couldn't translate matrix comparison: {e}")
+        return None
+
+def _comparison_title(query: dict) -> str:
+    # what a matrix difference compares against, for its title
+    return f" compared with {query.get(COMPARISONS.get(query.get('compare_by'), ''), '')}"
+
+def _fetch_plot(plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> dict:
+    """Get everything from the database needed to make a plot.
+
+    Inputs:
+        plot_type (str): the type of plot requested
+        query (dict): the shaped (not translated) query
+        target (DatabaseTarget): the database target of the query
+        translated_query (dict): the query translated for the database (see translate_query())
+
+    Outputs:
+        dict: the data to give to _render_plot()
+    """
+
+    match plot_type:
+        case "sankey":
+            nodes,links,options = get_sankey(target, translated_query, query.get("palette") or None)
+            return dict(nodes = nodes, links = links, options = options)
+
+        case "xy_plot":
+            # Extract specific parameters for xy_plot
+            efficiency_metric = query.get('efficiency')
+            color_by = query.get("color_by")
+            line_by = query.get("line_by")
+            facet_col_by = query.get("facet-col-by")
+            facet_row_by = query.get("facet-row-by")
+            energy_type = query.get("energy_type")
+            
+            # Handle combined Energy and Exergy case
+            if 'Energy' in energy_type and 'Exergy' in energy_type:
+                energy_type = 'Energy, Exergy'
+            
+            xy = get_xy(efficiency_metric, target, translated_query, color_by, line_by, facet_col_by, facet_row_by, energy_type)
+            return dict(figure = xy, title_exclude = [color_by, line_by, facet_col_by, facet_row_by, energy_type])
+
+        case "matrices":
+            # Extract specific parameters for matrices
+            matrix_name = query.get("matname")
+            color_scale = query.get('color_scale', "inferno")
+
+            # Retrieve the matrix
+            coloring_method = query.get('coloring_method', 'weight')
+            
+            matname = None
+            if matrix_name == "RUVY" and coloring_method == "ruvy":
+                matrix, matname = get_ruvy_matrix(target, translated_query)
+            else:
+                matrix = get_matrix(target, translated_query)
+
+            if matrix is None:
+                return dict(frame = None)
+
+            # big matrices are drawn in tiles fetched as they are needed
+            if matrix.nnz > MATRIX_TILE_CELLS:
+                return dict(tiles = publish_matrix_tiles(target, translated_query, matrix, matname))
+
+            return dict(frame = matrix_frame(target, matrix, matname))
+
+        case "matrix_diff":
+            if (other_query := _comparison_query(target, query)) is None:
+                return dict(frame = None)
+
+            # both matrices come from one database query
+            diff, relative = get_matrix_diff(target, translated_query, other_query)
+            if diff is None:
+                return dict(frame = None)
+
+            if diff.nnz > MATRIX_TILE_CELLS:
+                return dict(tiles = publish_matrix_tiles(target, dict(first = translated_query, second = other_query), diff), diverging = True)
+
+            return dict(frame = matrix_frame(target, diff, relative = relative))
+
+    return dict()
+
+def _matrix_title(query: dict) -> str:
+    # the title of a matrix heatmap
+    if query.get("plot_type") == "matrix_diff":
+        return query.get("matname") + " Matrix difference: " + get_plot_title(query) + _comparison_title(query)
+    return query.get("matname") + " Matrix: " + get_plot_title(query)
+
+def _matrix_color_scale(query: dict) -> str:
+    # differences always have the diverging color scale
+    return DIFF_COLOR_SCALE if query.get("plot_type") == "matrix_diff" else query.get("color_scale", "inferno")
+
+def _matrix_spec(query: dict, data: dict) -> dict | None:
+    """Get the spec for the plot renderer of a matrix heatmap from its data from _fetch_plot().
+
+    Outputs:
+        dict: the spec, tiled for big matrices
+        or None if there is no data
+    """
+
+    color_scale = _matrix_color_scale(query)
+
+    if data.get("tiles") is not None:
+        spec = dict(data["tiles"], color_scale = color_scale)
+        if data.get("diverging"):
+            # colored evenly either side of no change
+            spec["max"] = max(abs(spec["min"]), abs(spec["max"]))
+            spec["min"] = -spec["max"]
+    elif data.get("frame") is not None:
+        spec = plot_json.matrix_spec(data["frame"], color_scale, query.get("coloring_method", "weight"))
+    else:
+        return None
+
+    spec["title"] = _matrix_title(query)
+    return spec
+
+def _render_plot(plot_type: str, query: dict, data: dict) -> str:
+    """Turn the data for a plot into the HTML to send to the user.
+
+    Inputs:
+        plot_type (str): the type of plot requested
+        query (dict): the shaped (not translated) query
+        data (dict): the data for the plot from _fetch_plot()
+
+    Outputs:
+        str: the plot HTML or an error message
+    """
+
+    # Use match-case to handle different plot types
+    match plot_type:
+        case "sankey":
+            if data["nodes"] is None:
+                return "Error: No cooresponding data"
+            return f"<script>createSankey({data['nodes']},{data['links']},{data['options']},'{get_plot_title(query)}')</script>\
+                    <button onclick='downloadSankey()' class='sankey-download-button'>Download Sankey</button>"
+
+        case "xy_plot":
+            xy = data["figure"]
+            if xy is None:
+                return "Error: No corresponding data"
+            xy.update_layout(
+                title=get_plot_title(query, exclude=data["title_exclude"])
+            )
+            plot_div = plot(xy, output_type="div", include_plotlyjs=False)
+            LOGGER.info("XY plot made")
+            return plot_div
+
+        case "matrices" | "matrix_diff":
+            if MATRIX_HEATMAPS == "altair" and data.get("frame") is not None:
+                heatmap = visualize_matrix(data["frame"], _matrix_color_scale(query), query.get("coloring_method", "weight")).properties(
+                    title = _matrix_title(query),
+                    autosize = {"type": "fit", "contains": "padding"}
+                )
+                plot_div = heatmap.to_html() # Render the figure as an HTML div
+            elif (spec := _matrix_spec(query, data)) is None:
+                plot_div = "Error: No corresponding data"
+            else:
+                # drawn by the plot renderer, with only the rows and columns that have values
+                plot_div = plot_json.inline(spec)
+            
+            LOGGER.info("Matrix visualization made")
+            return plot_div
+
+        case _: # default
+            LOGGER.warning("Unrecognized plot type requested")
+            return "Error: Plot type not specified or supported"
+
+# query fields that change how a plot looks without changing which data is in it
+RENDER_OPTIONS = [
+    "palette", "efficiency", "color_by", "line_by", "facet-col-by", "facet-row-by", "energy_type", "matname", "color_scale", "coloring_method",
+    "compare_by", "compare_year", "compare_version", "compare_country",
+]
+
+# coalesces identical plot requests that come in at the same time
+PLOT_FLIGHTS = SingleFlight(SINGLE_FLIGHT_LOCK_DIR, SINGLE_FLIGHT_RESULT_TTL)
+
+def _plot_key(plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> str:
+    # identical plots have the same type, data and rendering options
+    return canonical_key(plot_type, target[0], translated_query, {k: query.get(k) for k in RENDER_OPTIONS})
+
+def _make_plot(plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> str:
+    # fetch and render in one go
+    return _render_plot(plot_type, query, _fetch_plot(plot_type, query, target, translated_query))
+
+def _render_plot_json(plot_type: str, query: dict, data: dict) -> bytes:
+    """Turn the data for a plot into the compact JSON to send to the plot renderer (see plot_json.py).
+
+    Inputs:
+        plot_type (str): the type of plot requested
+        query (dict): the shaped (not translated) query
+        data (dict): the data for the plot from _fetch_plot()
+
+    Outputs:
+        bytes: the plot spec or an error, as JSON
+    """
+
+    match plot_type:
+        case "sankey":
+            if data["nodes"] is None:
+                return plot_json.dumps(dict(error = "Error: No corresponding data"))
+            spec = dict(
+                type = "sankey",
+                nodes = json.loads(data["nodes"]), links = json.loads(data["links"]), options = json.loads(data["options"])
+            )
+            title = get_plot_title(query)
+
+        case "xy_plot":
+            if data["figure"] is None:
+                return plot_json.dumps(dict(error = "Error: No corresponding data"))
+            spec = plot_json.xy_spec(data["figure"])
+            title = get_plot_title(query, exclude=data["title_exclude"])
+
+        case "matrices" | "matrix_diff":
+            if (spec := _matrix_spec(query, data)) is None:
+                return plot_json.dumps(dict(error = "Error: No corresponding data"))
+            title = spec["title"]
+
+        case _: # default
+            LOGGER.warning("Unrecognized plot type requested")
+            return plot_json.dumps(dict(error = "Error: Plot type not specified or supported"))
+
+    spec["title"] = title
+    return plot_json.dumps(spec)
+
+def _make_plot_json(plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> bytes:
+    # fetch and render in one go
+    return _render_plot_json(plot_type, query, _fetch_plot(plot_type, query, target, translated_query))
+
+def _plot_json_response(request, plot_type: str, query: dict, payload: bytes) -> HttpResponse:
+    """Wrap a plot spec in a response, updating the user's history if the plot was made."""
+
+    response = HttpResponse(payload, content_type="application/json")
+
+    if not payload.startswith(b'{"error"'):
+        serialized_data = update_user_history(request, plot_type, query)
+        response.set_cookie('user_history', serialized_data.hex(), max_age=7 * 24 * 60 * 60)
+
+    return response
+
+@csrf_exempt
+@time_view
+def get_plot_json(request):
+    """Generate and return a plot as compact JSON for the plot renderer (see plot_json.py).
+
+    Works the same as get_plot(). Plots made as background jobs are sent back as
+    {"job": <poller HTML>}, the poller swaps in the plot's HTML once it's made.
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+
+    Outputs:
+        HttpResponse: A JSON response containing the plot spec or an error message.
+    """
+
+    LOGGER.info(f"Plot JSON requested by {request.user.get_username() or 'anonymous user'}")
+
+    if request.method != "POST":
+        return HttpResponse(plot_json.dumps(dict(error = "Error: Plots must be requested with POST")), content_type="application/json", status=405)
+
+    query, plot_type, target = shape_post_request(request.POST, ret_plot_type = True, ret_database_target = True)
+
+    if error := _plot_form_error(query):
+        return HttpResponse(plot_json.dumps(dict(error = error)), content_type="application/json", status=400)
+
+    if error := _plot_request_error(request.user, query):
+        return HttpResponse(plot_json.dumps(dict(error = error)), content_type="application/json")
+
+    translated_query = translate_query(target, query)
+
+    if not might_have_data(target, translated_query):
+        return HttpResponse(plot_json.dumps(dict(error = "Error: No corresponding data")), content_type="application/json")
+
+    # expensive plots are made in the background, the page polls for their HTML
+    if job_response := _submit_plot_job(_job_user(request, request.user), _plot_key(plot_type, query, target, translated_query), plot_type, query, target, translated_query):
+        return HttpResponse(plot_json.dumps(dict(job = job_response)), content_type="application/json")
+
+    key = _plot_key("json:" + plot_type, query, target, translated_query)
+    payload = PLOT_FLIGHTS.do(key, _make_plot_json, plot_type, query, target, translated_query)
+    return _plot_json_response(request, plot_type, query, payload)
+
+@csrf_exempt
+@time_view
+async def async_get_plot_json(request):
+    """Generate and return a plot as compact JSON, without tying up the server while it's made.
+
+    Works the same as get_plot_json(), with the threads of async_get_plot().
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+
+    Outputs:
+        HttpResponse: A JSON response containing the plot spec or an error message.
+    """
+
+    user = await request.auser()
+    LOGGER.info(f"Plot JSON requested by {user.get_username() or 'anonymous user'}")
+
+    if request.method != "POST":
+        return HttpResponse(plot_json.dumps(dict(error = "Error: Plots must be requested with POST")), content_type="application/json", status=405)
+
+    query, plot_type, target = shape_post_request(request.POST, ret_plot_type = True, ret_database_target = True)
+
+    if error := _plot_form_error(query):
+        return HttpResponse(plot_json.dumps(dict(error = error)), content_type="application/json", status=400)
+
+    if error := await run_in_db_thread(_plot_request_error, user, query):
+        return HttpResponse(plot_json.dumps(dict(error = error)), content_type="application/json")
+
+    translated_query = await run_in_db_thread(translate_query, target, query)
+
+    if not await run_in_db_thread(might_have_data, target, translated_query):
+        return HttpResponse(plot_json.dumps(dict(error = "Error: No corresponding data")), content_type="application/json")
+
+    # expensive plots are made in the background, the page polls for their HTML
+    if job_response := await run_in_db_thread(_submit_plot_job, _job_user(request, user), _plot_key(plot_type, query, target, translated_query), plot_type, query, target, translated_query):
+        return HttpResponse(plot_json.dumps(dict(job = job_response)), content_type="application/json")
+
+    async def make_plot():
+        data = await run_in_db_thread(_fetch_plot, plot_type, query, target, translated_query)
+        return await run_in_render_thread(_render_plot_json, plot_type, query, data)
+
+    key = _plot_key("json:" + plot_type, query, target, translated_query)
+    payload = await PLOT_FLIGHTS.do_async(key, make_plot)
+    return _plot_json_response(request, plot_type, query, payload)
+
+@time_view
+def get_heatmap_tile(request, name: str, tile_row: int, tile_col: int):
+    """Get one tile of a big matrix heatmap (see publish_matrix_tiles()).
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+        name (str): the name of the matrix, given with its heatmap
+        tile_row, tile_col (int): which tile
+
+    Outputs:
+        HttpResponse: A JSON response containing the cells of the tile,
+        or a 404 if the matrix has expired.
+    """
+
+    if not re.fullmatch(r"[0-9a-f]{64}", name) or (tile := get_matrix_tile(name, tile_row, tile_col)) is None:
+        return HttpResponse(plot_json.dumps(dict(error = "Error: Matrix not found, it may have expired. Please plot again.")), content_type="application/json", status=404)
+
+    response = HttpResponse(plot_json.dumps(plot_json.matrix_tile_spec(tile)), content_type="application/json")
+    # a matrix's tiles never change
+    response["Cache-Control"] = f"private, max-age={MATRIX_TILE_TTL}"
+    return response
+
+@csrf_exempt
+@time_view
+def get_matrix_quantity(request):
+    """Work out an input-output quantity from the RUVY matrices of a query (see matrix_algebra.py).
+
+    Takes the same POST form as a matrix plot, along with
+        quantity: which quantity to work out, one of QUANTITIES
+        format: "json" for sparse JSON (the default) or "mtx" for Matrix Market
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+
+    Outputs:
+        HttpResponse: A response containing the quantity or an error message.
+    """
+
+    if request.method != "POST":
+        return HttpResponse("Error: Quantities must be requested with POST", status=405)
+
+    query, target = shape_post_request(request.POST, ret_database_target = True)
+    quantity = query.pop("quantity", None)
+    output_format = query.pop("format", "json")
+
+    if quantity not in QUANTITIES or output_format not in ("json", "mtx"):
+        return HttpResponse(f"Error: quantity must be one of {', '.join(QUANTITIES)} and format one of json, mtx", status=400)
+
+    if error := _plot_request_error(request.user, query):
+        return HttpResponse(error, status=403)
+
+    # every quantity is worked out from all four matrices
+    query["matname"] = "RUVY"
+    translated_query = translate_query(target, query)
+
+    if not might_have_data(target, translated_query) or (result := get_quantity(target, translated_query, quantity)) is None:
+        return HttpResponse("Error: No corresponding data", status=404)
+
+    LOGGER.info(f"Matrix quantity {quantity} worked out")
+    if output_format == "mtx":
+        response = HttpResponse(result.to_matrix_market(), content_type="text/plain")
+        response["Content-Disposition"] = f'attachment; filename="{quantity}.mtx"'
+        return response
+
+    return HttpResponse(plot_json.dumps(result.to_json()), content_type="application/json")
+
+# makes expensive plots in the background
+PLOT_JOBS = JobQueue(PLOT_JOB_DIR, PLOT_JOB_WORKERS, PLOT_JOB_PER_USER, PLOT_JOB_RESULT_TTL, PLOT_JOB_TIMEOUT)
+
+def _job_user(request, user) -> str:
+    # who a job counts against, anonymous users are told apart by address
+    return user.get_username() or request.META.get("REMOTE_ADDR", "anonymous")
+
+def _job_poller(job_id: str) -> str:
+    # swaps itself out for the next poll (or the finished plot) every so often
+    return f"<div hx-get='/plot/job/{job_id}' hx-trigger='load delay:{PLOT_JOB_POLL_INTERVAL}s' hx-target='#plot-section' hx-swap='innerHTML' hx-indicator='#plot-spinner'>\
+            Making plot, this one may take a while...</div>"
+
+def _plot_fetches(plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> list[tuple[dict, list]] | None:
+    # the queries and columns _fetch_plot() gets for a plot,
+    # or None if that can't be told without fetching
+    match plot_type:
+        case "sankey":
+            return [(sankey_query(target, translated_query), SANKEY_COLUMNS)]
+
+        case "xy_plot":
+            columns = xy_columns(query.get("efficiency"), query.get("color_by"), query.get("line_by"), query.get("facet-col-by"), query.get("facet-row-by"))
+            return [(translated_query, columns)]
+
+        case "matrices":
+            ruvy = query.get("matname") == "RUVY" and query.get("coloring_method", "weight") == "ruvy"
+            return [(translated_query, ["i", "j", "value", "matname"] if ruvy else ["i", "j", "value"])]
+
+    return None
+
+def _submit_plot_job(job_user: str, key: str, plot_type: str, query: dict, target: DatabaseTarget, translated_query: dict) -> str | None:
+    """Make a plot as a background job if it is expensive to make.
+
+    Whether a plot is expensive is decided by how many rows the database expects it to select.
+    Plots already being made, or whose data is in memory, are never expensive,
+    so the database is only asked for its estimate when neither is the case.
+
+    Inputs:
+        job_user (str): who the job is for (see _job_user())
+        key (str): the key of the plot (see _plot_key())
+        plot_type (str): the type of plot requested
+        query (dict): the shaped (not translated) query
+        target (DatabaseTarget): the database target of the query
+        translated_query (dict): the query translated for the database (see translate_query())
+
+    Outputs:
+        str: the HTML to send back, either a poller for the job or an error message
+        or None if the plot should be made right away
+    """
+
+    if PLOT_JOB_ROW_THRESHOLD <= 0:
+        return None
+
+    # someone is already making it, wait for theirs
+    if PLOT_FLIGHTS.pending(key):
+        return None
+
+    try:
+        fetches = _plot_fetches(plot_type, query, target, translated_query)
+        if fetches is not None and all(is_cached(target, fetch_query, columns) for fetch_query, columns in fetches):
+            return None
+
+        rows = estimate_rows(target, translated_query)
+    except Exception as e:
+        LOGGER.warning(f"Couldn't estimate the size of a plot, making it right away: {e}")
+        return None
+
+    if rows <= PLOT_JOB_ROW_THRESHOLD:
+        return None
+
+    # the job still coalesces with anyone making the plot right away
+    # its ID can't be worked out from the query, so only those given it can poll for the plot
+    job_id = PLOT_JOBS.submit(
+        canonical_key(SECRET_KEY, "plot job", key), job_user, dict(plot_type = plot_type, query = query),
+        PLOT_FLIGHTS.do, key, _make_plot, plot_type, query, target, translated_query
+    )
+    if job_id is None:
+        return "Error: You already have plots being made, please wait for them to finish"
+
+    LOGGER.info(f"Plot of about {rows} rows made as job {job_id}")
+    return _job_poller(job_id)
+
+def _plot_response(request, plot_type: str, query: dict, plot_div: str) -> HttpResponse:
+    """Wrap plot HTML in a response, updating the user's history if the plot was made."""
+
+    response = HttpResponse(plot_div) # the final response to be returned
+    
+    # Update user history only if there was no error
+    if not plot_div.startswith("Error"):
+        serialized_data = update_user_history(request, plot_type, query)
+        response.content += b"<script>refreshHistory();</script>"
+        # if the plot should be in a separate window
+        if query.get("separate_window") == "on":
+            response.content += b"<script>plotInNewWindow();</script>"
+        # Set cookie to expire in 7 days
+        response.set_cookie('user_history', serialized_data.hex(), max_age=7 * 24 * 60 * 60)
+
+    return response
+
 @csrf_exempt
 @time_view
 def get_plot(request):
@@ -139,106 +722,192 @@ def get_plot(request):
         # Extract plot type and query parameters from the POST request
         query, plot_type, target = shape_post_request(request.POST, ret_plot_type = True, ret_database_target = True)
 
-        try:
-            if query["dataset"].startswith(SANDBOX_PREFIX) != query["version"].startswith(SANDBOX_PREFIX):
-                return HttpResponse("Error: Dataset and version must both be from sandbox or both not be from sandbox!")
-        except:
-            pass
-        
-        # get boolean of if the plot should be
-        # in a separate window
-        separate_window = query.get("separate_window") == "on"
+        if error := _plot_form_error(query):
+            return HttpResponse(error, status=400)
 
-        # Check if the user has access to IEA data
-        # TODO: make this work with status = 403, problem is HTMX won't show anything
-        if not iea_valid(request.user, query):
-            LOGGER.warning(f"IEA data requested by unauthorized user {request.user.get_username() or 'anonymous user'}")
-            return HttpResponse("You do not have access to IEA data. Please contact <a style='color: #00adb5' :visited='{color: #87CEEB}' href='mailto:matthew.heun@calvin.edu'>matthew.heun@calvin.edu</a> with questions."
-                                "You can also purchase WEB data at <a style='color: #00adb5':visited='{color: #87CEEB}' href='https://www.iea.org/data-and-statistics/data-product/world-energy-balances'> World Energy Balances</a>.")
-        
-        plot_div = None # where to store what html will be sent to the user
-
-        # Use match-case to handle different plot types
-        match plot_type:
-            case "sankey":
-                translated_query = translate_query(target, query)
-                nodes,links,options = get_sankey(target, translated_query)
-
-                if nodes is None:
-                    plot_div = "Error: No cooresponding data"
-                else:
-                    plot_div = f"<script>createSankey({nodes},{links},{options},'{get_plot_title(query)}')</script>\
-                                <button onclick='downloadSankey()' class='sankey-download-button'>Download Sankey</button>"
-
-            case "xy_plot":
-                # Extract specific parameters for xy_plot
-                efficiency_metric = query.get('efficiency')
-                color_by = query.get("color_by")
-                line_by = query.get("line_by")
-                facet_col_by = query.get("facet-col-by")
-                facet_row_by = query.get("facet-row-by")
-                energy_type = query.get("energy_type")
-                
-                # Handle combined Energy and Exergy case
-                if 'Energy' in energy_type and 'Exergy' in energy_type:
-                    energy_type = 'Energy, Exergy'
-                
-                translated_query = translate_query(target, query)
-                xy = get_xy(efficiency_metric, target, translated_query, color_by, line_by, facet_col_by, facet_row_by, energy_type)
-                if xy is None:
-                    plot_div = "Error: No corresponding data"
-                else:
-                    xy.update_layout(
-                        title=get_plot_title(query, exclude=[color_by, line_by, facet_col_by, facet_row_by, energy_type])
-                    )
-                    plot_div = plot(xy, output_type="div", include_plotlyjs=False)
-                    LOGGER.info("XY plot made")
-
-            case "matrices":
-                # Extract specific parameters for matrices
-                matrix_name = query.get("matname")
-                color_scale = query.get('color_scale', "inferno")
-
-                # Retrieve the matrix
-                coloring_method = query.get('coloring_method', 'weight')
-                translated_query = translate_query(target, query)
-                
-                matname = None
-                if matrix_name == "RUVY" and coloring_method == "ruvy":
-                    matrix, matname = get_ruvy_matrix(target, translated_query)
-                else:
-                    matrix = get_matrix(target, translated_query)
-
-                if matrix is None:
-                    plot_div = "Error: No corresponding data"
-                else:
-                    heatmap = visualize_matrix(target, matrix, matname, color_scale, coloring_method)
-                    heatmap = heatmap.properties(
-                        title=matrix_name + " Matrix: " + get_plot_title(query),
-                        autosize = {"type": "fit", "contains": "padding"}
-                    )
-                    plot_div = heatmap.to_html() # Render the figure as an HTML div
-                
-                LOGGER.info("Matrix visualization made")
-        
+        if error := _plot_request_error(request.user, query):
+            return HttpResponse(error)
 
-            case _: # default
-                plot_div = "Error: Plot type not specified or supported"
-                LOGGER.warning("Unrecognized plot type requested")
-        
-        response = HttpResponse(plot_div) # the final response to be returned
-        
-        # Update user history only if there was no error
-        if not plot_div.startswith("Error"):
-            serialized_data = update_user_history(request, plot_type, query)
-            response.content += b"<script>refreshHistory();</script>"
-            if separate_window:
-                response.content += b"<script>plotInNewWindow();</script>"
-            # Set cookie to expire in 7 days
-            response.set_cookie('user_history', serialized_data.hex(), max_age=7 * 24 * 60 * 60)
+        translated_query = translate_query(target, query)
+
+        # don't go to the database for queries that certainly have no data
+        if not might_have_data(target, translated_query):
+            return HttpResponse("Error: No corresponding data")
+
+        key = _plot_key(plot_type, query, target, translated_query)
+
+        # expensive plots are made in the background and polled for
+        if job_response := _submit_plot_job(_job_user(request, request.user), key, plot_type, query, target, translated_query):
+            return HttpResponse(job_response)
+
+        # if someone else is already making this exact plot, wait for theirs
+        plot_div = PLOT_FLIGHTS.do(key, _make_plot, plot_type, query, target, translated_query)
+        response = _plot_response(request, plot_type, query, plot_div)
 
     return response
 
+@csrf_exempt
+@time_view
+async def async_get_plot(request):
+    """Generate and return a plot based on the POST request data, without tying up the server while it's made.
+
+    Works the same as get_plot(), but the database work is done on a
+    bounded pool of database threads and the rendering on a pool of render threads,
+    so one process can have many slow plot requests in flight at once.
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+
+    Outputs:
+        HttpResponse: A response containing the plot HTML or an error message.
+    """
+
+    user = await request.auser()
+
+    # if user is not logged in their username is empty string
+    # mark them as anonymous in the logs
+    LOGGER.info(f"Plot requested by {user.get_username() or 'anonymous user'}")
+
+    if request.method == "POST":
+        # Extract plot type and query parameters from the POST request
+        query, plot_type, target = shape_post_request(request.POST, ret_plot_type = True, ret_database_target = True)
+
+        if error := _plot_form_error(query):
+            return HttpResponse(error, status=400)
+
+        if error := await run_in_db_thread(_plot_request_error, user, query):
+            return HttpResponse(error)
+
+        translated_query = await run_in_db_thread(translate_query, target, query)
+
+        # don't go to the database for queries that certainly have no data
+        if not await run_in_db_thread(might_have_data, target, translated_query):
+            return HttpResponse("Error: No corresponding data")
+
+        key = _plot_key(plot_type, query, target, translated_query)
+
+        # expensive plots are made in the background and polled for
+        if job_response := await run_in_db_thread(_submit_plot_job, _job_user(request, user), key, plot_type, query, target, translated_query):
+            return HttpResponse(job_response)
+
+        async def make_plot():
+            data = await run_in_db_thread(_fetch_plot, plot_type, query, target, translated_query)
+            return await run_in_render_thread(_render_plot, plot_type, query, data)
+
+        # if someone else is already making this exact plot, wait for theirs
+        plot_div = await PLOT_FLIGHTS.do_async(key, make_plot)
+        response = _plot_response(request, plot_type, query, plot_div)
+
+    return response
+
+@time_view
+def get_plot_job(request, job_id: str):
+    """Poll for a plot being made as a background job (see _submit_plot_job()).
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+        job_id (str): the ID of the job
+
+    Outputs:
+        HttpResponse: A response containing the plot HTML once it is made,
+        another poller while it is being made, or an error message.
+    """
+
+    state = PLOT_JOBS.get(job_id)
+    if state is None:
+        return HttpResponse("Error: Plot not found, it may have expired. Please plot again.")
+
+    match state["status"]:
+        case "pending":
+            return HttpResponse(_job_poller(job_id))
+
+        case "error":
+            return HttpResponse("Error: Plot could not be made")
+
+    info = state["info"]
+
+    # the plot may be shared with other users' jobs for the same plot
+    if error := _plot_request_error(request.user, info["query"]):
+        return HttpResponse(error)
+
+    return _plot_response(request, info["plot_type"], info["query"], state["result"])
+
+# form fields whose options can be narrowed down to those with data
+# values are the column each field is for (see Translator.get_all_available())
+AVAILABLE_FIELDS = {
+    "version": "Version",
+    "country": "Country",
+    "energy_type": "EnergyType",
+    "last_stage": "LastStage",
+    "product_aggregation": "ProductAggregation",
+    "industry_aggregation": "IndustryAggregation",
+    "grossnet": "GrossNet",
+    "matname": "matname",
+    "year": "Year",
+}
+
+@csrf_exempt
+@time_view
+def get_available(request):
+    """Give the options of the visualizer's form that there is data for, given the rest of the form.
+
+    The options for each field are found ignoring what is picked for that field,
+    so picking one option doesn't hide the others.
+
+    Inputs:
+        request (HttpRequest): The HTTP request object, with the form as its POST data.
+
+    Outputs:
+        JsonResponse: A response with the available options for each field that can be narrowed,
+        e.g. {"country": ["Ghana", ...], "year": [1971, ...], ...}
+    """
+
+    if request.method != "POST":
+        return JsonResponse({"error": "Form must be POSTed"}, status = 405)
+
+    query, target = shape_post_request(request.POST, ret_database_target = True)
+    sandbox = target[0] == "sandbox"
+
+    try:
+        translated_query = translate_query(target, query)
+    except (KeyError, ValueError, AttributeError) as e:
+        return JsonResponse({"error": f"Couldn't read form: {e}"}, status = 400)
+
+    combination_columns, bitset_columns = INDEXED_COLUMNS.get(target[1], ([], []))
+    available = {}
+    for field, column in AVAILABLE_FIELDS.items():
+        if column != "Version" and column not in combination_columns + bitset_columns:
+            continue
+        available[field] = Translator.get_all_available(column, target, translated_query)
+
+    # versions from the sandbox are shown with the sandbox prefix
+    if sandbox and "version" in available:
+        available["version"] = [SANDBOX_PREFIX + version for version in available["version"]]
+
+    # RUVY is all four matrices together
+    if "matname" in available and {"R", "U", "V", "Y"} <= set(available["matname"]):
+        available["matname"].append("RUVY")
+
+    return JsonResponse(available)
+
+def _data_columns(target: DatabaseTarget) -> list[str]:
+    # Which columns to give for a data request
+    if target[1] is AggEtaPFU:
+        # get xy info
+        return META_COLUMNS + AGGETA_COLUMNS
+    # get psut (sankey and matrix) info
+    return META_COLUMNS + PSUT_COLUMNS
+
+def _csv_response(csv) -> StreamingHttpResponse:
+    # stream the csv chunks
+    # then give csv MIME 
+    # and appropriate http header
+    return StreamingHttpResponse(
+        streaming_content = csv,
+        content_type = "text/csv",
+        headers = {"Content-Disposition": 'attachment; filename="eviz_data.csv"'} # TODO: make this file name more descriptive
+    )
+
 @time_view
 def get_data(request):
     """ Handle data retrieval requests and return CSV data based on the query.
@@ -247,7 +916,8 @@ def get_data(request):
         request (HttpRequest): The HTTP request object.
 
     Outputs:
-        HttpResponse: A response containing CSV data or an error message.
+        StreamingHttpResponse: A response streaming CSV data
+        or HttpResponse: A response containing an error message.
     """
 
     # if user is not logged in their username is empty string
@@ -261,33 +931,59 @@ def get_data(request):
 
         if not iea_valid(request.user, query):
             LOGGER.warning(f"IEA data requested by unauthorized user {request.user.get_username() or 'anonymous user'}")
-            return HttpResponse("You do not have access to IEA data. Please contact <a style='color: #00adb5' :visited='{color: #87CEEB}' href='mailto:matthew.heun@calvin.edu'>matthew.heun@calvin.edu</a> with questions."
-                                "You can also purchase WEB data at <a style='color: #00adb5':visited='{color: #87CEEB}' href='https://www.iea.org/data-and-statistics/data-product/world-energy-balances'> World Energy Balances</a>.")
+            return HttpResponse(IEA_ACCESS_MESSAGE)
 
         # Translate the query to match database field names
         query = translate_query(target, query)
 
-        # Generate CSV data based on the query
-        if target[1] is AggEtaPFU:
-            # get xy info
-            csv = get_csv_from_query(target, query, columns = META_COLUMNS + AGGETA_COLUMNS)
-        else:
-            # get psut (sankey and matrix) info
-            csv = get_csv_from_query(target, query, columns = META_COLUMNS + PSUT_COLUMNS)
-
         # set up the response:
-        # content is the csv made above
-        # then give csv MIME 
-        # and appropriate http header
-        final_response = HttpResponse(
-            content = csv,
-            content_type = "text/csv",
-            headers = {"Content-Disposition": 'attachment; filename="eviz_data.csv"'} # TODO: make this file name more descriptive
-        )
-        LOGGER.info("Made CSV data")
+        # content is the csv, streamed a chunk of rows at a time as it is made
+        # so the whole dataset is never held in memory at once
+        final_response = _csv_response(iter_csv_from_query(target, query, _data_columns(target)))
+        LOGGER.info("Streaming CSV data")
 
         # TODO: excel downloads
         # MIME for workbook is application/vnd.openxmlformats-officedocument.spreadsheetml.sheet
         # file handle is xlsx for workbook 
 
+    return final_response
+
+@time_view
+async def async_get_data(request):
+    """ Handle data retrieval requests and stream CSV data based on the query, without tying up the server.
+
+    Works the same as get_data(), but the chunks of CSV are made in a thread
+    while the server keeps handling other requests.
+
+    Inputs:
+        request (HttpRequest): The HTTP request object.
+
+    Outputs:
+        StreamingHttpResponse: A response streaming CSV data
+        or HttpResponse: A response containing an error message.
+    """
+
+    user = await request.auser()
+
+    # if user is not logged in their username is empty string
+    # mark them as anonymous in the logs
+    LOGGER.info(f"Data requested by {user.get_username() or 'anonymous user'}")
+
+    if request.method == "POST":
+
+        # set up query and get csv from it
+        query, target = shape_post_request(request.POST, ret_database_target = True)
+
+        if not await run_in_db_thread(iea_valid, user, query):
+            LOGGER.warning(f"IEA data requested by unauthorized user {user.get_username() or 'anonymous user'}")
+            return HttpResponse(IEA_ACCESS_MESSAGE)
+
+        # Translate the query to match database field names
+        query = await run_in_db_thread(translate_query, target, query)
+
+        # the server-side cursor behind the csv has to stay on one thread,
+        # so the chunks are made on this request's thread
+        final_response = _csv_response(iterate_in_thread(iter_csv_from_query(target, query, _data_columns(target))))
+        LOGGER.info("Streaming CSV data")
+
     return final_response
\ No newline at end of file
@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'eviz_site.settings')
+# serve plots and downloads with the async views (see ASYNC_VIEWS in settings.py),
+# unless they were explicitly turned off
+os.environ.setdefault('async_views', 'on')
 
 application = get_asgi_application()
+
+# only processes that serve requests import this module (runserver does too, in the process it serves from)
+from django.apps import apps
+apps.get_app_config('eviz').warm_up()
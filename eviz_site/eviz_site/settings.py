@@ -79,28 +79,66 @@ WSGI_APPLICATION = 'eviz_site.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Threads that query the databases at once in each process
+# (a connection pool is sized to these, so they are set here rather than with the rest of their settings)
+# how many threads do database work for the async views (see utils/concurrency.py)
+PLOT_DB_THREADS = int(environ.get("plot_db_threads", 8))
+# how many background plot jobs run at once (see utils/jobs.py)
+PLOT_JOB_WORKERS = int(environ.get("plot_job_workers", 2))
+# connections kept for requests' own queries, e.g. the sync views, availability and version checks
+REQUEST_DB_CONNECTIONS = int(environ.get("request_db_connections", 2))
+
+def _pool_options(alias: str, min_size: int, max_size: int) -> dict:
+    # Options for a database's connection pool
+    # sizes can be overridden with environment variables,
+    # e.g. default_pool_min_size and default_pool_max_size
+    # "manage.py benchmark pool" compares /plot latency with and without the pools
+    return {
+        "min_size": int(environ.get(f"{alias}_pool_min_size", min_size)),
+        "max_size": int(environ.get(f"{alias}_pool_max_size", max_size)),
+        # how many seconds a request waits for a free connection before erroring
+        "timeout": float(environ.get(f"{alias}_pool_timeout", 10)),
+    }
+
+# every thread that can be querying at once gets a connection without waiting,
+# anything past that (e.g. a burst of sync requests) waits for one to be given back;
+# the minimum keeps enough open for requests' own queries so a quiet site doesn't reconnect
+_DB_CONNECTIONS = PLOT_DB_THREADS + PLOT_JOB_WORKERS + REQUEST_DB_CONNECTIONS
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
+        # make sure a pooled connection still works before handing it out
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS": {
             "service": "MexerDB",
             # All other information provided through environment variables
             # PGSERVICEFILE and PGPASSFILE
-            "application_name": "Mexer Site"
+            "application_name": "Mexer Site",
+            # reuse connections instead of connecting for every request
+            "pool": _pool_options("default", REQUEST_DB_CONNECTIONS, _DB_CONNECTIONS),
         }
     },
     "sandbox": {
         "ENGINE": "django.db.backends.postgresql",
+        # make sure a pooled connection still works before handing it out
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS": {
             "service": "SandboxDB",
-            "application_name": "Mexer Site"
+            "application_name": "Mexer Site",
+            # sandbox plots are rare, so only a connection is kept open,
+            # but they can still come in as many at once as any other plot
+            "pool": _pool_options("sandbox", 1, _DB_CONNECTIONS),
         }
     },
     'users': {
         'ENGINE': 'django.db.backends.postgresql',
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS":{
             "service": "users",
-            "application_name": "Mexer Site"
+            "application_name": "Mexer Site",
+            # every request checks its session here, so it can be as busy as the default database
+            "pool": _pool_options("users", REQUEST_DB_CONNECTIONS, _DB_CONNECTIONS),
         }
     }
 
@@ -138,7 +176,7 @@ USE_TZ = True
 
 # Static files (CSS, JavaScript, Images)
 # NOT used in the Django way...
-# see eviz/views/misc.py for how statics are handled
+# see utils/static.py for how statics are handled
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [
     BASE_DIR / "static",
@@ -146,6 +184,10 @@ STATICFILES_DIRS = [
     BASE_DIR / "static/js",
 ]
 STATIC_BASE = BASE_DIR / "static"
+# how many seconds browsers keep static files asked for by their hashed URLs
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# how big a static file has to be before compressed copies of it are made
+STATIC_COMPRESS_MIN_BYTES = 512
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -189,6 +231,107 @@ LOGGING = {
 
 SANKEY_COLORS_PATH = BASE_DIR / "internal_resources" / "sankey_color_categories.json"
 
+# palettes that can be used to color energy carriers (see utils/colors.py)
+# "carriers" is a list of carriers without colors, each is given a distinct but arbitrary one
+SANKEY_PALETTES = {
+    "categories": SANKEY_COLORS_PATH,
+    "scheme": BASE_DIR / "internal_resources" / "given_scheme.json",
+    "carriers": BASE_DIR / "internal_resources" / "carriers_list.json",
+}
+SANKEY_DEFAULT_PALETTE = "categories"
+
 SANDBOX_PREFIX = "sDB:"
 
-IEA_TABLES = ["IEA EWEB", "CL-PFU IEA", "CL-PFU IEA+MW"]
\ No newline at end of file
+IEA_TABLES = ["IEA EWEB", "CL-PFU IEA", "CL-PFU IEA+MW"]
+
+# Query result cache (see utils/cache.py)
+# how many bytes of query results to keep in memory per process
+RESULT_CACHE_MAX_BYTES = int(environ.get("result_cache_max_bytes", 256 * 1024 * 1024))
+# how many seconds to wait between checking the databases for new versions
+RESULT_CACHE_VERSION_CHECK = 60
+
+
+# Async plotting (see utils/concurrency.py)
+# serve /plot and /data with the async views
+# on by default only under ASGI (eviz_site/asgi.py turns it on), e.g. with uvicorn;
+# under WSGI (e.g. runserver, as in the dockerfile) async views only add overhead,
+# and streamed responses (the CSV downloads) are read into memory before being sent
+ASYNC_VIEWS = environ.get("async_views", "off") == "on"
+# how many threads do database work for the async views is PLOT_DB_THREADS, set with the databases above
+# how many threads render plots for the async views
+PLOT_RENDER_THREADS = int(environ.get("plot_render_threads", 4))
+
+# Coalescing of identical plot requests (see utils/singleflight.py)
+# directory for lock files to also coalesce across processes on this host
+# (unset to only coalesce within each process)
+SINGLE_FLIGHT_LOCK_DIR = environ.get("single_flight_lock_dir")
+# how many seconds a finished plot is left for other processes to pick up
+SINGLE_FLIGHT_RESULT_TTL = 10
+
+# Background jobs for expensive plots (see utils/jobs.py)
+# plots the database expects to select more rows than this are made as jobs
+# (set to 0 to never use jobs)
+PLOT_JOB_ROW_THRESHOLD = int(environ.get("plot_job_row_threshold", 500_000))
+# directory to keep job state in, shared by every process on this host
+PLOT_JOB_DIR = environ.get("plot_job_dir", "/tmp/eviz_plot_jobs")
+# how many jobs run at once per process is PLOT_JOB_WORKERS, set with the databases above
+# how many jobs one user can have queued or running at once
+PLOT_JOB_PER_USER = 2
+# how many seconds finished plots are kept for polling
+PLOT_JOB_RESULT_TTL = 300
+# how many seconds a job can go unfinished before it is given up on
+PLOT_JOB_TIMEOUT = 900
+# how many seconds the page waits between polls
+PLOT_JOB_POLL_INTERVAL = 2
+
+# Translation cache generation (see utils/translator.py)
+# file holding the stamp that makes every process reload its translations when changed
+TRANSLATOR_GENERATION_FILE = environ.get("translator_generation_file", "/tmp/eviz_translator_generation")
+# how many seconds to wait between checking the stamp
+TRANSLATOR_GENERATION_CHECK = 5
+# load every translation when the server starts (see EvizConfig.warm_up() in eviz/apps.py), instead of on first use
+TRANSLATOR_WARMUP = environ.get("translator_warmup", "on") == "on"
+# the databases that have translation tables to warm up
+TRANSLATION_DATABASES = ["default", "sandbox"]
+
+# Availability index (see utils/availability.py)
+# build the index of which queries have data when the server starts, instead of on first use
+AVAILABILITY_WARMUP = environ.get("availability_warmup", "on") == "on"
+
+# Local partition store (see utils/partitions.py)
+# directory to keep partitions in, built with "manage.py build_partitions"
+# (unset to not use partitions)
+PARTITION_DIR = environ.get("partition_dir")
+
+# Efficiency cube (see utils/cube.py)
+# build the in-memory cube of xy plot data when the server starts, instead of on first use
+CUBE_WARMUP = environ.get("cube_warmup", "on") == "on"
+
+# Shared data store (see utils/shared.py)
+# directory (ideally on a RAM backed file system, e.g. /dev/shm) holding data
+# every process on the host maps instead of keeping its own copy
+SHARED_DATA_DIR = environ.get("shared_data_dir", "/dev/shm/eviz" if Path("/dev/shm").is_dir() else "/tmp/eviz_shared")
+
+# Large xy plots (see utils/xy_plot.py)
+# how many points or lines a plot can have before it is drawn with WebGL
+XY_WEBGL_POINTS = 5000
+XY_WEBGL_TRACES = 100
+# how many points a WebGL plot is downsampled to
+XY_POINT_BUDGET = int(environ.get("xy_point_budget", 20000))
+
+# Large matrix heatmaps (see utils/matrix.py)
+# how many values a matrix can have before its heatmap is drawn in tiles
+MATRIX_TILE_CELLS = int(environ.get("matrix_tile_cells", 20000))
+# how smaller heatmaps are drawn on the plot page:
+# "compact" sends only the cells with values, as codes into their labels, to the plot renderer (plotUtil.js)
+# "altair" sends Altair's HTML with every cell's labels inline (Altair refuses more than 5,000 cells)
+# (the plot JSON endpoint always sends compact heatmaps)
+MATRIX_HEATMAPS = environ.get("matrix_heatmaps", "compact")
+# how many rows and columns are in each tile
+MATRIX_TILE_SIZE = 128
+# how many seconds a matrix is kept for its tiles to be fetched
+MATRIX_TILE_TTL = 3600
+
+# Matrix algebra (see utils/matrix_algebra.py)
+# how many queries' matrices and factorizations are kept
+MATRIX_ALGEBRA_CACHE_SIZE = 32
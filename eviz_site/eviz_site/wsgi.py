@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'eviz_site.settings')
 
 application = get_wsgi_application()
+
+# only processes that serve requests import this module (runserver does too, in the process it serves from)
+from django.apps import apps
+apps.get_app_config('eviz').warm_up()
@@ -104,4 +104,269 @@ const downloadSankey = () => {
     document.body.removeChild(a);
 }
 
-export {downloadSankey, createSankey};
\ No newline at end of file
+// constructors for the typed arrays sent by /plot.json (see utils/plot_json.py)
+const TYPED_ARRAYS = {f4: Float32Array, f8: Float64Array, i2: Int16Array, i4: Int32Array, u1: Uint8Array};
+
+const decodeArray = ({dtype, bdata}) => {
+    // base64 of the little-endian bytes of the array
+    const binary = atob(bdata);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++)
+        bytes[i] = binary.charCodeAt(i);
+    return new TYPED_ARRAYS[dtype](bytes.buffer);
+}
+
+// the parts of every xy plot's layout that don't change from plot to plot,
+// so they aren't sent with each one
+const XY_LAYOUT = {
+    plot_bgcolor: "white",
+    showlegend: true,
+    margin: {l: 50, r: 50, t: 50, b: 50},
+    hovermode: "closest",
+};
+
+const renderXY = (spec, container) => {
+    const traces = spec.traces.map(trace => Object.assign(trace, {
+        x: Array.from(decodeArray(trace.x), year => String(year)), // years as dates
+        y: decodeArray(trace.y),
+    }));
+    const layout = Object.assign({}, XY_LAYOUT, spec.layout, {title: {text: spec.title}});
+    Plotly.newPlot(container, traces, layout, {responsive: true});
+}
+
+const renderMatrix = (spec, container) => {
+    const x = decodeArray(spec.x);
+    const y = decodeArray(spec.y);
+    const value = decodeArray(spec.value);
+    const matname = spec.matname && decodeArray(spec.matname);
+    const relative = spec.relative && decodeArray(spec.relative);
+
+    const values = new Array(value.length);
+    for (let i = 0; i < value.length; i++) {
+        values[i] = {x: spec.labels[x[i]], y: spec.labels[y[i]], value: value[i]};
+        if (matname) values[i].matname = spec.matnames[matname[i]];
+        if (relative) values[i].relative = relative[i];
+    }
+
+    const byMatname = spec.coloring_method === "ruvy" && matname;
+    const tooltip = [{field: "y", title: "From"}, {field: "x", title: "To"}, {field: "value", type: "quantitative"}];
+    if (byMatname) tooltip.push({field: "matname"});
+    if (relative) tooltip.push({field: "relative", type: "quantitative", format: "+.1%"});
+
+    vegaEmbed(container, {
+        $schema: "https://vega.github.io/schema/vega-lite/v4.17.0.json",
+        title: spec.title,
+        autosize: {type: "fit", contains: "padding"},
+        data: {values: values},
+        mark: {type: "rect", stroke: "blue", strokeWidth: 1},
+        encoding: {
+            x: {field: "x", type: "nominal", sort: spec.labels, axis: {orient: "top", labelAngle: -45, title: ""}},
+            y: {field: "y", type: "nominal", sort: spec.labels, axis: {title: ""}},
+            color: {
+                field: byMatname ? "matname" : "value",
+                type: byMatname ? "nominal" : "quantitative",
+                // differences are colored either side of no change
+                scale: relative ? {scheme: spec.color_scale, domainMid: 0} : {scheme: spec.color_scale},
+            },
+            tooltip: tooltip,
+        },
+    });
+}
+
+const createTiledMatrix = (spec, container) => {
+    // draw a big matrix heatmap on a canvas, fetching the tiles of it in view as it is zoomed and panned
+    const [rowCount, colCount] = spec.shape;
+    const tileSize = spec.tile_size;
+
+    const title = document.createElement("div");
+    title.className = "tiled-matrix-title";
+    title.textContent = spec.title;
+    const canvas = document.createElement("canvas");
+    canvas.className = "tiled-matrix";
+    const tooltip = document.createElement("div");
+    tooltip.className = "tiled-matrix-tooltip";
+    container.append(title, canvas, tooltip);
+
+    canvas.width = Math.max(container.clientWidth, plotSection.clientWidth, 600);
+    canvas.height = Math.max(plotSection.clientHeight - title.offsetHeight, 600);
+    const context = canvas.getContext("2d");
+
+    // room for the row and column labels
+    const left = 200, top = 150;
+
+    // how many pixels a cell is, and which cell is at the top left
+    let cellSize = Math.min((canvas.width - left) / colCount, (canvas.height - top) / rowCount);
+    const minCellSize = cellSize;
+    let firstRow = 0, firstCol = 0;
+
+    const continuous = vega.scheme(spec.color_scale) || vega.scheme("inferno");
+    const categorical = vega.scheme("category10");
+    const range = (spec.max - spec.min) || 1;
+    const color = (value, matname) => spec.matnames
+        ? categorical[matname % categorical.length]
+        : continuous((value - spec.min) / range);
+
+    // keys are "row,col" of tiles, values are the fetched tiles (or null while being fetched)
+    const tiles = new Map();
+    const fetchTile = (tileRow, tileCol) => {
+        const key = `${tileRow},${tileCol}`;
+        tiles.set(key, null);
+        fetch(`/matrix/tile/${spec.name}/${tileRow}/${tileCol}`)
+            .then(response => response.json())
+            .then(tile => {
+                if (tile.error) {
+                    title.textContent = tile.error;
+                    return;
+                }
+                tiles.set(key, {r: decodeArray(tile.r), c: decodeArray(tile.c), v: decodeArray(tile.v), m: tile.m && decodeArray(tile.m)});
+                requestAnimationFrame(draw);
+            });
+    }
+
+    const draw = () => {
+        context.clearRect(0, 0, canvas.width, canvas.height);
+
+        const lastRow = Math.min(rowCount, firstRow + Math.ceil((canvas.height - top) / cellSize));
+        const lastCol = Math.min(colCount, firstCol + Math.ceil((canvas.width - left) / cellSize));
+        const size = Math.max(cellSize, 1);
+
+        for (let tileRow = Math.floor(firstRow / tileSize); tileRow * tileSize < lastRow; tileRow++) {
+            for (let tileCol = Math.floor(firstCol / tileSize); tileCol * tileSize < lastCol; tileCol++) {
+                const key = `${tileRow},${tileCol}`;
+                if (!tiles.has(key)) {
+                    fetchTile(tileRow, tileCol);
+                    continue;
+                }
+
+                const tile = tiles.get(key);
+                if (tile === null)
+                    continue;
+                for (let k = 0; k < tile.v.length; k++) {
+                    context.fillStyle = color(tile.v[k], tile.m && tile.m[k]);
+                    context.fillRect(
+                        left + (tileCol * tileSize + tile.c[k] - firstCol) * cellSize,
+                        top + (tileRow * tileSize + tile.r[k] - firstRow) * cellSize,
+                        size, size
+                    );
+                }
+            }
+        }
+
+        // cover anything drawn over the labels, then label the rows and columns if they're big enough to read
+        context.clearRect(0, 0, left, canvas.height);
+        context.clearRect(0, 0, canvas.width, top);
+        if (cellSize >= 8) {
+            context.fillStyle = "black";
+            context.font = `${Math.min(cellSize - 2, 12)}px sans-serif`;
+            context.textAlign = "right";
+            context.textBaseline = "middle";
+            for (let row = firstRow; row < lastRow; row++)
+                context.fillText(spec.row_labels[row], left - 4, top + (row - firstRow + 0.5) * cellSize, left - 8);
+
+            context.textAlign = "left";
+            for (let col = firstCol; col < lastCol; col++) {
+                context.save();
+                context.translate(left + (col - firstCol + 0.5) * cellSize, top - 4);
+                context.rotate(-Math.PI / 4);
+                context.fillText(spec.col_labels[col], 0, 0, top * 1.3);
+                context.restore();
+            }
+        }
+    }
+
+    const cellAt = (event) => {
+        // the row and column under the mouse
+        const bounds = canvas.getBoundingClientRect();
+        return [
+            Math.floor(firstRow + (event.clientY - bounds.top - top) / cellSize),
+            Math.floor(firstCol + (event.clientX - bounds.left - left) / cellSize),
+        ];
+    }
+
+    const valueAt = (row, col) => {
+        const tile = tiles.get(`${Math.floor(row / tileSize)},${Math.floor(col / tileSize)}`);
+        if (!tile)
+            return undefined;
+        for (let k = 0; k < tile.v.length; k++)
+            if (tile.r[k] === row % tileSize && tile.c[k] === col % tileSize)
+                return [tile.v[k], tile.m && tile.m[k]];
+        return undefined;
+    }
+
+    // zoom in and out around the mouse
+    canvas.addEventListener("wheel", event => {
+        event.preventDefault();
+        const [row, col] = cellAt(event);
+        const newCellSize = Math.max(minCellSize, Math.min(cellSize * (event.deltaY < 0 ? 1.25 : 0.8), 40));
+        firstRow = Math.max(0, row - (row - firstRow) * cellSize / newCellSize);
+        firstCol = Math.max(0, col - (col - firstCol) * cellSize / newCellSize);
+        cellSize = newCellSize;
+        requestAnimationFrame(draw);
+    });
+
+    // pan by dragging, and show the cell under the mouse
+    let dragging = null;
+    canvas.addEventListener("mousedown", event => dragging = [event.clientX, event.clientY, firstRow, firstCol]);
+    window.addEventListener("mouseup", () => dragging = null);
+    canvas.addEventListener("mousemove", event => {
+        if (dragging) {
+            firstRow = Math.max(0, Math.min(rowCount - 1, dragging[2] - (event.clientY - dragging[1]) / cellSize));
+            firstCol = Math.max(0, Math.min(colCount - 1, dragging[3] - (event.clientX - dragging[0]) / cellSize));
+            requestAnimationFrame(draw);
+            return;
+        }
+
+        const [row, col] = cellAt(event);
+        const found = row >= 0 && col >= 0 && row < rowCount && col < colCount && valueAt(row, col);
+        if (!found) {
+            tooltip.style.display = "none";
+            return;
+        }
+        tooltip.innerHTML = `From: ${spec.row_labels[row]}<br>To: ${spec.col_labels[col]}<br>value: ${found[0]}`
+            + (spec.matnames ? `<br>matname: ${spec.matnames[found[1]]}` : "");
+        tooltip.style.display = "block";
+        tooltip.style.left = `${canvas.offsetLeft + event.offsetX + 12}px`;
+        tooltip.style.top = `${canvas.offsetTop + event.offsetY + 12}px`;
+    });
+
+    draw();
+}
+
+const renderPlotJSON = (spec, container = plotSection) => {
+    // draw a plot from /plot.json in the container
+    container.innerHTML = "";
+    if (spec.error) {
+        container.innerHTML = spec.error;
+        return;
+    }
+
+    // expensive plots are made as jobs, let htmx poll for them
+    if (spec.job) {
+        container.innerHTML = spec.job;
+        htmx.process(container);
+        return;
+    }
+
+    switch (spec.type) {
+        case "xy": renderXY(spec, container); break;
+        case "matrix": renderMatrix(spec, container); break;
+        case "tiled_matrix": createTiledMatrix(spec, container); break;
+        case "sankey": createSankey(spec.nodes, spec.links, spec.options, spec.title); break;
+    }
+}
+
+const fetchPlot = async (form, container = plotSection) => {
+    // get a plot for the query in a form from /plot.json and draw it
+    const response = await fetch("/plot.json", {method: "POST", body: new FormData(form)});
+    const spec = await response.json();
+    renderPlotJSON(spec, container);
+
+    // only plots drawn right away are in the history yet, jobs add theirs when done
+    if (!spec.error && !spec.job) {
+        refreshHistory();
+        if (new FormData(form).get("separate_window") === "on")
+            plotInNewWindow();
+    }
+}
+
+export {downloadSankey, createSankey, renderPlotJSON, fetchPlot};
\ No newline at end of file
@@ -12,6 +12,25 @@ const initialize = () => {
         error.detail.target.innerHTML = `Error creating plot! Status code ${error.detail.xhr.status}.\nPlease try again later. Contact information on the about page.`;
     });
 
+    // xy plots and matrices are drawn in the browser from /plot.json, sankeys still come from /plot
+    document.body.addEventListener("htmx:beforeRequest", (event) => {
+        if (event.detail.elt.id !== "get")
+            return;
+
+        const form = document.getElementById("query-form");
+        if (!["xy_plot", "matrices", "matrix_diff"].includes(new FormData(form).get("plot_type")))
+            return;
+
+        event.preventDefault();
+        const spinner = document.getElementById("plot-spinner");
+        spinner.classList.add("htmx-request");
+        window.fetchPlot(form)
+            .catch(() => {
+                document.getElementById("plot-section").innerHTML = `Error creating plot!\nPlease try again later. Contact information on the about page.`;
+            })
+            .finally(() => spinner.classList.remove("htmx-request"));
+    });
+
     document.getElementById("dataset-dropdown").addEventListener("change", (event) => {
         if (document.getElementById("dataset-dropdown").value.startsWith("sDB:")) {
             document.getElementById("sandbox-version-dropdown").hidden = false;
@@ -57,6 +76,17 @@ const initialize = () => {
     colorScale = document.getElementById("color-scale");
     menuInputs.push(colorScale);
 
+    // what a matrix difference compares against, and the input for each choice
+    compareBy = document.getElementById("compare-by");
+    menuInputs.push(compareBy);
+    compareInputs = {
+        year: document.getElementById("compare-year-input"),
+        version: document.getElementById("compare-version-dropdown"),
+        country: document.getElementById("compare-country-dropdown"),
+    };
+    menuInputs.push(...Object.values(compareInputs));
+    compareBy.addEventListener("change", showCompareInput);
+
     labelThreshold = document.getElementById("label-threshold");
     menuInputs.push(labelThreshold)
 
@@ -64,6 +94,7 @@ const initialize = () => {
     sankeyMenuInputs = [singleYearInput, labelThreshold];
     xyMenuInputs = [fromYearInput, toYearInput, efficiencyDropdown, colorBy, lineBy, facetColBy, facetRowBy];
     matrixMenuInputs = [fromYearInput, toYearInput, matnameDropdown, colorScale];
+    matrixDiffMenuInputs = [fromYearInput, toYearInput, matnameDropdown, compareBy];
 
     // have specifics show differently for different plots
     let selectedValue = null; // to be filled in the following loop
@@ -82,6 +113,9 @@ const initialize = () => {
 
         else if (plotTypeButton.value === "matrices")
             plotTypeButton.addEventListener('change', handleMatrices);
+
+        else if (plotTypeButton.value === "matrix_diff")
+            plotTypeButton.addEventListener('change', handleMatrixDiff);
     });
 
     // if there is an already selected plot, set up the query section accordingly
@@ -94,12 +128,57 @@ const initialize = () => {
     else if (selectedValue === "matrices")
         handleMatrices();
 
+    else if (selectedValue === "matrix_diff")
+        handleMatrixDiff();
+
     // if not, hide all specifics
     else {
         startMenuSwitch();
     }
+
+    // only offer options that have data for what else is picked
+    document.getElementById("query-form").addEventListener("change", narrowOptions);
+    narrowOptions();
 }
 
+/**
+ * Marks the form's options that have no data for the rest of the form.
+ * Options without data are disabled, and year inputs are limited to the years with data.
+ */
+const narrowOptions = async () => {
+    const form = document.getElementById("query-form");
+
+    let available;
+    try {
+        const response = await fetch("/available", { method: "POST", body: new FormData(form) });
+        if (!response.ok)
+            return;
+        available = await response.json();
+    } catch {
+        return; // options just aren't narrowed
+    }
+
+    for (const [field, values] of Object.entries(available)) {
+        if (field === "year") {
+            if (values.length === 0)
+                continue;
+            for (const yearInput of form.querySelectorAll('input[name="year"], input[name="to_year"]')) {
+                yearInput.min = values[0];
+                yearInput.max = values[values.length - 1];
+            }
+            continue;
+        }
+
+        const allowed = new Set(values);
+        // dropdown options and radio buttons/checkboxes alike
+        for (const option of form.querySelectorAll(`select[name="${field}"] option, input[name="${field}"]`)) {
+            option.classList.toggle("no-data", !allowed.has(option.value));
+            if (option.tagName === "OPTION")
+                option.disabled = !allowed.has(option.value);
+        }
+    }
+};
+
 /** Enables an input element and displays its container. */
 const inputOn = (element) => {
     element.disabled = false;
@@ -161,6 +240,27 @@ const handleMatrices = () => {
     inputRadioOn(coloringMethod)
 }
 
+// Configure UI for matrix differences
+const handleMatrixDiff = () => {
+    startMenuSwitch();
+    for (let item of matrixDiffMenuInputs)
+        inputOn(item);
+    showCompareInput();
+    inputRadioOff(coloringMethod)
+}
+
+/** Shows only the input for what a matrix difference compares against. */
+const showCompareInput = () => {
+    if (compareBy.disabled)
+        return;
+    for (const [by, input] of Object.entries(compareInputs)) {
+        if (by === compareBy.value)
+            inputOn(input);
+        else
+            inputOff(input);
+    }
+}
+
 /** Add a new dropdown for a specified category */
 const showDropdown = (name) => {
 
@@ -0,0 +1,226 @@
+####################################################################
+# availability.py contains the index of which queries have data
+#
+# Not every combination of dataset, version, country, year, etc.
+# has data, and finding that out from the database is a full round trip
+# just to answer "Error: No corresponding data".
+# Instead, every distinct combination of the metadata columns is loaded
+# once into an AvailabilityIndex, which answers
+#   does this query have any data? (see might_have_data(), used to skip
+#       going to the database for queries that certainly have no data)
+#   which values of a column are there data for, given the rest of a query?
+#       (see Translator.get_all_available(), used for narrowing the visualizer's options)
+#
+# The index is made of the distinct combinations of every metadata column
+# other than Year and matname. Which years and matrices each combination has
+# are held as bitsets (one bit per possible value), which keeps the index small.
+#
+# Since it ignores how year and matname go together (and any columns it
+# doesn't index), the index can say there is data when there isn't,
+# but never that there isn't data when there is.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import numpy as np
+from eviz.models import PSUT, AggEtaPFU
+from utils.logging import LOGGER
+from utils.filters import query_mask, split_key
+from utils.cache import VersionedBuilds
+from utils.data import DatabaseTarget, version_stamp, _valid_database
+from eviz_site.settings import RESULT_CACHE_VERSION_CHECK
+
+# the columns indexed for each model
+# values are the columns kept as distinct combinations and the columns kept as bitsets
+INDEXED_COLUMNS = {
+    PSUT: (
+        ["Dataset", "ValidFromVersion", "ValidToVersion", "Country", "Method", "EnergyType", "LastStage",
+         "IncludesNEU", "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation"],
+        ["Year", "matname"],
+    ),
+    AggEtaPFU: (
+        ["Dataset", "ValidFromVersion", "ValidToVersion", "Country", "Method", "EnergyType", "LastStage",
+         "IncludesNEU", "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation", "GrossNet"],
+        ["Year"],
+    ),
+}
+
+# powers of two for packing 64 booleans into a bitset word
+_BITS = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+class AvailabilityIndex:
+    '''The distinct combinations of a table's metadata columns'''
+
+    def __init__(self, combination_columns: list[str], bitset_columns: list[str], rows: np.ndarray):
+        '''
+        Inputs:
+            combination_columns: the columns kept as distinct combinations
+            bitset_columns: the columns kept as bitsets
+            rows: the distinct rows of the combination columns followed by the bitset columns
+        '''
+
+        n = len(combination_columns)
+        combinations, inverse = np.unique(rows[:, :n], axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # keys are columns, values are the column's value for each combination
+        self.columns = {col: combinations[:, k] for k, col in enumerate(combination_columns)}
+
+        # keys are columns, values are tuples of
+        # the value bit 0 stands for and a (combinations x words) array of bitsets
+        self.bitsets: dict[str, tuple[int, np.ndarray]] = {}
+        for k, col in enumerate(bitset_columns):
+            values = rows[:, n + k].astype(np.int64)
+            base = int(values.min()) if len(values) else 0
+            offsets = values - base
+            words = int(offsets.max()) // 64 + 1 if len(values) else 1
+
+            bits = np.zeros((len(combinations), words), dtype=np.uint64)
+            np.bitwise_or.at(bits, (inverse, offsets // 64), _BITS[offsets % 64])
+            self.bitsets[col] = (base, bits)
+
+        self.size = len(combinations)
+
+    def __allowed_bits(self, col: str, conditions: dict) -> np.ndarray:
+        # a bitset of the values of a bitset column the conditions allow
+        base, bits = self.bitsets[col]
+        values = np.arange(base, base + bits.shape[1] * 64)
+
+        allowed, _ = query_mask({col: values}, conditions, len(values))
+        return (allowed.reshape(-1, 64) * _BITS).sum(axis=1, dtype=np.uint64)
+
+    def mask(self, query: dict, ignore: str = None) -> np.ndarray:
+        '''Get which combinations a translated query matches
+
+        Inputs:
+            query: a translated query (see translate_query())
+            ignore: a column whose conditions are left out of the query, if any
+
+        Outputs:
+            a boolean array with an entry for each combination
+        '''
+
+        # columns that aren't indexed can only make a query match less, so leaving them out is safe
+        mask, _ = query_mask(self.columns, query, self.size, ignore = (ignore, *self.bitsets))
+
+        for col in self.bitsets:
+            conditions = {key: v for key, v in query.items() if split_key(key)[0] == col}
+            if col == ignore or not conditions:
+                continue
+            mask &= (self.bitsets[col][1] & self.__allowed_bits(col, conditions)).any(axis=1)
+
+        return mask
+
+    def any(self, query: dict) -> bool:
+        '''Whether a translated query might have any data'''
+
+        return bool(self.mask(query).any())
+
+    def values(self, col: str, query: dict) -> np.ndarray:
+        '''Get the values of a column that there is data for, given the rest of a query
+
+        Inputs:
+            col: the column to get values for
+            query: a translated query (see translate_query()), its conditions on col are ignored
+
+        Outputs:
+            a sorted array of the values
+        '''
+
+        mask = self.mask(query, ignore = col)
+
+        if col in self.bitsets:
+            base, bits = self.bitsets[col]
+            present = np.bitwise_or.reduce(bits[mask], axis=0) if mask.any() else np.zeros(bits.shape[1], dtype=np.uint64)
+            return base + np.flatnonzero((present[:, None] & _BITS) != 0)
+
+        return np.unique(self.columns[col][mask])
+
+    def versions(self, query: dict, version_ids) -> list[int]:
+        '''Get the versions there is data for, given the rest of a query
+
+        A version is matched the same way translate_query() matches one,
+        i.e. ValidFromVersion >= version and ValidToVersion <= version
+
+        Inputs:
+            query: a translated query (see translate_query()), its version conditions are ignored
+            version_ids: the IDs of every version
+
+        Outputs:
+            a list of the IDs of the versions with data
+        '''
+
+        query = {k: v for k, v in query.items() if not k.startswith(("ValidFromVersion", "ValidToVersion"))}
+        mask = self.mask(query)
+        valid_from = self.columns["ValidFromVersion"][mask]
+        valid_to = self.columns["ValidToVersion"][mask]
+
+        return [v for v in version_ids if ((valid_from >= v) & (valid_to <= v)).any()]
+
+def _build(target: DatabaseTarget) -> AvailabilityIndex:
+    combination_columns, bitset_columns = INDEXED_COLUMNS[target[1]]
+    LOGGER.info(f"Building availability index for {target[0]}:{target[1]._meta.db_table}")
+
+    rows = target[1].objects.using(target[0]).order_by().values_list(*combination_columns, *bitset_columns).distinct()
+    rows = np.array(list(rows), dtype=np.int32).reshape(-1, len(combination_columns) + len(bitset_columns))
+
+    return AvailabilityIndex(combination_columns, bitset_columns, rows)
+
+# the index of each (database, model), rebuilt when the database's versions change
+INDEXES = VersionedBuilds("availability index", _build, version_stamp, RESULT_CACHE_VERSION_CHECK)
+
+def get_availability(target: DatabaseTarget, wait: bool = True) -> AvailabilityIndex | None:
+    '''Get the availability index for a database target
+
+    The index is rebuilt when the database's versions change,
+    which is checked at most every RESULT_CACHE_VERSION_CHECK seconds.
+
+    Inputs:
+        target: the database target to get the index for
+        wait: whether to wait for the index to be built if it isn't ready,
+              otherwise it is built in the background
+
+    Outputs:
+        the index, or None if the target isn't indexed or the index isn't ready
+    '''
+
+    if target[1] not in INDEXED_COLUMNS or not _valid_database(target[0]):
+        return None
+
+    return INDEXES.get((target[0], target[1]), wait)
+
+# counters for how many queries the index has kept from going to the database
+AVAILABILITY_STATS = dict(ruled_out = 0, might_have_data = 0, not_ready = 0)
+
+def might_have_data(target: DatabaseTarget, query: dict) -> bool:
+    '''Whether a translated query might have any data
+
+    Never waits on the index being built, if it isn't ready the answer is True.
+
+    Inputs:
+        target: the database target of the query
+        query: a translated query (see translate_query())
+
+    Outputs:
+        False only if the query certainly has no data
+    '''
+
+    index = get_availability(target, wait = False)
+    if index is None:
+        AVAILABILITY_STATS["not_ready"] += 1
+        return True
+
+    if index.any(query):
+        AVAILABILITY_STATS["might_have_data"] += 1
+        return True
+
+    AVAILABILITY_STATS["ruled_out"] += 1
+    return False
+
+def warm_availability(databases: list[str]):
+    '''Build the availability indexes for some databases in the background'''
+
+    for database in databases:
+        for model in INDEXED_COLUMNS:
+            INDEXES.build_in_background((database, model))
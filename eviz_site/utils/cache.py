@@ -0,0 +1,294 @@
+####################################################################
+# cache.py contains the cache for query results
+#
+# The same queries get run over and over (everyone starts with the
+# default query on the visualizer page), so query results are kept
+# in memory as compact numpy columns and reused.
+#
+# Entries are keyed by a hash of everything that goes into a query
+# (see result_cache_key()) and evicted least recently used first once
+# the cache holds more than its budget of bytes.
+#
+# Since the data in the databases only changes when a new version is
+# published, the cache is cleared for a database when its versions change.
+#
+# Things built from whole tables (see VersionedBuilds) are likewise
+# rebuilt when their database's versions change.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import json
+import hashlib
+import numpy as np
+from time import monotonic
+from threading import Lock, Thread
+from collections import OrderedDict
+from django.db import connections
+from utils.logging import LOGGER
+
+def canonical_key(*parts) -> str:
+    '''Get a key that is the same for any two sets of equal parts
+
+    Inputs:
+        parts: JSON-able values, e.g. database names and translated queries
+
+    Outputs:
+        a string hash of the parts
+    '''
+
+    # order of values in lists (e.g. "__in" lookups) doesn't change what they mean
+    canonical = [
+        {k: sorted(v) if isinstance(v, (list, tuple, set)) else v for k, v in part.items()}
+        if isinstance(part, dict) else part
+        for part in parts
+    ]
+
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+def result_cache_key(database: str, table: str, query: dict, columns: list) -> str:
+    '''Get the canonical key for a query result
+
+    Inputs:
+        database: the name of the database the query is for
+        table: the name of the table the query is for
+        query: a translated query (see translate_query())
+        columns: the columns being selected
+
+    Outputs:
+        a string that is the same for any two queries that select the same data
+    '''
+
+    return canonical_key(database, table, query, list(columns))
+
+class ResultCache:
+    '''An LRU cache of query results with a limit on how many bytes it holds
+
+    Results are dictionaries of column names to numpy arrays.
+    The arrays are made read only when cached since they are shared
+    between everyone who gets them from the cache.
+    '''
+
+    def __init__(self, max_bytes: int, version_check: float):
+        '''
+        Inputs:
+            max_bytes: how many bytes of results can be held before evicting
+            version_check: how many seconds to wait between checking for new versions
+        '''
+
+        self.max_bytes = max_bytes
+        self.version_check = version_check
+
+        # keys are result keys
+        # values are tuples of the database the result is from, the result and its size in bytes
+        self.__entries: OrderedDict[str, tuple[str, dict[str, np.ndarray], int]] = OrderedDict()
+        self.__nbytes = 0
+        self.__lock = Lock()
+
+        # keys are database names
+        # values are tuples of when the versions were last checked and what they were
+        self.__versions: dict[str, tuple[float, object]] = {}
+
+        # counters for sizing the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> dict[str, np.ndarray] | None:
+        '''Get a cached result, or None if it isn't cached'''
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key: str) -> bool:
+        '''Whether a result is cached, without counting as a use of it'''
+
+        with self.__lock:
+            return key in self.__entries
+
+    def put(self, key: str, database: str, result: dict[str, np.ndarray]):
+        '''Cache a result, evicting the least recently used results if over budget'''
+
+        for col in result.values():
+            col.flags.writeable = False
+        nbytes = sum(col.nbytes for col in result.values())
+
+        # would never fit, don't throw out everything else trying
+        if nbytes > self.max_bytes:
+            return
+
+        with self.__lock:
+            if (old := self.__entries.pop(key, None)) is not None:
+                self.__nbytes -= old[2]
+
+            self.__entries[key] = (database, result, nbytes)
+            self.__nbytes += nbytes
+
+            while self.__nbytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self.__entries.popitem(last=False)
+                self.__nbytes -= evicted_bytes
+                self.evictions += 1
+
+    def revalidate(self, database: str, get_versions):
+        '''Clear a database's results if its versions changed
+
+        The versions are only actually checked every version_check seconds
+
+        Inputs:
+            database: the name of the database to check
+            get_versions: a function that gives something representing the current versions in the database
+        '''
+
+        checked = self.__versions.get(database)
+        if checked is not None and monotonic() - checked[0] < self.version_check:
+            return
+
+        versions = get_versions()
+        with self.__lock:
+            self.__versions[database] = (monotonic(), versions)
+
+        # first check, nothing can be stale yet
+        if checked is None or checked[1] == versions:
+            return
+
+        LOGGER.info(f"Versions changed in {database}, clearing its cached results")
+        self.clear(database)
+
+    def versions(self, database: str, get_versions):
+        '''Get what a database's versions were when last checked (see revalidate())
+
+        Inputs:
+            database: the name of the database
+            get_versions: a function that gives something representing the current versions in the database
+        '''
+
+        self.revalidate(database, get_versions)
+        return self.__versions[database][1]
+
+    def clear(self, database: str = None):
+        '''Drop all cached results, or just those of one database'''
+
+        with self.__lock:
+            for key in [k for k, entry in self.__entries.items() if database is None or entry[0] == database]:
+                self.__nbytes -= self.__entries.pop(key)[2]
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        '''Get the counters and size of the cache'''
+
+        with self.__lock:
+            return dict(
+                hits = self.hits,
+                misses = self.misses,
+                evictions = self.evictions,
+                invalidations = self.invalidations,
+                entries = len(self.__entries),
+                bytes = self.__nbytes,
+                max_bytes = self.max_bytes,
+            )
+
+class VersionedBuilds:
+    '''Things built from a database (e.g. indexes of a table) that are rebuilt when its versions change
+
+    Each thing is identified by a key whose first item is the name of the database it is built from.
+    Builds can be waited on, or left to happen in the background.
+    '''
+
+    def __init__(self, name: str, build, get_versions, version_check: float):
+        '''
+        Inputs:
+            name: what is being built, for logging
+            build: a function that builds the thing for a key
+            get_versions: a function that gives something representing the current versions in a database
+            version_check: how many seconds to wait between checking for new versions
+        '''
+
+        self.name = name
+        self.__build = build
+        self.__get_versions = get_versions
+        self.version_check = version_check
+
+        # keys are keys
+        # values are tuples of when the versions were last checked, what they were and the thing built
+        self.__built: dict[tuple, tuple[float, object, object]] = {}
+        self.__lock = Lock()
+        # keys are keys, held while building the thing for that key
+        self.__build_locks: dict[tuple, Lock] = {}
+        # keys being built in the background
+        self.__building: set[tuple] = set()
+
+    def __build_and_store(self, key: tuple):
+        with self.__lock:
+            build_lock = self.__build_locks.setdefault(key, Lock())
+
+        with build_lock:
+            # someone else may have built it while we waited for the lock
+            entry = self.__built.get(key)
+            if entry is not None and monotonic() - entry[0] < self.version_check:
+                return entry[2]
+
+            versions = self.__get_versions(key[0])
+            built = self.__build(key)
+            self.__built[key] = (monotonic(), versions, built)
+            return built
+
+    def build_in_background(self, key: tuple):
+        '''Build the thing for a key in a background thread, unless it is already being built'''
+
+        with self.__lock:
+            if key in self.__building:
+                return
+            self.__building.add(key)
+
+        def build():
+            try:
+                self.__build_and_store(key)
+            except Exception as e:
+                LOGGER.error(f"Couldn't build {self.name} for {key[0]}: {e}")
+                # don't try again until the next version check
+                self.__built[key] = (monotonic(), None, None)
+            finally:
+                # this thread is done with its connection
+                connections[key[0]].close()
+                with self.__lock:
+                    self.__building.discard(key)
+
+        Thread(target=build, name=f"eviz-{self.name.replace(' ', '-')}", daemon=True).start()
+
+    def get(self, key: tuple, wait: bool = True):
+        '''Get the thing built for a key
+
+        Inputs:
+            key: the key of the thing, its first item the name of the database it is built from
+            wait: whether to wait for the thing to be built if it isn't ready (or is out of date),
+                  otherwise it is built in the background
+
+        Outputs:
+            the thing, or None if it isn't ready and wait is False
+        '''
+
+        entry = self.__built.get(key)
+        if entry is not None:
+            checked, versions, built = entry
+            if monotonic() - checked < self.version_check:
+                return built
+
+            if self.__get_versions(key[0]) == versions:
+                self.__built[key] = (monotonic(), versions, built)
+                return built
+
+        if wait:
+            return self.__build_and_store(key)
+
+        self.build_in_background(key)
+        return None
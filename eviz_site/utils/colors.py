@@ -0,0 +1,134 @@
+####################################################################
+# colors.py contains the color palettes for energy carriers
+#
+# A palette turns the name of an energy carrier (an Index name)
+# into the color used for it in plots, e.g. Sankey nodes and flows.
+#
+# Category palettes give a carrier the color of the first category
+# (in file order) whose name is in the carrier's name,
+# e.g. "Coking coal" -> "coal" -> "dimgray".
+# Every category is compiled into one regular expression when the
+# palette is made, so a name is matched against all of them in one go.
+#
+# List palettes give each carrier listed in a file its own color.
+# The list files hold no colors, so the colors are made up: each listed
+# carrier gets the next color of plotly's Alphabet cycle, in file order.
+# They tell carriers apart, but don't mean anything (e.g. coals aren't gray).
+# Carriers that aren't listed get no color, the same as carriers no
+# category matches in a category palette (their nodes are drawn red).
+#
+# The Index table doesn't change, so colors are remembered
+# once they have been figured out.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import re
+import json
+from threading import Lock
+from plotly.colors import qualitative
+from utils.logging import LOGGER
+from eviz_site.settings import SANKEY_PALETTES, SANKEY_DEFAULT_PALETTE
+
+class Palette:
+    '''A mapping of energy carrier names to colors'''
+
+    def __init__(self, name: str, categories: dict[str, str] = None, carriers: list[str] = None):
+        '''
+        Inputs:
+            name: the name of the palette, for logging
+            categories: a dictionary of category to color, for a category palette
+            carriers: a list of carrier names, for a list palette
+        '''
+
+        self.name = name
+
+        if categories is not None:
+            self.__colors = list(categories.values())
+            # one lookahead per category, tried in order from the start of the name,
+            # so the group that matches is the first category in the name
+            self.__matcher = re.compile(
+                "^(?:" + "|".join(f"(?=.*?({re.escape(category.lower())}))" for category in categories) + ")",
+                re.DOTALL
+            )
+            self.__exact = None
+        else:
+            # made up colors, see the top of this file
+            cycle = qualitative.Alphabet
+            self.__exact = {carrier: cycle[k % len(cycle)] for k, carrier in enumerate(carriers)}
+            self.__matcher = None
+
+        # remembered colors, keys are carrier names
+        self.__by_name: dict[str, str | None] = {}
+        # remembered colors, keys are (database, Index ID)
+        self.__by_index: dict[tuple[str, int], str | None] = {}
+        self.__lock = Lock()
+
+    def color(self, name: str) -> str | None:
+        '''Get the color for an energy carrier, or None if the palette has no color for it'''
+
+        try:
+            return self.__by_name[name]
+        except KeyError:
+            pass
+
+        if self.__exact is not None:
+            color = self.__exact.get(name)
+        elif match := self.__matcher.match(name.lower()):
+            color = self.__colors[match.lastindex - 1]
+        else:
+            color = None
+
+        # only log once per name, not on every use
+        if color is None:
+            LOGGER.error(f"Couldn't find {self.name} color for " + name)
+
+        with self.__lock:
+            self.__by_name[name] = color
+        return color
+
+    def index_colors(self, database: str, ids: list[int], names: list[str]) -> list[str | None]:
+        '''Get the colors for many Index entries
+
+        Inputs:
+            database: the database the Index entries are from
+            ids: the Index IDs
+            names: the Index names for each ID
+
+        Outputs:
+            a list of the colors for each ID (None where the palette has no color)
+        '''
+
+        colors = []
+        for index_id, name in zip(ids, names):
+            key = (database, index_id)
+            if (color := self.__by_index.get(key, -1)) == -1:
+                color = self.color(name)
+                with self.__lock:
+                    self.__by_index[key] = color
+            colors.append(color)
+
+        return colors
+
+def _load_palette(name: str, path) -> Palette:
+    with open(path) as f:
+        contents = json.loads(f.read())
+
+    if isinstance(contents, dict):
+        return Palette(name, categories=contents)
+    return Palette(name, carriers=contents)
+
+# every palette, compiled once
+PALETTES: dict[str, Palette] = {name: _load_palette(name, path) for name, path in SANKEY_PALETTES.items()}
+
+def get_palette(name: str = None) -> Palette:
+    '''Get a palette by name, or the default palette if no name is given'''
+
+    if name is None:
+        name = SANKEY_DEFAULT_PALETTE
+
+    if name not in PALETTES:
+        raise ValueError(f"Unknown palette: {name}")
+
+    return PALETTES[name]
@@ -0,0 +1,82 @@
+####################################################################
+# concurrency.py contains the helpers for running work off of the event loop
+#
+# The async views (see eviz/views/visualizer.py) hand their blocking work
+# to these so that one process can have many requests in flight:
+#   database work goes to a bounded pool of database threads
+#   CPU heavy rendering (plotly, altair) goes to a pool of render threads
+#
+# The database pool is kept no bigger than the connection pools
+# (see DATABASES in eviz_site/settings.py) so threads don't sit waiting on connections.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from eviz_site.settings import PLOT_DB_THREADS, PLOT_RENDER_THREADS
+
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=PLOT_DB_THREADS, thread_name_prefix="eviz-db")
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=PLOT_RENDER_THREADS, thread_name_prefix="eviz-render")
+
+def _closing_connections(func, *args):
+    # database threads live on between requests,
+    # so give their connections back to the pool once the work is done
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+async def run_in_db_thread(func, *args):
+    '''Run a function that uses the database on a database thread
+
+    Inputs:
+        func: the function to run
+        args: the arguments to give the function
+
+    Outputs:
+        what the function returns
+    '''
+
+    return await sync_to_async(_closing_connections, thread_sensitive=False, executor=DB_EXECUTOR)(func, *args)
+
+async def run_in_render_thread(func, *args):
+    '''Run a CPU heavy function that doesn't use the database on a render thread
+
+    Inputs:
+        func: the function to run
+        args: the arguments to give the function
+
+    Outputs:
+        what the function returns
+    '''
+
+    return await asyncio.get_running_loop().run_in_executor(RENDER_EXECUTOR, partial(func, *args))
+
+async def iterate_in_thread(iterator):
+    '''Turn a blocking iterator into an async one
+
+    Every item is made on the current request's thread (the same one each time),
+    so iterators holding things tied to a thread, like database cursors, keep working.
+
+    Inputs:
+        iterator: the iterator to go through
+
+    Outputs:
+        an async generator of the iterator's items
+    '''
+
+    done = object()
+    get_next = sync_to_async(next, thread_sensitive=True)
+
+    try:
+        while (item := await get_next(iterator, done)) is not done:
+            yield item
+    finally:
+        # let the iterator clean up (e.g. close its cursor) if the client goes away early
+        if hasattr(iterator, "close"):
+            await sync_to_async(iterator.close, thread_sensitive=True)()
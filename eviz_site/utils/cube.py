@@ -0,0 +1,193 @@
+####################################################################
+# cube.py contains the in-memory cube of efficiency data for xy plots
+#
+# The AggEtaPFU table (what xy plots are made from) is small enough
+# to keep in memory, so the whole table is kept as a cube:
+#   one axis is every distinct combination of the metadata columns
+#   (dataset, version, country, method, energy type, last stage, ...)
+#   the other axis is every year
+# with a dense array for each of EXp, EXf, EXu, etapf, etafu and etapu.
+#
+# An xy query is then a mask over the combinations and a slice of years,
+# so changing the efficiency metric or adding a country never goes
+# to the database. The cube is rebuilt when a new version is published.
+#
+# The cube is built by one process on the host and kept in the shared
+# store (see shared.py), so every process maps the same copy of it.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import numpy as np
+from eviz.models import AggEtaPFU
+from utils.logging import LOGGER
+from utils.filters import query_mask, split_key
+from utils.cache import VersionedBuilds
+from utils.shared import SHARED
+from utils.data import DatabaseTarget, version_stamp, _fetch_columns_from_database
+from eviz_site.settings import RESULT_CACHE_VERSION_CHECK
+
+# the columns that make up the combinations axis
+COMBINATION_COLUMNS = [
+    "Dataset", "ValidFromVersion", "ValidToVersion", "Country", "Method", "EnergyType", "LastStage",
+    "IncludesNEU", "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation", "GrossNet",
+]
+# the columns held as dense arrays
+VALUE_COLUMNS = ["EXp", "EXf", "EXu", "etapf", "etafu", "etapu"]
+
+class EfficiencyCube:
+    '''The AggEtaPFU table as dense (combination x year) arrays'''
+
+    def __init__(self, columns: dict[str, np.ndarray], years: np.ndarray, present: np.ndarray, values: dict[str, np.ndarray]):
+        '''
+        Inputs:
+            columns: column name to the column's value for each combination
+            years: every year, in order
+            present: which (combination, year) cells have a row
+            values: value column name to its (combination x year) array
+        '''
+
+        self.columns = columns
+        self.size = len(present)
+        self.years = years
+        self.present = present
+        self.values = values
+
+    @classmethod
+    def from_table(cls, data: dict[str, np.ndarray]) -> "EfficiencyCube":
+        '''Build a cube from every row of the table, column name to numpy array'''
+
+        combinations, inverse = np.unique(
+            np.column_stack([data[col] for col in COMBINATION_COLUMNS]), axis=0, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+
+        columns = {col: combinations[:, k].astype(data[col].dtype) for k, col in enumerate(COMBINATION_COLUMNS)}
+
+        years = data["Year"]
+        first_year = int(years.min()) if len(years) else 0
+        all_years = np.arange(first_year, int(years.max()) + 1 if len(years) else 0).astype(years.dtype)
+        year_index = (years - first_year).astype(np.int64)
+
+        present = np.zeros((len(combinations), len(all_years)), dtype=bool)
+        present[inverse, year_index] = True
+
+        # the cube can only stand in for the table if no two rows share a cell
+        if present.sum() != len(years):
+            raise ValueError("Rows share a combination and year, so the table can't be held as a cube")
+
+        values = {}
+        for col in VALUE_COLUMNS:
+            values[col] = np.full(present.shape, np.nan, dtype=data[col].dtype)
+            values[col][inverse, year_index] = data[col]
+
+        return cls(columns, all_years, present, values)
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        '''Get every array of the cube by name, see from_arrays()'''
+
+        arrays = {"years": self.years, "present": self.present}
+        arrays.update({f"column.{col}": values for col, values in self.columns.items()})
+        arrays.update({f"value.{col}": values for col, values in self.values.items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "EfficiencyCube":
+        '''Make a cube from its arrays, see arrays()'''
+
+        return cls(
+            {col: arrays[f"column.{col}"] for col in COMBINATION_COLUMNS},
+            arrays["years"], arrays["present"],
+            {col: arrays[f"value.{col}"] for col in VALUE_COLUMNS},
+        )
+
+    def fetch(self, query: dict, columns: list) -> dict[str, np.ndarray] | None:
+        '''Get the data for a query from the cube, in order of year
+
+        Inputs:
+            query: a translated query (see translate_query())
+            columns: the columns to get
+
+        Outputs:
+            a dictionary of column name to (read only) numpy array
+            or None if the query can't be answered from the cube
+        '''
+
+        if any(col not in self.columns and col not in self.values and col != "Year" for col in columns):
+            return None
+
+        year_query = {key: v for key, v in query.items() if split_key(key)[0] == "Year"}
+        combinations, unhandled = query_mask(self.columns, query, self.size, ignore = ("Year",))
+        years, year_unhandled = query_mask({"Year": self.years}, year_query, len(self.years))
+        if unhandled or year_unhandled:
+            return None
+
+        combinations = np.flatnonzero(combinations)
+        years = np.flatnonzero(years)
+
+        # cells with data, by year then combination
+        year_pos, combination_pos = np.nonzero(self.present[np.ix_(combinations, years)].T)
+        rows = combinations[combination_pos]
+        cols = years[year_pos]
+
+        data = {}
+        for col in columns:
+            if col == "Year":
+                data[col] = self.years[cols]
+            elif col in self.values:
+                data[col] = self.values[col][rows, cols]
+            else:
+                data[col] = self.columns[col][rows]
+            data[col].flags.writeable = False
+
+        return data
+
+    def nbytes(self) -> int:
+        return self.present.nbytes + sum(values.nbytes for values in self.values.values())
+
+def _build(key: tuple[str]) -> EfficiencyCube:
+    database = key[0]
+    versions = list(version_stamp(database))
+
+    def build():
+        LOGGER.info(f"Building efficiency cube for {database}")
+        data = _fetch_columns_from_database((database, AggEtaPFU), {}, COMBINATION_COLUMNS + ["Year"] + VALUE_COLUMNS)
+        return {"versions": versions}, EfficiencyCube.from_table(data).arrays()
+
+    # one process on the host builds the cube, every process maps the same copy
+    _, arrays = SHARED.load(f"cube-{database}", lambda meta: meta.get("versions") == versions, build)
+    cube = EfficiencyCube.from_arrays(arrays)
+
+    LOGGER.info(f"Loaded efficiency cube for {database}: {cube.size} combinations, {cube.nbytes() / 1e6:.1f} MB")
+    return cube
+
+# the cube of each database, rebuilt when the database's versions change
+CUBES = VersionedBuilds("efficiency cube", _build, version_stamp, RESULT_CACHE_VERSION_CHECK)
+
+def fetch_from_cube(target: DatabaseTarget, query: dict, columns: list) -> dict[str, np.ndarray] | None:
+    '''Get the data for a query from the efficiency cube
+
+    Never waits on the cube being built, if it isn't ready the query should go to the database.
+
+    Inputs:
+        target: the database target of the query
+        query: a translated query (see translate_query())
+        columns: the columns to get
+
+    Outputs:
+        a dictionary of column name to (read only) numpy array, in order of year
+        or None if the query can't be answered from the cube
+    '''
+
+    if target[1] is not AggEtaPFU:
+        return None
+
+    cube = CUBES.get((target[0],), wait = False)
+    return None if cube is None else cube.fetch(query, columns)
+
+def warm_cubes(databases: list[str]):
+    '''Build the efficiency cubes for some databases in the background'''
+
+    for database in databases:
+        CUBES.build_in_background((database,))
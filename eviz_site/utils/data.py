@@ -24,13 +24,18 @@
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
-from eviz.models import models, PSUT, IEAData, AggEtaPFU
+from eviz.models import models, PSUT, IEAData, AggEtaPFU, Version
+import io
+import json
+import numpy as np
 import pandas as pd
-from utils.misc import Silent
-import pandas.io.sql as pd_sql  # for getting data into a pandas dataframe
 from django.db import connections
+from django.db.models import Count, Max
+from django.core.exceptions import FieldDoesNotExist
 from utils.translator import Translator
-from eviz_site.settings import DATABASES, SANDBOX_PREFIX
+from utils.cache import ResultCache, result_cache_key
+from utils.partitions import PartitionStore
+from eviz_site.settings import DATABASES, SANDBOX_PREFIX, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_VERSION_CHECK, PARTITION_DIR
 
 DatabaseTarget = tuple[str, models.Model]
 
@@ -45,85 +50,369 @@ def _get_database_target(query: dict) -> DatabaseTarget:
     
     return "sandbox" if dataset.startswith(SANDBOX_PREFIX) else "default", model
 
-def _query_database(target: DatabaseTarget, query: dict, values: list[str]):
+def _query_database(target: DatabaseTarget, query: dict, values: list[str]) -> list[tuple]:
     db = target[0]
-    model = target[1]
 
     if not _valid_database(db):
         raise ValueError("Unknown database specified for query")
 
-    data = (
-        model.objects
-        .using(db)
-        .values_list(*values)
-        .filter(**query)
-    )
+    data = _fetch_columns(target, query, values)
+
+    # back into rows of plain Python values
+    return list(zip(*(data[value].tolist() for value in values)))
+
+def _query_database_arrays(target: DatabaseTarget, query: dict, values: list[str]) -> dict[str, np.ndarray] | None:
+    '''Get the data for a query as columns instead of rows
+
+    Inputs:
+        target: the database target to query
+        query: a query ready to hit the database, i.e. translated as neccessary (see translate_query())
+        values: the columns to get
+
+    Outputs:
+        a dictionary of column name to (read only) numpy array
+        or None if there is no data for the query
+    '''
+
+    if not _valid_database(target[0]):
+        raise ValueError("Unknown database specified for query")
+
+    data = _fetch_columns(target, query, values)
+
+    if len(data[values[0]]) == 0:
+        return None
 
     return data
 
 def _valid_database(database_name: str):
     return database_name in DATABASES.keys()
 
+# how many rows to pull from a server-side cursor at a time
+# when the binary COPY path can't be used
+FETCH_CHUNK_SIZE = 50_000
+
+# how each type of database field is fetched in a binary COPY
+# keys are Django field types
+# values are the Postgres type to cast the column to and the numpy type to decode it as
+# (binary COPY is in network byte order, so the numpy types are big-endian)
+_BINARY_TYPES = {
+    "PositiveSmallIntegerField": ("int2", ">i2"),
+    "SmallIntegerField": ("int2", ">i2"),
+    "IntegerField": ("int4", ">i4"),
+    "BooleanField": ("bool", "?"),
+    "FloatField": ("float8", ">f8"),
+}
+
+# binary COPY output starts with an 11 byte signature, a 4 byte flags field
+# and a 4 byte header extension length (followed by the extension itself)
+# it ends with a 2 byte trailer
+_COPY_HEADER_SIZE = 19
+_COPY_TRAILER_SIZE = 2
+
+def _binary_types(model: models.Model, columns: list) -> list[tuple[str, str]] | None:
+    '''Get the (Postgres type, numpy type) pairs to fetch each column with
+
+    Outputs:
+        a list of type pairs in the same order as columns
+        or None if any of the columns can't be fetched as a fixed width type
+    '''
+
+    try:
+        types = [_BINARY_TYPES.get(model._meta.get_field(col).get_internal_type()) for col in columns]
+    except FieldDoesNotExist:
+        return None
+
+    return None if None in types else types
+
+def _copy_to(cursor, sql: str, buffer: io.BytesIO):
+    # psycopg2 and psycopg 3 have different COPY interfaces
+    if hasattr(cursor, "copy_expert"):
+        cursor.copy_expert(sql, buffer)
+    else:
+        with cursor.copy(sql) as copy:
+            for block in copy:
+                buffer.write(block)
+
+def _decode_binary_copy(data: memoryview, columns: list, types: list[tuple[str, str]]) -> dict[str, np.ndarray] | None:
+    '''Decode the output of a binary COPY straight into numpy columns
+
+    Every tuple in a binary COPY is a 2 byte field count followed by,
+    for each field, a 4 byte length and then the field's bytes.
+    When every field is fixed width and not null, every tuple is the same size
+    so the whole body can be viewed as one numpy structured array.
+
+    Outputs:
+        a dictionary of column name to numpy array (in native byte order)
+        or None if the data has nulls in it and can't be decoded this way
+    '''
+
+    header_extension = int.from_bytes(data[15:_COPY_HEADER_SIZE], "big")
+    body = data[_COPY_HEADER_SIZE + header_extension : len(data) - _COPY_TRAILER_SIZE]
+
+    # layout of a single tuple
+    fields = [("nfields", ">i2")]
+    for k, (col, (_, np_type)) in enumerate(zip(columns, types)):
+        fields += [(f"length{k}", ">i4"), (col, np_type)]
+    row_type = np.dtype(fields)
+
+    # nulls are written with no bytes, so the tuples won't line up
+    if len(body) % row_type.itemsize != 0:
+        return None
+
+    rows = np.frombuffer(body, dtype=row_type)
+    for k, (col, (_, np_type)) in enumerate(zip(columns, types)):
+        if (rows[f"length{k}"] != np.dtype(np_type).itemsize).any():
+            return None
+
+    return {col: rows[col].astype(np.dtype(np_type).newbyteorder("=")) for col, (_, np_type) in zip(columns, types)}
+
+def _fetch_binary(target: DatabaseTarget, query: dict, columns: list) -> dict[str, np.ndarray] | None:
+    '''Get the data for a query with a binary COPY
+
+    Outputs:
+        a dictionary of column name to numpy array
+        or None if the columns can't be fetched this way
+    '''
+
+    types = _binary_types(target[1], columns)
+    if types is None:
+        return None
+
+    connection = connections[target[0]]
+    sql, params = target[1].objects.using(target[0]).filter(**query).values(*columns).query.sql_with_params()
+
+    # cast every column to a fixed width type so each tuple has the same layout
+    select = ", ".join(f"sub.{connection.ops.quote_name(col)}::{pg_type}" for col, (pg_type, _) in zip(columns, types))
+    copy_sql = f"COPY (SELECT {select} FROM ({connection.ops.compose_sql(sql, params)}) AS sub) TO STDOUT (FORMAT binary)"
+
+    buffer = io.BytesIO()
+    with connection.cursor() as cursor:
+        _copy_to(cursor, copy_sql, buffer)
+
+    return _decode_binary_copy(buffer.getbuffer(), columns, types)
+
+def _records_to_columns(rows: list[tuple], columns: list, types: list[tuple[str, str]] | None) -> dict[str, np.ndarray]:
+    # fast path, let numpy build all the columns at once
+    if types is not None:
+        try:
+            records = np.array(rows, dtype=[(col, np.dtype(np_type).newbyteorder("=")) for col, (_, np_type) in zip(columns, types)])
+            return {col: np.ascontiguousarray(records[col]) for col in columns}
+        except (TypeError, ValueError):
+            pass # nulls in the data, let numpy figure out the types
+
+    return {col: np.array([row[k] for row in rows]) for k, col in enumerate(columns)}
+
+def _iter_column_chunks(target: DatabaseTarget, query: dict, columns: list, chunk_size: int = FETCH_CHUNK_SIZE):
+    '''Get the data for a query in chunks from a server-side cursor
+
+    Outputs:
+        a generator of dictionaries of column name to numpy array,
+        each holding at most chunk_size rows
+    '''
+
+    types = _binary_types(target[1], columns)
+    sql, params = target[1].objects.using(target[0]).filter(**query).values(*columns).query.sql_with_params()
+
+    with connections[target[0]].chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while rows := cursor.fetchmany(chunk_size):
+            yield _records_to_columns(rows, columns, types)
+
+def _fetch_columns_from_database(target: DatabaseTarget, query: dict, columns: list) -> dict[str, np.ndarray]:
+    '''Get the data for a query from the database as typed numpy columns
+
+    ID columns come back as int16 and values as float64,
+    without building a Python object for every value along the way.
+
+    Outputs:
+        a dictionary of column name to numpy array
+    '''
+
+    if (data := _fetch_binary(target, query, columns)) is not None:
+        return data
+
+    # couldn't use a binary COPY, so build the columns up a chunk at a time
+    chunks = list(_iter_column_chunks(target, query, columns))
+    if not chunks:
+        return {col: np.array([]) for col in columns}
+
+    return {col: np.concatenate([chunk[col] for chunk in chunks]) for col in columns}
+
+# results of queries, shared by everyone in this process
+RESULT_CACHE = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_VERSION_CHECK)
+
+# slices of tables kept on local disk, if set up
+PARTITIONS = PartitionStore(PARTITION_DIR) if PARTITION_DIR else None
+
+def version_stamp(database: str) -> tuple:
+    # a new Version row changes the count and (almost always) the latest ID
+    return tuple(Version.objects.using(database).aggregate(count = Count("VersionID"), latest = Max("VersionID")).values())
+
+def current_versions(database: str) -> tuple:
+    '''Get the version stamp of a database, only checked against the database every RESULT_CACHE_VERSION_CHECK seconds'''
+
+    return RESULT_CACHE.versions(database, lambda: version_stamp(database))
+
+def _fetch_columns(target: DatabaseTarget, query: dict, columns: list) -> dict[str, np.ndarray]:
+    '''Get the data for a query as typed numpy columns, using cached results when possible
+
+    The arrays given back are read only, since cached results are shared.
+
+    Outputs:
+        a dictionary of column name to numpy array
+    '''
+
+    # imported here since they get their data through this module
+    from utils.availability import might_have_data
+    from utils.cube import fetch_from_cube
+
+    RESULT_CACHE.revalidate(target[0], lambda: version_stamp(target[0]))
+
+    # xy data is held in memory
+    if (data := fetch_from_cube(target, query, columns)) is not None:
+        return data
+
+    key = result_cache_key(target[0], target[1]._meta.db_table, query, columns)
+    if (data := RESULT_CACHE.get(key)) is not None:
+        return data
+
+    # queries that certainly have no data don't need to go to the database
+    if not might_have_data(target, query):
+        return _records_to_columns([], columns, _binary_types(target[1], columns))
+
+    # hot slices may be kept locally, those are already quick to read so aren't cached
+    if PARTITIONS is not None and (data := PARTITIONS.fetch(target, query, columns)) is not None:
+        return data
+
+    data = _fetch_columns_from_database(target, query, columns)
+    RESULT_CACHE.put(key, target[0], data)
+
+    return data
+
+def is_cached(target: DatabaseTarget, query: dict, columns: list) -> bool:
+    '''Whether the data for a query would come from memory (the efficiency cube or the result cache)
+    instead of the database (see _fetch_columns())
+
+    Inputs:
+        target: the database target of the query
+        query: a translated query (see translate_query())
+        columns: the columns to get
+    '''
+
+    # imported here since it gets its data through this module
+    from utils.cube import fetch_from_cube
+
+    if fetch_from_cube(target, query, columns) is not None:
+        return True
+
+    return RESULT_CACHE.contains(result_cache_key(target[0], target[1]._meta.db_table, query, columns))
+
+def estimate_rows(target: DatabaseTarget, query: dict) -> int:
+    '''Get the planner's estimate of how many rows a query selects, without running it
+
+    Inputs:
+        target: the database target of the query
+        query: a query ready to hit the database, i.e. translated as neccessary (see translate_query())
+
+    Outputs:
+        the estimated number of rows
+    '''
+
+    if not _valid_database(target[0]):
+        raise ValueError("Unknown database specified for query")
+
+    plan = json.loads(target[1].objects.using(target[0]).filter(**query).explain(format = "json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
+
 def get_dataframe(target: DatabaseTarget, query: dict, columns: list) -> pd.DataFrame:
     if not _valid_database(target[0]):
         return pd.DataFrame() # empty data frame if database is wrong
-    
-    # get the data from database
-    db_query = target[1].objects.filter(**query).values(*columns).query
-    with Silent():
-        df = pd_sql.read_sql_query(
-            str(db_query),
-            con=connections[target[0]].cursor().connection # get the connection associated with the requested database
-        )
 
-    return df
+    # get the data from database
+    return pd.DataFrame(_fetch_columns(target, query, columns), columns=columns)
 
 META_COLUMNS = ["Dataset", "ValidFromVersion", "ValidToVersion", "Country", "Method", "EnergyType", "LastStage", "IncludesNEU", "Year", "ChoppedMat", "ChoppedVar", "ProductAggregation", "IndustryAggregation"]
 PSUT_COLUMNS = ["matname", "i", "j", "value"]
 AGGETA_COLUMNS = ["GrossNet", "EXp", "EXf", "EXu", "etapf", "etafu", "etapu"]
-def get_translated_dataframe(target: DatabaseTarget, query: dict, columns: list) -> pd.DataFrame:
-    df = get_dataframe(target, query, columns)
-
-    # no need to do work if dataframe is empty (no data was found for the query)
-    if df.empty: return df
-
-    translator = Translator(target[0]) # get a translator for the correct database
-    
-    # Translate the DataFrame's column names
+def _translate_dataframe(df: pd.DataFrame, translator: Translator) -> pd.DataFrame:
+    # Which translation table to use for each of the DataFrame's columns
     translate_columns = {
-        'Dataset': translator.dataset_translate,
-        'ValidFromVersion': translator.version_translate,
-        'ValidToVersion': translator.version_translate,
-        'Country': translator.country_translate,
-        'Method': translator.method_translate,
-        'EnergyType': translator.energytype_translate,
-        'LastStage': translator.laststage_translate,
-        'ChoppedMat': translator.matname_translate,
-        'ChoppedVar': translator.index_translate,
-        'ProductAggregation': translator.agglevel_translate,
-        'IndustryAggregation': translator.agglevel_translate,
-        'matname': translator.matname_translate,
-        'grossnet': translator.grossnet_translate,
-        'i': translator.index_translate,
-        'j': translator.index_translate
+        'Dataset': 'dataset',
+        'ValidFromVersion': 'version',
+        'ValidToVersion': 'version',
+        'Country': 'country',
+        'Method': 'method',
+        'EnergyType': 'energytype',
+        'LastStage': 'laststage',
+        'ChoppedMat': 'matname',
+        'ChoppedVar': 'index',
+        'ProductAggregation': 'agglevel',
+        'IndustryAggregation': 'agglevel',
+        'matname': 'matname',
+        'grossnet': 'grossnet',
+        'i': 'index',
+        'j': 'index'
     }
 
-    # Apply the translation functions to each column if it exists in the DataFrame
-    for col, translate_func in translate_columns.items():
+    # Decode each column that exists in the DataFrame in one go
+    # the columns stay categorical, so each name is only stored once
+    for col, attribute in translate_columns.items():
         if col in df.columns:
-            df[col] = df[col].apply(translate_func)
+            df[col] = translator.decode(attribute, df[col].to_numpy())
     
     # Handle IncludesNEU separately as it's a boolean
     if 'IncludesNEU' in df.columns:
-        df['IncludesNEU'] = df['IncludesNEU'].apply(lambda x: 'Yes' if x else 'No')
+        df['IncludesNEU'] = pd.Categorical.from_codes(
+            df['IncludesNEU'].to_numpy().astype(bool).astype(np.int8), categories=['No', 'Yes'])
     
     return df
 
+def get_translated_dataframe(target: DatabaseTarget, query: dict, columns: list) -> pd.DataFrame:
+    df = get_dataframe(target, query, columns)
+
+    # no need to do work if dataframe is empty (no data was found for the query)
+    if df.empty: return df
+
+    translator = Translator(target[0]) # get a translator for the correct database
+
+    return _translate_dataframe(df, translator)
+
+def iter_translated_dataframes(target: DatabaseTarget, query: dict, columns: list, chunk_size: int = FETCH_CHUNK_SIZE):
+    '''Get the translated data for a query a chunk at a time
+
+    Only one chunk is held in memory at once, so this can be used for
+    queries whose results are too big to hold all at once.
+
+    Outputs:
+        a generator of translated DataFrames, each with at most chunk_size rows
+    '''
+
+    if not _valid_database(target[0]):
+        return
+
+    translator = Translator(target[0]) # get a translator for the correct database
+
+    for chunk in _iter_column_chunks(target, query, columns, chunk_size):
+        yield _translate_dataframe(pd.DataFrame(chunk, columns=columns), translator)
+
 def get_csv_from_query(target: DatabaseTarget, query: dict, columns: list):
     
     # index false to not have column of row numbers
     return get_translated_dataframe(target, query, columns).to_csv(index=False)
 
+def iter_csv_from_query(target: DatabaseTarget, query: dict, columns: list):
+    '''Get the csv for a query a chunk of rows at a time
+
+    Outputs:
+        a generator of strings, the header row first and then the rows of each chunk
+    '''
+
+    # header row is written on its own so it is sent even if there is no data
+    yield pd.DataFrame(columns=columns).to_csv(index=False)
+
+    for df in iter_translated_dataframes(target, query, columns):
+        yield df.to_csv(index=False, header=False)
+
 def get_excel_from_query(target: DatabaseTarget, query: dict, columns = PSUT_COLUMNS):
 
     # index false to not have column of row numbers
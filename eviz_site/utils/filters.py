@@ -0,0 +1,124 @@
+####################################################################
+# filters.py contains the evaluation of translated queries in memory
+#
+# Translated queries (see translate_query() in data.py) are dictionaries
+# of Django lookups, e.g. {"Country__in": [1, 2], "Year__gte": 1971}.
+# Anything holding data as numpy columns (the availability index,
+# the partition store, ...) can use query_mask() to find which
+# of its rows a query matches, the same way the database would.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import numpy as np
+from typing import Mapping
+
+# the lookups that can be evaluated in memory
+LOOKUPS = {"exact", "in", "gte", "lte"}
+
+def split_key(key: str) -> tuple[str, str]:
+    '''Split a query key into its column and lookup, e.g. "Year__gte" -> ("Year", "gte")'''
+
+    col, _, lookup = key.partition("__")
+    return col, lookup or "exact"
+
+def compare(values: np.ndarray, lookup: str, v) -> np.ndarray:
+    '''Get which values a single lookup matches
+
+    Inputs:
+        values: the values of a column
+        lookup: the lookup (one of LOOKUPS)
+        v: the value the query gives for the lookup
+
+    Outputs:
+        a boolean array with an entry for each value
+    '''
+
+    match lookup:
+        case "exact": return values == v
+        case "in": return np.isin(values, list(v))
+        case "gte": return values >= v
+        case "lte": return values <= v
+
+    raise ValueError(f"Unsupported lookup: {lookup}")
+
+def query_mask(columns: Mapping[str, np.ndarray], query: dict, size: int, ignore = ()) -> tuple[np.ndarray, list[str]]:
+    '''Get which rows of some columns a translated query matches
+
+    Inputs:
+        columns: the data, column names to arrays of equal length
+        query: a translated query (see translate_query())
+        size: how many rows the columns have
+        ignore: columns whose conditions are left out of the query
+
+    Outputs:
+        a tuple of
+            a boolean array with an entry for each row
+            a list of the query keys that couldn't be evaluated
+            (columns that aren't in the data or lookups not in LOOKUPS),
+            which are left out of the mask
+    '''
+
+    mask = np.ones(size, dtype=bool)
+    unhandled = []
+
+    for key, v in query.items():
+        col, lookup = split_key(key)
+        if col in ignore:
+            continue
+
+        if col not in columns or lookup not in LOOKUPS:
+            unhandled.append(key)
+            continue
+
+        mask &= compare(columns[col], lookup, v)
+
+    return mask, unhandled
+
+def merge_queries(*queries: dict) -> tuple[dict, list[str]]:
+    '''Get one query whose rows include every row of some translated queries
+
+    The rows of each query can then be picked out of the merged query's rows
+    with query_mask(), so several queries can be fetched in one go.
+
+    Inputs:
+        queries: the translated queries, which may only differ in
+                 exact/"in" values and the bounds of gte/lte lookups
+
+    Outputs:
+        a tuple of
+            the merged query
+            the columns the queries differ in, which need fetching to tell their rows apart
+    '''
+
+    merged = {}
+    differing = set()
+
+    for key in dict.fromkeys(key for query in queries for key in query):
+        values = [query.get(key) for query in queries]
+        col, lookup = split_key(key)
+
+        if all(v == values[0] for v in values):
+            merged[key] = values[0]
+            continue
+
+        if any(v is None for v in values):
+            # one query doesn't filter on the column at all, so neither does the merged one
+            differing.add(col)
+            continue
+
+        differing.add(col)
+        match lookup:
+            case "exact" | "in":
+                # every value any query matches
+                items = [item for v in values for item in (v if lookup == "in" else [v])]
+                merged[col + "__in"] = sorted(set(merged.get(col + "__in", [])) | set(items))
+            case "gte":
+                merged[key] = min(values)
+            case "lte":
+                merged[key] = max(values)
+            case _:
+                raise ValueError(f"Can't merge queries that differ in {key}")
+
+    return merged, sorted(differing)
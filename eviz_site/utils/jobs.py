@@ -0,0 +1,185 @@
+####################################################################
+# jobs.py contains the background job queue for expensive plots
+#
+# Some plots (e.g. RUVY matrices at detailed aggregations, or xy plots
+# faceted over many countries) take long enough that holding the request
+# open until they are made ties up the server and can time out.
+# Those plots are made as jobs instead: the request gets a job ID back
+# right away, and the page polls for the finished plot (see get_plot_job()
+# in eviz/views/visualizer.py).
+#
+# Job state is kept as small JSON files in a directory so that any
+# process on the host can answer a poll for any job.
+# Jobs are identified by a key of what they make (hashed with the
+# secret key, so it can't be worked out from a query), so identical
+# requests share one job, and finished jobs are kept for a short time.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import re
+import json
+from time import time
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
+from utils.logging import LOGGER
+
+# job IDs are hex keys from canonical_key(), anything else isn't a job
+_JOB_ID = re.compile(r"[0-9a-f]{64}")
+
+class JobQueue:
+    '''A queue of jobs run on a pool of worker threads, with their state kept in files'''
+
+    def __init__(self, store_dir: str | Path, workers: int, per_user_limit: int, result_ttl: float, timeout: float):
+        '''
+        Inputs:
+            store_dir: directory to keep job state in
+            workers: how many jobs can run at once
+            per_user_limit: how many jobs one user can have queued or running at once
+            result_ttl: how many seconds finished jobs are kept
+            timeout: how many seconds a job can be unfinished before it is given up on
+        '''
+
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.per_user_limit = per_user_limit
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="eviz-job")
+        # keys are users, values are how many jobs they have queued or running
+        self.__per_user: dict[str, int] = {}
+        self.__lock = Lock()
+        self.__last_sweep = 0
+
+        # counters
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.finished = 0
+        self.failed = 0
+
+    def __path(self, job_id: str) -> Path:
+        return self.store_dir / f"{job_id}.json"
+
+    def __write(self, job_id: str, state: dict):
+        # write to a temporary file first so no one reads half a state
+        temp_path = self.store_dir / f"{job_id}.json.{os.getpid()}"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.__path(job_id))
+
+    def __expired(self, state: dict, age: float) -> bool:
+        # unfinished jobs get longer, but not forever in case their process died
+        return age > (self.timeout if state["status"] == "pending" else self.result_ttl)
+
+    def get(self, job_id: str) -> dict | None:
+        '''Get the state of a job
+
+        Outputs:
+            a dictionary with the job's status ("pending", "done" or "error"),
+            the info it was submitted with and, once finished, its result
+            or None if there is no such job (or it expired)
+        '''
+
+        if not _JOB_ID.fullmatch(job_id):
+            return None
+
+        path = self.__path(job_id)
+        try:
+            age = time() - path.stat().st_mtime
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return None if self.__expired(state, age) else state
+
+    def submit(self, job_id: str, user: str, info: dict, func, *args) -> str | None:
+        '''Queue a job, unless an identical one is already queued or finished
+
+        Inputs:
+            job_id: what identifies the job, identical jobs have the same ID (see canonical_key())
+            user: who the job is for, to limit how many jobs they have at once
+            info: JSON-able information to keep with the job, e.g. what to do with its result
+            func: the function to run, its result must be JSON-able
+            args: the arguments to give the function
+
+        Outputs:
+            the ID of the job to poll
+            or None if the user already has too many jobs
+        '''
+
+        self.sweep()
+
+        with self.__lock:
+            state = self.get(job_id)
+            if state is not None and state["status"] != "error":
+                self.deduplicated += 1
+                return job_id
+
+            if self.__per_user.get(user, 0) >= self.per_user_limit:
+                self.rejected += 1
+                return None
+
+            self.__per_user[user] = self.__per_user.get(user, 0) + 1
+            self.__write(job_id, dict(status = "pending", info = info))
+            self.submitted += 1
+
+        self.__executor.submit(self.__run, job_id, user, info, func, *args)
+        return job_id
+
+    def __run(self, job_id: str, user: str, info: dict, func, *args):
+        try:
+            state = dict(status = "done", info = info, result = func(*args))
+            self.finished += 1
+        except Exception:
+            LOGGER.exception(f"Job {job_id} failed")
+            state = dict(status = "error", info = info, result = None)
+            self.failed += 1
+        finally:
+            # worker threads live on between jobs,
+            # so give their connections back to the pool once the work is done
+            close_old_connections()
+            with self.__lock:
+                self.__per_user[user] -= 1
+                if self.__per_user[user] == 0:
+                    del self.__per_user[user]
+
+        self.__write(job_id, state)
+
+    def sweep(self):
+        '''Delete the files of expired jobs, at most once every result_ttl seconds'''
+
+        now = time()
+        if now - self.__last_sweep < self.result_ttl:
+            return
+        self.__last_sweep = now
+
+        for path in self.store_dir.glob("*.json"):
+            try:
+                age = now - path.stat().st_mtime
+                with open(path) as f:
+                    state = json.load(f)
+                if self.__expired(state, age):
+                    path.unlink()
+            except (OSError, ValueError):
+                # another process got to it first
+                continue
+
+    def stats(self) -> dict:
+        '''Get the counters of the queue'''
+
+        with self.__lock:
+            return dict(
+                submitted = self.submitted,
+                deduplicated = self.deduplicated,
+                rejected = self.rejected,
+                finished = self.finished,
+                failed = self.failed,
+                queued_or_running = sum(self.__per_user.values()),
+            )
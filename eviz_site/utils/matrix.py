@@ -5,16 +5,70 @@
 # and turn those matricies into HTML to display
 #
 # The matricies are represented by scipy's sparse coo_matrix
+#
+# The rows and columns of every matrix are the entries of the Index table,
+# which is kept in memory for each database (see get_index_table())
+# so making a matrix or heatmap only queries the matrix's values.
+#
+# Heatmaps only show the rows and columns of a matrix that have values.
+# Big ones are drawn in tiles: the matrix is put in the shared store
+# (see shared.py) and the page fetches the tiles it needs as it is
+# zoomed and panned (see get_matrix_tile()).
+#
+# Two matrices (e.g. of different years, versions or countries) can be
+# compared cell by cell, see get_matrix_diff().
 # 
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
+import numpy as np
+from time import monotonic
 import plotly.graph_objects as pgo
-from scipy.sparse import coo_matrix
-from utils.data import _query_database, DatabaseTarget
+from scipy.sparse import coo_matrix, csr_matrix
+from utils.data import _query_database_arrays, DatabaseTarget, version_stamp, current_versions
+from utils.cache import VersionedBuilds, canonical_key
+from utils.shared import SHARED
+from utils.filters import merge_queries, query_mask, split_key
 from eviz.models import PSUT, Index
 from utils.translator import Translator
+from eviz_site.settings import SECRET_KEY, RESULT_CACHE_VERSION_CHECK, MATRIX_TILE_SIZE, MATRIX_TILE_TTL
+
+class IndexTable:
+    '''The Index table of a database, the rows and columns of its matrices'''
+
+    def __init__(self, ids: np.ndarray, names: np.ndarray, orders: np.ndarray):
+        '''
+        Inputs:
+            ids: the IndexID of every entry
+            names: the name of every entry
+            orders: the order of every entry
+        '''
+
+        # matrices are square, with a row and column for every ID
+        self.size = max(len(ids), int(ids.max()) + 1 if len(ids) else 0)
+
+        # names and orders by ID, so a matrix's rows and columns can be looked up all at once
+        self.names = np.full(self.size, None, dtype=object)
+        self.names[ids] = names
+        self.orders = np.full(self.size, np.iinfo(np.int32).max, dtype=np.int32)
+        self.orders[ids] = orders
+
+        # keys are names, values are IDs
+        self.ids = dict(zip(names.tolist(), ids.tolist()))
+
+def _build_index_table(key: tuple[str]) -> IndexTable:
+    rows = list(Index.objects.using(key[0]).values_list("IndexID", "Index", "Order"))
+    ids, names, orders = zip(*rows) if rows else ((), (), ())
+    return IndexTable(np.array(ids, dtype=np.int64), np.array(names, dtype=object), np.array(orders, dtype=np.int32))
+
+# the Index table of each database, reloaded when the database's versions change
+INDEX_TABLES = VersionedBuilds("index table", _build_index_table, version_stamp, RESULT_CACHE_VERSION_CHECK)
+
+def get_index_table(database: str) -> IndexTable:
+    '''Get the Index table of a database'''
+
+    return INDEX_TABLES.get((database,))
 
 def get_matrix(target: DatabaseTarget, query: dict) -> coo_matrix:
     '''Collects, constructs, and returns one of the RUVY matrices
@@ -29,93 +83,303 @@ def get_matrix(target: DatabaseTarget, query: dict) -> coo_matrix:
 
     # Get the sparse matrix representation
     # i, j, x for row, column, value
-    # in 3-tuples
-    sparse_matrix = _query_database(target, query, ["i", "j", "value"])
+    # as one array for each
+    sparse_matrix = _query_database_arrays(target, query, ["i", "j", "value"])
 
     # if nothing was returned
-    if not sparse_matrix:
+    if sparse_matrix is None:
         return None
 
     # Get dimensions for a matrix (rows and columns will be the same)
-    # len() would evaluate the query set, so use count() instead for better performance
-    matrix_nrow = Index.objects.all().count()
-
-    # For each 3-tuple in sparse_matrix
-    # Put together all the first values, all the second, etc.
-    # All first values across the tupes are rows, second are columns, etc.
-    row, col, val = zip(*sparse_matrix)
+    matrix_nrow = get_index_table(target[0]).size
 
     # Make and return the sparse matrix
     return coo_matrix(
-        (val, (row, col)),
+        (sparse_matrix["value"], (sparse_matrix["i"], sparse_matrix["j"])),
         shape=(matrix_nrow, matrix_nrow),
     )
 
 def get_ruvy_matrix(target: DatabaseTarget, query: dict) -> tuple:
-    sparse_matrix = _query_database(target, query, ["i", "j", "value", "matname"])
-    if not sparse_matrix:
+    sparse_matrix = _query_database_arrays(target, query, ["i", "j", "value", "matname"])
+    if sparse_matrix is None:
         return None, None
-    matrix_nrow = Index.objects.all().count()
-    row, col, val, matname = zip(*sparse_matrix)
+    matrix_nrow = get_index_table(target[0]).size
     mat = coo_matrix(
-        (val, (row, col)),
+        (sparse_matrix["value"], (sparse_matrix["i"], sparse_matrix["j"])),
         shape=(matrix_nrow, matrix_nrow),
     )
 
-    return mat, matname
+    return mat, sparse_matrix["matname"]
+
+def get_matrix_diff(target: DatabaseTarget, query: dict, other_query: dict) -> tuple:
+    '''Collects two matrices in one database query and finds the cells that changed between them
+
+    Inputs:
+        target: the database target of the queries
+        query: a translated query for the first matrix (see translate_query())
+        other_query: a translated query for the second matrix,
+                     differing from the first in e.g. its year, version or country
+
+    Outputs:
+        a tuple of
+            a scipy coo_matrix of (second - first), with only the cells that changed
+            the relative change of each of those cells, (second - first) / |first| (inf for cells new in the second)
+        or a tuple of None, None if neither query related to any data
+    '''
+
+    # fetch the rows of both matrices at once, along with what tells them apart
+    merged, differing = merge_queries(query, other_query)
+    data = _query_database_arrays(target, merged, ["i", "j", "value"] + differing)
+    if data is None:
+        return None, None
+
+    size = get_index_table(target[0]).size
+    columns = {col: data[col] for col in differing}
+
+    def matrix(side_query: dict) -> csr_matrix:
+        # the rows of one of the matrices
+        mask, unhandled = query_mask(columns, {k: v for k, v in side_query.items() if split_key(k)[0] in columns}, len(data["value"]))
+        if unhandled:
+            raise ValueError(f"Can't tell the matrices apart by {unhandled}")
+        return csr_matrix((data["value"][mask], (data["i"][mask], data["j"][mask])), shape=(size, size))
+
+    first, second = matrix(query), matrix(other_query)
+    diff = (second - first).tocoo()
+
+    # only cells that changed by more than rounding
+    first_values = np.asarray(first[diff.row, diff.col]).reshape(-1)
+    second_values = np.asarray(second[diff.row, diff.col]).reshape(-1)
+    changed = np.abs(diff.data) > 1e-9 * np.maximum(np.abs(first_values), np.abs(second_values))
+
+    relative = np.full(changed.sum(), np.inf)
+    np.divide(diff.data[changed], np.abs(first_values[changed]), out=relative, where=first_values[changed] != 0)
+
+    return coo_matrix((diff.data[changed], (diff.row[changed], diff.col[changed])), shape=diff.shape), relative
 
 import altair as alt
 import pandas as pd
-def visualize_matrix(target: DatabaseTarget, mat: coo_matrix, matnames: list = None ,color_scale: str = 'inferno', coloring_method: str = 'weight') -> pgo.Figure:
-    """Visualize a sparse matrix as a heatmap using Plotly.
+
+def matrix_frame(target: DatabaseTarget, mat: coo_matrix, matnames = None, relative = None) -> pd.DataFrame:
+    """Get the cells of a matrix heatmap, labelled and ordered by the Index table.
 
     Inputs:
+        target: the database target the matrix is from
         mat (coo_matrix): A scipy sparse matrix in COOrdinate format.
-        color_scale (str, optional): The color scale to use for the heatmap. Defaults to 'viridis'.
+        matnames (optional): for RUVY matrices colored by matrix, the matrix name ID of each value
+        relative (optional): for a matrix of differences (see get_matrix_diff()), the relative change of each cell
 
     Outputs:
-        pgo.Figure: A Plotly graph object Figure containing the heatmap.
+        pd.DataFrame: the x, y, value, x_order and y_order (and matname or relative) of each cell
     """
-    
-    translator = Translator(target[0]) # get a translator for the correct database
-    
-    # Create a dictionary mapping index IDs to their orders.
-    index_orders = {id: order for id, order in Index.objects.values_list("IndexID", "Order")}
-    
+
+    index = get_index_table(target[0]) # the rows and columns of the correct database
+
     # columns to be used in dataframe
+    # (looked up for every cell at once)
     frame_columns = {
-        'x': [translator.index_translate(col) for col in mat.col],
-        'y': [translator.index_translate(row) for row in mat.row],
+        'x': index.names[mat.col],
+        'y': index.names[mat.row],
         'value': mat.data,
-        'x_order': [index_orders[col] for col in mat.col],
-        'y_order': [index_orders[row] for row in mat.row]
+        'x_order': index.orders[mat.col],
+        'y_order': index.orders[mat.row]
     }
-    
-    # Create a Plotly Heatmap object
-    if coloring_method == 'ruvy' and matnames:
-        frame_columns.update({'matname': [translator.matname_translate(i) for i in matnames]})
-        tooltip = [
-                alt.Tooltip('y', title='From'),
-                alt.Tooltip('x', title='To'),
-                alt.Tooltip('value'),
-                alt.Tooltip('matname')]
+
+    if matnames is not None:
+        # only the few distinct matrix names need translating
+        translator = Translator(target[0])
+        matname_ids, inverse = np.unique(matnames, return_inverse=True)
+        frame_columns.update({'matname': np.array([translator.matname_translate(int(i)) for i in matname_ids], dtype=object)[inverse.reshape(-1)]})
+
+    if relative is not None:
+        frame_columns['relative'] = relative
+
+    return pd.DataFrame(frame_columns)
+
+def visualize_matrix(frame: pd.DataFrame, color_scale: str = 'inferno', coloring_method: str = 'weight') -> alt.Chart:
+    """Visualize the cells of a matrix as an Altair heatmap.
+
+    Inputs:
+        frame (pd.DataFrame): the cells of the matrix (see matrix_frame())
+        color_scale (str, optional): The color scale to use for the heatmap. Defaults to 'inferno'.
+        coloring_method (str, optional): color by "weight" or, for RUVY matrices, by matrix ("ruvy")
+
+    Outputs:
+        alt.Chart: An Altair Chart containing the heatmap.
+    """
+
+    tooltip = [
+            alt.Tooltip('y', title='From'),
+            alt.Tooltip('x', title='To'),
+            alt.Tooltip('value')]
+
+    if coloring_method == 'ruvy' and 'matname' in frame:
+        tooltip.append(alt.Tooltip('matname'))
         colors = 'matname:N'
     else:
-        tooltip = [
-                alt.Tooltip('y', title='From'),
-                alt.Tooltip('x', title='To'),
-                alt.Tooltip('value')]
         colors = 'value:Q'
-    
-    df = pd.DataFrame(frame_columns)
-        
-    heatmap = alt.Chart(df).mark_rect(stroke='blue', strokeWidth=1).encode(
+
+    # differences are colored either side of no change
+    scale = alt.Scale(scheme=color_scale)
+    if 'relative' in frame:
+        tooltip.append(alt.Tooltip('relative', format='+.1%'))
+        scale = alt.Scale(scheme=color_scale, domainMid=0)
+
+    heatmap = alt.Chart(frame).mark_rect(stroke='blue', strokeWidth=1).encode(
             x=alt.X('x', axis=alt.Axis(orient='top', labelAngle=-45, title=""), sort=alt.EncodingSortField(field='x_order', order='ascending')),
             y=alt.Y('y', axis=alt.Axis(title=""), sort=alt.EncodingSortField(field='y_order', order='ascending')),
             color=alt.Color(
                 colors, 
-                scale=alt.Scale(scheme=color_scale)
+                scale=scale
             ),
             tooltip=tooltip
         )
-    return heatmap
\ No newline at end of file
+    return heatmap
+
+def compact_matrix(target: DatabaseTarget, mat: coo_matrix, matnames = None) -> dict:
+    '''Drop the empty rows and columns of a matrix and put the rest in order
+
+    Inputs:
+        target: the database target the matrix is from
+        mat: the matrix
+        matnames: the matrix name ID of each value, for RUVY matrices
+
+    Outputs:
+        a dictionary of
+            row_labels, col_labels: the names of the rows and columns left, in order
+            indptr, indices, data: the matrix in CSR form, over the rows and columns left
+            matname (if matnames were given): the matrix name ID of each value, in CSR order
+    '''
+
+    index = get_index_table(target[0])
+
+    # the rows and columns with values, in order
+    rows = np.unique(mat.row)
+    rows = rows[np.lexsort((rows, index.orders[rows]))]
+    cols = np.unique(mat.col)
+    cols = cols[np.lexsort((cols, index.orders[cols]))]
+
+    # where each row and column moved to
+    row_pos = np.empty(index.size, dtype=np.int64)
+    row_pos[rows] = np.arange(len(rows))
+    col_pos = np.empty(index.size, dtype=np.int64)
+    col_pos[cols] = np.arange(len(cols))
+
+    # sorted by row then column, without adding together values that share a cell
+    # (which a RUVY matrix's values can, being from different matrices)
+    new_rows, new_cols = row_pos[mat.row], col_pos[mat.col]
+    order = np.lexsort((new_cols, new_rows))
+
+    compact = dict(
+        row_labels = index.names[rows].tolist(),
+        col_labels = index.names[cols].tolist(),
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(new_rows, minlength=len(rows)))]),
+        indices = new_cols[order].astype(np.int32),
+        data = np.asarray(mat.data)[order],
+    )
+    if matnames is not None:
+        compact["matname"] = np.asarray(matnames)[order]
+
+    return compact
+
+# keys are database names, values are their versions when stored matrices were last pruned
+_PRUNED_VERSIONS: dict[str, list] = {}
+# when stored matrices were last pruned (from time.monotonic())
+_last_prune = 0
+
+def _prune_matrix_tiles(database: str, versions: list):
+    # remove stored matrices no one has published for a while,
+    # only when a database's versions change (making its matrices stale) or every MATRIX_TILE_TTL seconds
+    global _last_prune
+    if _PRUNED_VERSIONS.get(database) == versions and monotonic() - _last_prune < MATRIX_TILE_TTL:
+        return
+
+    _PRUNED_VERSIONS[database] = versions
+    _last_prune = monotonic()
+    SHARED.remove_older("matrix-", MATRIX_TILE_TTL)
+
+def publish_matrix_tiles(target: DatabaseTarget, query: dict, mat: coo_matrix, matnames = None) -> dict:
+    '''Put a matrix in the shared store so its heatmap can be drawn in tiles
+
+    Inputs:
+        target: the database target the matrix is from
+        query: the translated query the matrix is for
+        mat: the matrix
+        matnames: the matrix name ID of each value, for RUVY matrices
+
+    Outputs:
+        a dictionary describing the matrix for the tiled heatmap renderer (see plotUtil.js)
+    '''
+
+    # the secret key keeps the names of matrices (e.g. of IEA data) from being worked out from their queries
+    name = "matrix-" + canonical_key(SECRET_KEY, target[0], query, matnames is not None)
+
+    # the matrix is rebuilt for new data even though its query stays the same
+    versions = list(current_versions(target[0]))
+
+    def build():
+        compact = compact_matrix(target, mat, matnames)
+        meta = dict(
+            versions = versions,
+            row_labels = compact.pop("row_labels"),
+            col_labels = compact.pop("col_labels"),
+            min = float(compact["data"].min()),
+            max = float(compact["data"].max()),
+        )
+        return meta, compact
+
+    _prune_matrix_tiles(target[0], versions)
+
+    # the same matrix is only stored once
+    meta, arrays = SHARED.load(name, lambda meta: meta.get("versions") == versions, build)
+
+    spec = dict(
+        type = "tiled_matrix",
+        name = name.removeprefix("matrix-"),
+        shape = [len(meta["row_labels"]), len(meta["col_labels"])],
+        tile_size = MATRIX_TILE_SIZE,
+        row_labels = meta["row_labels"],
+        col_labels = meta["col_labels"],
+        min = meta["min"],
+        max = meta["max"],
+    )
+    if "matname" in arrays:
+        translator = Translator(target[0])
+        matname_ids = np.unique(arrays["matname"])
+        spec["matnames"] = {str(i): translator.matname_translate(int(i)) for i in matname_ids}
+
+    return spec
+
+def get_matrix_tile(name: str, tile_row: int, tile_col: int) -> dict | None:
+    '''Get the values in one tile of a matrix put in the shared store by publish_matrix_tiles()
+
+    Inputs:
+        name: the name of the matrix
+        tile_row, tile_col: which tile, counting tiles of MATRIX_TILE_SIZE rows and columns
+
+    Outputs:
+        a dictionary of the row and column (within the tile) and value of every cell in the tile,
+        and their matrix name IDs for RUVY matrices
+        or None if the matrix isn't in the store (e.g. it expired)
+    '''
+
+    shared = SHARED.read("matrix-" + name)
+    if shared is None:
+        return None
+    arrays = shared[1]
+
+    indptr = arrays["indptr"]
+    row_start = min(tile_row * MATRIX_TILE_SIZE, len(indptr) - 1)
+    row_end = min(row_start + MATRIX_TILE_SIZE, len(indptr) - 1)
+    col_start = tile_col * MATRIX_TILE_SIZE
+
+    # the values of the tile's rows, then just those in the tile's columns
+    start, end = indptr[row_start], indptr[row_end]
+    rows = np.repeat(np.arange(row_end - row_start), np.diff(indptr[row_start:row_end + 1]))
+    cols = arrays["indices"][start:end] - col_start
+    in_tile = (cols >= 0) & (cols < MATRIX_TILE_SIZE)
+
+    tile = dict(rows = rows[in_tile], cols = cols[in_tile], values = arrays["data"][start:end][in_tile])
+    if "matname" in arrays:
+        tile["matnames"] = arrays["matname"][start:end][in_tile]
+    return tile
+
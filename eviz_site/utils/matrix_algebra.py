@@ -0,0 +1,214 @@
+####################################################################
+# matrix_algebra.py contains the input-output quantities derived from the RUVY matrices
+#
+# Instead of downloading the R, U, V and Y matrices to work things out
+# offline, users can ask for quantities worked out on the server:
+#   sum         R + U + V + Y
+#   q           product supply, U i + Y i
+#   g           industry output, V i
+#   y           final demand, Y i
+#   leontief    the Leontief inverse (I - A)^-1, with A = U g^-1 V q^-1
+#   efficiency  each industry's output over its input, g / (U' i)
+# (i being a vector of ones and ^-1 the inverse of a vector made diagonal)
+#
+# The matrices and the factorization of (I - A) for a query are kept
+# in a small LRU cache, so asking for more quantities of the same
+# query doesn't go back to the database or factorize again.
+# A database's entries are dropped when its versions change.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import io
+import numpy as np
+import scipy.io
+from threading import Lock
+from collections import OrderedDict
+from scipy.sparse import csr_matrix, csc_matrix, diags, identity
+from scipy.sparse.linalg import splu
+from utils.data import DatabaseTarget, current_versions
+from utils.cache import canonical_key
+from utils.matrix import get_ruvy_matrix, get_index_table, IndexTable
+from utils.translator import Translator
+from eviz_site.settings import MATRIX_ALGEBRA_CACHE_SIZE
+
+# the quantities that can be asked for
+QUANTITIES = ["sum", "q", "g", "y", "leontief", "efficiency"]
+
+class LabeledMatrix:
+    '''A sparse matrix (or vector) whose rows and columns are entries of the Index table'''
+
+    def __init__(self, mat: csr_matrix, index: IndexTable, row_ids: np.ndarray = None, col_ids: np.ndarray = None):
+        '''
+        Inputs:
+            mat: the matrix
+            index: the Index table the rows and columns are from
+            row_ids, col_ids: the IndexID of each row and column
+                              (every ID in order if not given, vectors have a single column with no ID)
+        '''
+
+        self.mat = csr_matrix(mat)
+        self.mat.eliminate_zeros()
+        self.index = index
+        self.row_ids = np.arange(mat.shape[0]) if row_ids is None else row_ids
+        self.col_ids = np.arange(mat.shape[1]) if col_ids is None else col_ids
+
+    @property
+    def size(self) -> int:
+        '''How many values aren't zero'''
+
+        return self.mat.nnz
+
+    def get(self, row: str, col: str = None) -> float:
+        '''Get a value by the names of its row and column (no column for vectors)'''
+
+        row_pos = np.flatnonzero(self.row_ids == self.index.ids[row])
+        col_pos = [0] if col is None else np.flatnonzero(self.col_ids == self.index.ids[col])
+        if len(row_pos) == 0 or len(col_pos) == 0:
+            return 0.0
+        return float(self.mat[row_pos[0], col_pos[0]])
+
+    def __nonzero_labels(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, list[str], list[str]]:
+        # the values, with codes into lists of just the rows and columns that have values
+        coo = self.mat.tocoo()
+        rows, row_codes = np.unique(coo.row, return_inverse=True)
+        cols, col_codes = np.unique(coo.col, return_inverse=True)
+        row_labels = self.index.names[self.row_ids[rows]].tolist()
+        col_labels = self.index.names[self.col_ids[cols]].tolist() if self.mat.shape[1] > 1 else [None] * len(cols)
+        return row_codes.reshape(-1), col_codes.reshape(-1), coo.data, row_labels, col_labels
+
+    def to_json(self) -> dict:
+        '''Get the matrix as sparse JSON: the labels of the rows and columns with values, and the values by code'''
+
+        rows, cols, values, row_labels, col_labels = self.__nonzero_labels()
+        return dict(
+            rows = row_labels, cols = col_labels,
+            i = rows.tolist(), j = cols.tolist(), value = values.tolist(),
+        )
+
+    def to_matrix_market(self) -> str:
+        '''Get the matrix in Matrix Market form, with the labels of its rows and columns in the comments'''
+
+        rows, cols, values, row_labels, col_labels = self.__nonzero_labels()
+        comment = "\n".join(
+            [f" row {k + 1}: {label}" for k, label in enumerate(row_labels)]
+            + [f" col {k + 1}: {label}" for k, label in enumerate(col_labels) if label is not None]
+        )
+
+        out = io.BytesIO()
+        scipy.io.mmwrite(out, csr_matrix((values, (rows, cols)), shape=(len(row_labels), len(col_labels))), comment=comment)
+        return out.getvalue().decode()
+
+class _PSUT:
+    # the RUVY matrices of a query and what's worked out from them, kept between requests
+
+    def __init__(self, index: IndexTable, matrices: dict[str, csr_matrix]):
+        self.index = index
+        self.R, self.U, self.V, self.Y = (matrices[name] for name in "RUVY")
+
+        ones = np.ones(index.size)
+        self.y = self.Y @ ones
+        self.q = self.U @ ones + self.y
+        self.g = self.V @ ones
+        self.industry_inputs = self.U.T @ ones
+
+        # the factorization of (I - A) over the products with supply, made when first needed
+        self.__lu = None
+        self.__lock = Lock()
+
+    def leontief_factorization(self):
+        with self.__lock:
+            if self.__lu is None:
+                products = np.flatnonzero(self.q)
+                Z = self.U @ diags(_inverse(self.g))
+                D = self.V @ diags(_inverse(self.q))
+                A = csc_matrix((Z @ D)[products][:, products])
+                self.__lu = (products, splu(identity(len(products), format="csc") - A))
+            return self.__lu
+
+def _inverse(v: np.ndarray) -> np.ndarray:
+    # 1 / v, leaving zeros as zeros
+    out = np.zeros_like(v, dtype=np.float64)
+    np.divide(1, v, out=out, where=v != 0)
+    return out
+
+def _vector(index: IndexTable, v: np.ndarray) -> LabeledMatrix:
+    return LabeledMatrix(csr_matrix(v.reshape(-1, 1)), index)
+
+# keys are query keys, values are tuples of the database and the _PSUT of the query, least recently used first
+_CACHE: OrderedDict[str, tuple[str, _PSUT]] = OrderedDict()
+_CACHE_LOCK = Lock()
+# keys are database names, values are the versions the database's entries are from
+_CACHE_VERSIONS: dict[str, tuple] = {}
+
+def _get_psut(target: DatabaseTarget, query: dict) -> _PSUT | None:
+    # the RUVY matrices of a (translated, RUVY) query, from the cache when possible
+    database = target[0]
+    key = canonical_key(database, query)
+    versions = current_versions(database)
+    with _CACHE_LOCK:
+        # new data, so the database's matrices (and their Index table) are out of date
+        if _CACHE_VERSIONS.get(database) != versions:
+            for stale in [k for k, (db, _) in _CACHE.items() if db == database]:
+                del _CACHE[stale]
+            _CACHE_VERSIONS[database] = versions
+
+        if (entry := _CACHE.get(key)) is not None:
+            _CACHE.move_to_end(key)
+            return entry[1]
+
+    mat, matnames = get_ruvy_matrix(target, query)
+    if mat is None:
+        return None
+
+    # split into the R, U, V and Y matrices
+    translator = Translator(target[0])
+    matrices = {}
+    for name in "RUVY":
+        part = np.asarray(matnames) == translator.matname_translate(name)
+        matrices[name] = csr_matrix((mat.data[part], (mat.row[part], mat.col[part])), shape=mat.shape)
+
+    psut = _PSUT(get_index_table(target[0]), matrices)
+    with _CACHE_LOCK:
+        # unless the versions changed while it was being made
+        if _CACHE_VERSIONS.get(database) == versions:
+            _CACHE[key] = (database, psut)
+        while len(_CACHE) > MATRIX_ALGEBRA_CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return psut
+
+def get_quantity(target: DatabaseTarget, query: dict, quantity: str) -> LabeledMatrix | None:
+    '''Work out an input-output quantity from the RUVY matrices of a query
+
+    Inputs:
+        target: the database target of the query
+        query: a query for the RUVY matrices, translated (see translate_query()) with matname "RUVY"
+        quantity: which quantity, one of QUANTITIES
+
+    Outputs:
+        the quantity as a labeled matrix (vectors are a single column)
+        or None if the query related to no data
+    '''
+
+    if quantity not in QUANTITIES:
+        raise ValueError(f"Unknown quantity: {quantity}")
+
+    psut = _get_psut(target, query)
+    if psut is None:
+        return None
+
+    match quantity:
+        case "sum":
+            return LabeledMatrix(psut.R + psut.U + psut.V + psut.Y, psut.index)
+        case "q":
+            return _vector(psut.index, psut.q)
+        case "g":
+            return _vector(psut.index, psut.g)
+        case "y":
+            return _vector(psut.index, psut.y)
+        case "efficiency":
+            return _vector(psut.index, psut.g * _inverse(psut.industry_inputs))
+        case "leontief":
+            products, lu = psut.leontief_factorization()
+            return LabeledMatrix(csr_matrix(lu.solve(np.eye(len(products)))), psut.index, products, products)
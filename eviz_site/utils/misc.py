@@ -13,16 +13,28 @@
 #####################
 
 from time import time
+from inspect import iscoroutinefunction
 def time_view(v):
     '''Wrapper to time how long it takes to deliver a view
 
     Inputs:
-        v, function: the view to time
+        v, function: the view to time (can be sync or async)
 
     Outputs:
         A function which wil prints how long the given view took to run
     '''
 
+    # async views have to stay async so Django runs them as such
+    if iscoroutinefunction(v):
+        async def async_wrap(*args, **kwargs):
+            t0 = time()
+            ret = await v(*args, **kwargs)
+            t1 = time()
+            print(f"Time to run {v.__name__}: {t1 - t0}")
+            return ret
+
+        return async_wrap
+
     def wrap(*args, **kwargs):
         t0 = time()
         ret = v(*args, **kwargs)
@@ -0,0 +1,196 @@
+####################################################################
+# partitions.py contains the local partition store for hot slices of data
+#
+# Most queries pick one dataset, one version and a few countries,
+# and the same slices get asked for over and over.
+# The partition store keeps those slices on local disk, one file per
+# (database, table, dataset, version, country), holding every column
+# of the slice's rows as a numpy structured array.
+#
+# Files are opened as memory maps, so reading a partition only touches
+# the pages needed and the operating system caches hot partitions
+# for every process at once. Rows are sorted by Year, so year ranges
+# are contiguous slices of a partition and don't copy anything.
+#
+# Queries that can't be answered from partitions (e.g. no partition
+# was built for the country) go to the database as usual.
+# Partitions are built with the build_partitions management command.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import re
+import numpy as np
+from pathlib import Path
+from threading import Lock
+from utils.logging import LOGGER
+from utils.filters import query_mask, split_key
+
+# partition file names, e.g. d3-v7-c42.npy
+_PARTITION_NAME = re.compile(r"d(\d+)-v(\d+)-c(\d+)\.npy")
+
+def partition_fields(model) -> list[str]:
+    '''Get the columns kept in partitions of a model's table'''
+
+    return [field.name for field in model._meta.concrete_fields if not field.primary_key]
+
+class PartitionStore:
+    '''Slices of tables kept as memory mapped files'''
+
+    def __init__(self, root: str | Path):
+        '''
+        Inputs:
+            root: the directory the partitions are kept in
+        '''
+
+        self.root = Path(root)
+
+        # keys are partition paths
+        # values are tuples of the file's modification time when opened and the open memory map
+        self.__open: dict[Path, tuple[int, np.ndarray]] = {}
+        self.__lock = Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, database: str, model, dataset: int, version: int, country: int) -> Path:
+        '''Get where the partition for a slice is kept'''
+
+        return self.root / database / model._meta.db_table / f"d{dataset}-v{version}-c{country}.npy"
+
+    def partitions(self, database: str, model) -> list[tuple[int, int, int]]:
+        '''Get the (dataset, version, country) of every partition built for a table'''
+
+        directory = self.root / database / model._meta.db_table
+        if not directory.is_dir():
+            return []
+
+        return [tuple(int(part) for part in match.groups()) for path in directory.iterdir() if (match := _PARTITION_NAME.fullmatch(path.name))]
+
+    def write(self, database: str, model, dataset: int, version: int, country: int, data: dict[str, np.ndarray]):
+        '''Write (or replace) a partition
+
+        Inputs:
+            database: the name of the database the data is from
+            model: the model of the table the data is from
+            dataset: the dataset ID of the slice
+            version: the version ID of the slice
+            country: the country ID of the slice
+            data: every column of the slice (see partition_fields()) as numpy arrays
+        '''
+
+        fields = partition_fields(model)
+        records = np.empty(len(data[fields[0]]), dtype=[(col, data[col].dtype) for col in fields])
+        for col in fields:
+            records[col] = data[col]
+
+        # sorted by year so year ranges are contiguous
+        records = records[np.argsort(records["Year"], kind="stable")]
+
+        path = self.path(database, model, dataset, version, country)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first so no one reads half a partition
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}")
+        with open(temp_path, "wb") as f:
+            np.save(f, records)
+        os.replace(temp_path, path)
+
+    def __read(self, path: Path) -> np.ndarray | None:
+        # the memory map of a partition, reopened if the partition was rebuilt
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+        opened = self.__open.get(path)
+        if opened is not None and opened[0] == mtime:
+            return opened[1]
+
+        try:
+            records = np.load(path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            LOGGER.error(f"Couldn't open partition {path}: {e}")
+            return None
+
+        with self.__lock:
+            self.__open[path] = (mtime, records)
+        return records
+
+    def fetch(self, target, query: dict, columns: list) -> dict[str, np.ndarray] | None:
+        '''Get the data for a query from partitions
+
+        Inputs:
+            target: the database target of the query
+            query: a translated query (see translate_query())
+            columns: the columns to get
+
+        Outputs:
+            a dictionary of column name to (read only) numpy array
+            or None if the query can't be answered from partitions
+        '''
+
+        database, model = target
+
+        # a partition is one dataset, one version and some countries
+        version = query.get("ValidFromVersion__gte")
+        if (
+            not isinstance(query.get("Dataset"), int)
+            or version is None or query.get("ValidToVersion__lte") != version
+        ):
+            return None
+
+        countries = query["Country__in"] if "Country__in" in query else [query.get("Country")]
+        if None in countries:
+            return None
+
+        # what's left to filter within each partition
+        rest = {
+            key: v for key, v in query.items()
+            if key not in ("Dataset", "ValidFromVersion__gte", "ValidToVersion__lte", "Country", "Country__in")
+        }
+        years = {key: v for key, v in rest.items() if split_key(key) in (("Year", "exact"), ("Year", "gte"), ("Year", "lte"))}
+        rest = {key: v for key, v in rest.items() if key not in years}
+
+        slices = []
+        for country in dict.fromkeys(countries):
+            records = self.__read(self.path(database, model, query["Dataset"], version, country))
+            if records is None:
+                self.misses += 1
+                return None
+
+            # year conditions are a contiguous range of the (sorted) partition
+            low, high = 0, len(records)
+            for key, v in years.items():
+                lookup = split_key(key)[1]
+                if lookup in ("exact", "gte"):
+                    low = max(low, np.searchsorted(records["Year"], v, side="left"))
+                if lookup in ("exact", "lte"):
+                    high = min(high, np.searchsorted(records["Year"], v, side="right"))
+            records = records[low:max(low, high)]
+
+            mask, unhandled = query_mask({col: records[col] for col in records.dtype.names}, rest, len(records))
+            if unhandled:
+                self.misses += 1
+                return None
+
+            slices.append(records if mask.all() else records[mask])
+
+        self.hits += 1
+        if len(slices) == 1:
+            # straight from the memory map when nothing had to be filtered out
+            data = {col: slices[0][col] for col in columns}
+        else:
+            data = {col: np.concatenate([part[col] for part in slices]) for col in columns}
+
+        for col in data.values():
+            col.flags.writeable = False
+        return data
+
+    def stats(self) -> dict:
+        '''Get the counters of the store'''
+
+        return dict(hits = self.hits, misses = self.misses, open_partitions = len(self.__open))
@@ -0,0 +1,126 @@
+####################################################################
+# plot_json.py contains the functions to turn plots into compact JSON
+#
+# Instead of whole plot HTML (which repeats the same layout, template
+# and config boilerplate with every plot), the /plot.json API gives
+# only the data of a plot and what little of its layout changes from
+# plot to plot. The renderer in static/js/plotUtil.js holds the rest.
+#
+# Numeric series are sent as typed arrays: base64 of the little-endian
+# bytes of the array, e.g. {"dtype": "f4", "bdata": "AACAPwAAAEA="}
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import base64
+from uuid import uuid4
+import orjson
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+def typed_array(values, dtype: str = "f4") -> dict:
+    '''Encode numbers as a typed array for the plot renderer
+
+    Inputs:
+        values: the numbers
+        dtype: the type to send them as, one of f4, f8, i2, i4, u1
+
+    Outputs:
+        a dictionary of the dtype and the base64 of the array's (little-endian) bytes
+    '''
+
+    array = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {"dtype": dtype, "bdata": base64.b64encode(array.tobytes()).decode("ascii")}
+
+def xy_spec(fig: go.Figure) -> dict:
+    '''Get the data and layout of an xy plot (see get_xy()) for the plot renderer
+
+    Outputs:
+        a dictionary of the plot's traces (with years as i2 and values as f4 typed arrays)
+        and its layout, without the template the renderer already has
+    '''
+
+    traces = []
+    for trace in fig.data:
+        spec = trace.to_plotly_json()
+        spec["x"] = typed_array(np.asarray(trace.x).astype("datetime64[Y]").astype(np.int64) + 1970, "i2")
+        spec["y"] = typed_array(trace.y, "f4")
+        traces.append(spec)
+
+    layout = fig.layout.to_plotly_json()
+    layout.pop("template", None)
+
+    return dict(type = "xy", traces = traces, layout = layout)
+
+def matrix_spec(frame: pd.DataFrame, color_scale: str, coloring_method: str) -> dict:
+    '''Get the cells of a matrix heatmap (see matrix_frame()) for the plot renderer
+
+    Inputs:
+        frame: the heatmap's data, with the x, y, value, x_order, y_order (and maybe matname) columns
+        color_scale: the color scheme of the heatmap
+        coloring_method: how the heatmap is colored, "weight" or "ruvy"
+                         (differences are colored either side of no change)
+
+    Outputs:
+        a dictionary of the row and column labels (in order) and the cells,
+        as codes into the labels (i4) and values (f4)
+    '''
+
+    # every row and column label, in the matrix's order
+    orders = pd.concat([
+        pd.Series(frame["x_order"].to_numpy(), index=frame["x"].to_numpy()),
+        pd.Series(frame["y_order"].to_numpy(), index=frame["y"].to_numpy()),
+    ])
+    orders = orders[~orders.index.duplicated()].sort_values(kind="stable")
+    labels = pd.Index(orders.index)
+
+    spec = dict(
+        type = "matrix",
+        labels = labels.tolist(),
+        x = typed_array(labels.get_indexer(frame["x"]), "i4"),
+        y = typed_array(labels.get_indexer(frame["y"]), "i4"),
+        value = typed_array(frame["value"], "f4"),
+        color_scale = color_scale,
+        coloring_method = coloring_method,
+    )
+
+    if "matname" in frame:
+        matnames, codes = np.unique(frame["matname"].to_numpy(dtype=str), return_inverse=True)
+        spec.update(matnames = matnames.tolist(), matname = typed_array(codes, "u1"))
+
+    # a matrix of differences (see get_matrix_diff())
+    if "relative" in frame:
+        spec["relative"] = typed_array(frame["relative"], "f4")
+
+    return spec
+
+def matrix_tile_spec(tile: dict) -> dict:
+    '''Get the cells of a tile of a matrix heatmap (see get_matrix_tile()) for the plot renderer
+
+    Outputs:
+        a dictionary of the rows and columns (within the tile) of the cells as i2,
+        their values as f4 and (for RUVY matrices) their matrix name IDs as u1 typed arrays
+    '''
+
+    spec = dict(r = typed_array(tile["rows"], "i2"), c = typed_array(tile["cols"], "i2"), v = typed_array(tile["values"], "f4"))
+    if "matnames" in tile:
+        spec["m"] = typed_array(tile["matnames"], "u1")
+    return spec
+
+def inline(spec: dict) -> str:
+    '''Get the HTML that draws a plot spec with the plot renderer right where it is put'''
+
+    element_id = "plot-" + uuid4().hex
+    # "</" would end the script early
+    spec_json = dumps(spec).decode().replace("</", "<\\/")
+    return (
+        f"<div id='{element_id}' class='inline-plot'></div>"
+        f"<script>renderPlotJSON({spec_json}, document.getElementById('{element_id}'))</script>"
+    )
+
+def dumps(spec: dict) -> bytes:
+    '''Serialize a plot spec (or an error) for sending'''
+
+    return orjson.dumps(spec, option=orjson.OPT_SERIALIZE_NUMPY)
@@ -12,62 +12,58 @@
 #       Edom Maru - eam43@calvin.edu 
 #####################
 import json
+import numpy as np
+import pandas as pd
 from utils.translator import Translator
-from utils.data import _query_database, DatabaseTarget
-from eviz_site.settings import SANKEY_COLORS_PATH
-from utils.logging import LOGGER
+from utils.data import _query_database_arrays, DatabaseTarget
+from utils.colors import get_palette
 
 INDUSTRY_COLOR = "midnightblue"
 
-with open(SANKEY_COLORS_PATH) as f:
-    SANKEY_COLORS: dict[str, str] = json.loads(f.read())
-
-def _get_sankey_color(node_name: str) -> str:
-    carrier_name = -1
-
-    for carrier_category in SANKEY_COLORS:
-        if carrier_category in node_name.lower():
-            carrier_name = carrier_category
-            break
-
-    return SANKEY_COLORS.get(carrier_name) or LOGGER.error("Couldn't find sankey color for " + node_name)
-
-def _get_sankey_node_info(
-        label_num: int, label_col: int,
-        node_list: list[list], idx_dict: dict, label_info_dict: dict,
-        translator: Translator,
-        carrier: bool
-):
-    name = translator.index_translate(label_num)
-    # try to get saved information about the label
-    label_info = label_info_dict.get(label_num, -1)
-    if label_info == -1:
-        # add it if it is a new label and get new node_idx
-        node_list[label_col].append(dict(label=name,
-                                         color=_get_sankey_color(name) or "red" if carrier else INDUSTRY_COLOR))
-        
-        label_info = (idx_dict[label_col], label_col)
-        idx_dict[label_col] += 1
-
-        # remember which index and column the label is in so future nodes can find this one
-        label_info_dict[label_num] = label_info
-        node_idx = label_info[0]
-
-    else:
-        # if node is not new, just get the recorded col and idx
-        label_col = label_info[1]
-        node_idx = label_info[0]
-    
-
-    return node_idx, label_col
-
-def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tuple[None, None, None]:
+# which plot columns each matrix's flows go from and to
+# and whether the rows (i) or columns (j) of the matrix are energy carriers
+# values are (from column, to column, carrier rows, carrier columns)
+MATRIX_COLUMNS = {
+    "R": (0, 1, False, True),
+    "U": (1, 2, True, False),
+    "V": (2, 3, False, True),
+    "Y": (3, 4, True, False),
+}
+
+# the columns a Sankey diagram is made from
+SANKEY_COLUMNS = ["matname", "i", "j", "value"]
+
+def sankey_query(target: DatabaseTarget, query: dict) -> dict:
+    '''Get the query for the data of a Sankey diagram, i.e. all of RUVY
+
+    Inputs:
+        target: the database target of the query
+        query: a translated query (see translate_query())
+
+    Outputs:
+        the query, with its matname swapped for all four of the RUVY matrices
+    '''
+
+    translator = Translator(target[0]) # get a translator for the correct database
+
+    query = {k: v for k, v in query.items() if k != "matname"}
+    query["matname__in"] = [
+        translator.matname_translate("R"),
+        translator.matname_translate("U"),
+        translator.matname_translate("V"),
+        translator.matname_translate("Y")
+    ]
+    return query
+
+def get_sankey(target: DatabaseTarget, query: dict, palette: str = None) -> tuple[str, str, str] | tuple[None, None, None]:
     ''' Gets a sankey diagram for a query
 
     Input:
 
         query, dict: a query ready to hit the database, i.e. translated as neccessary (see translate_query())
 
+        palette, str: the name of the palette to color energy carriers with (see utils/colors.py)
+
     Outputs:
 
         a plotly Figure with the sankey data
@@ -75,33 +71,24 @@ def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tu
         or None if there is no cooresponding data for the query
     '''
 
-    # we do a little shaping
-    if "matname" in query.keys():
-        del query["matname"]
-
     translator = Translator(target[0]) # get a translator for the correct database
-    
-    # have the query get a full RUVY
-    query.update({"matname__in": [
-            translator.matname_translate("R"),
-            translator.matname_translate("U"),
-            translator.matname_translate("V"),
-            translator.matname_translate("Y")
-        ]})
 
     # get all four matrices to make the full RUVY matrix
-    data = _query_database(target, query, ["matname", "i", "j", "value"])
+    query = sankey_query(target, query)
+    columns = SANKEY_COLUMNS
+    data = _query_database_arrays(target, query, columns)
 
     # if no cooresponding data, return as such
-    if not data:
+    if data is None:
         return (None, None, None)
 
     # get rid of any duplicate i,j,x combinations (many exist)
-    data = set(data)
+    # and put the flows in a set order so the same data always gives the same diagram
+    data = pd.DataFrame({col: data[col] for col in columns}).drop_duplicates().sort_values(columns)
+    matnames, i, j, magnitudes = (data[col].to_numpy() for col in columns)
 
     # 5 lists, one for each column in the plot
     nodes = [list(), list(), list(), list(), list()]
-    links = list()
     options = dict(
         plot_background_color = '#f4edf7',
         default_links_opacity = 0.8,
@@ -111,58 +98,68 @@ def get_sankey(target: DatabaseTarget, query: dict) -> tuple[str, str, str] | tu
         linear_gradient_links = False
     )
 
-    # track which label is which index in the column lists
-    label2info = dict()
-
-    # keep track of the index a new label is added to
-    # this prevents having to repeatedly calculate the length of the
-    # column lists
-    # keys = column lists by index in nodes list above
-    # values = index at which a new label will be added to a column list
-    idx = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
-
-    # what columns we think the node should go in
-    # filled in below
-
-    for matname, i, j, magnitude in data:
-        from_node_col = to_node_col = -1
-        carrier_row = False
-        carrier_col = False
-        # figure out which column the info should go in
-        match(translator.matname_translate(matname)):
-            case("R"):
-                from_node_col = 0
-                to_node_col = 1
-                carrier_col = True
-
-            case("U"):
-                from_node_col = 1
-                to_node_col = 2
-                carrier_row = True
-
-            case("V"):
-                from_node_col = 2
-                to_node_col = 3
-                carrier_col = True
-
-            case("Y"):
-                from_node_col = 3
-                to_node_col = 4
-                carrier_row = True
-
-        # if the column values were not filled in above
-        if from_node_col < 0 or to_node_col < 0:
-            raise ValueError("Unknown matrix name processed")
-
-        # get the index and column the node truely belongs in
-        from_node_idx, from_node_col = _get_sankey_node_info(i, from_node_col, nodes, idx, label2info, translator, carrier_row)
-        to_node_idx, to_node_col = _get_sankey_node_info(j, to_node_col, nodes, idx, label2info, translator, carrier_col)
-
-        # set up the flow from the two labels above
-        links.append({"from": dict(column=from_node_col, node = from_node_idx),
-                      "to": dict(column=to_node_col, node = to_node_idx),
-                      "value": magnitude,
-                      "color": _get_sankey_color(translator.index_translate(i if carrier_row else j))})
+    # figure out which columns each flow should go between
+    from_cols = np.full(len(data), -1)
+    to_cols = np.full(len(data), -1)
+    carrier_rows = np.zeros(len(data), dtype=bool)
+    carrier_cols = np.zeros(len(data), dtype=bool)
+    for name, (from_col, to_col, carrier_row, carrier_col) in MATRIX_COLUMNS.items():
+        is_matrix = matnames == translator.matname_translate(name)
+        from_cols[is_matrix] = from_col
+        to_cols[is_matrix] = to_col
+        carrier_rows[is_matrix] = carrier_row
+        carrier_cols[is_matrix] = carrier_col
+
+    # if the column values were not filled in above
+    if (from_cols < 0).any():
+        raise ValueError("Unknown matrix name processed")
+
+    # Every label becomes one node, which goes in the column it is first seen in.
+    # Labels are seen flow by flow, "from" label then "to" label,
+    # so lay them out in that order
+    labels = np.column_stack((i, j)).ravel()
+    label_cols = np.column_stack((from_cols, to_cols)).ravel()
+    label_carriers = np.column_stack((carrier_rows, carrier_cols)).ravel()
+
+    # one entry per distinct label (node)
+    node_labels, first_seen, label_nodes = np.unique(labels, return_index=True, return_inverse=True)
+    node_cols = label_cols[first_seen]
+    node_carriers = label_carriers[first_seen]
+
+    # nodes are numbered within their column in the order they were first seen
+    node_idxs = np.empty(len(node_labels), dtype=np.int64)
+    seen_order = np.argsort(first_seen)
+    for col in range(len(nodes)):
+        in_col = seen_order[node_cols[seen_order] == col]
+        node_idxs[in_col] = np.arange(len(in_col))
+
+    # flows are colored by their energy carrier
+    from_nodes, to_nodes = label_nodes[0::2], label_nodes[1::2]
+    color_nodes = np.where(carrier_rows, from_nodes, to_nodes)
+
+    # colors only need to be figured out for carrier nodes,
+    # and only once per node, not once per flow
+    names = translator.decode("index", node_labels).tolist()
+    carrier_nodes = np.union1d(np.flatnonzero(node_carriers), color_nodes).tolist()
+    colors = dict(zip(carrier_nodes, get_palette(palette).index_colors(
+        target[0], node_labels[carrier_nodes].tolist(), [names[node] for node in carrier_nodes])))
+
+    for node in seen_order.tolist():
+        nodes[int(node_cols[node])].append(dict(label=names[node],
+                                                color=colors[node] or "red" if node_carriers[node] else INDUSTRY_COLOR))
+
+    # set up the flows between the nodes made above
+    links = [
+        {"from": dict(column=from_col, node=from_idx),
+         "to": dict(column=to_col, node=to_idx),
+         "value": magnitude,
+         "color": colors[color_node]}
+        for from_col, from_idx, to_col, to_idx, magnitude, color_node in zip(
+            node_cols[from_nodes].tolist(), node_idxs[from_nodes].tolist(),
+            node_cols[to_nodes].tolist(), node_idxs[to_nodes].tolist(),
+            magnitudes.tolist(), color_nodes.tolist()
+        )
+    ]
 
     # convert everything to json to send it to the javascript renderer
     return json.dumps(nodes), json.dumps(links), json.dumps(options)
\ No newline at end of file
@@ -0,0 +1,184 @@
+####################################################################
+# shared.py contains the store of data shared by every process on a host
+#
+# Data every server process needs (e.g. the efficiency cube, see cube.py)
+# would otherwise be loaded and held separately by each process.
+# Instead, it is written once as numpy files and every process
+# memory maps them, so the operating system holds one copy per host
+# and every process reads it without copying.
+#
+# Each named set of arrays is kept in generations:
+#   <root>/<name>/<generation>/   the arrays of a generation, one .npy each
+#                                 and a meta.json describing what they were built from
+#   <root>/<name>/current         the name of the current generation
+# A new generation is written in full before "current" is swapped to it,
+# so readers always see a whole generation, old or new.
+#
+# Only one process at a time builds a new generation (see SharedArrays.loader()),
+# the others wait for it and read what it publishes.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import json
+import fcntl
+import shutil
+import numpy as np
+from time import time, time_ns
+from pathlib import Path
+from threading import Lock
+from contextlib import contextmanager
+from utils.logging import LOGGER
+from eviz_site.settings import SHARED_DATA_DIR
+
+class SharedArrays:
+    '''Named sets of numpy arrays kept once per host as memory mapped files'''
+
+    def __init__(self, root: str | Path):
+        '''
+        Inputs:
+            root: the directory the arrays are kept in
+        '''
+
+        self.root = Path(root)
+
+        # keys are names
+        # values are tuples of the generation and its (meta, arrays), so they're only opened once
+        self.__opened: dict[str, tuple[str, tuple[dict, dict[str, np.ndarray]]]] = {}
+        self.__lock = Lock()
+
+    def read(self, name: str) -> tuple[dict, dict[str, np.ndarray]] | None:
+        '''Get the current generation of a set of arrays
+
+        Inputs:
+            name: the name of the set
+
+        Outputs:
+            a tuple of the generation's meta information and its (read only, memory mapped) arrays
+            or None if nothing has been published under the name
+        '''
+
+        directory = self.root / name
+        try:
+            generation = (directory / "current").read_text()
+        except OSError:
+            # let go of the memory maps of anything removed
+            with self.__lock:
+                self.__opened.pop(name, None)
+            return None
+
+        opened = self.__opened.get(name)
+        if opened is not None and opened[0] == generation:
+            return opened[1]
+
+        try:
+            with open(directory / generation / "meta.json") as f:
+                meta = json.load(f)
+            arrays = {path.stem: np.load(path, mmap_mode="r") for path in (directory / generation).glob("*.npy")}
+        except (OSError, ValueError) as e:
+            # the generation was replaced and cleaned up while being opened
+            LOGGER.warning(f"Couldn't open shared {name} generation {generation}: {e}")
+            return None
+
+        with self.__lock:
+            self.__opened[name] = (generation, (meta, arrays))
+        return meta, arrays
+
+    def publish(self, name: str, meta: dict, arrays: dict[str, np.ndarray]):
+        '''Make a new generation of a set of arrays the current one
+
+        Inputs:
+            name: the name of the set
+            meta: JSON-able information about what the arrays were built from
+            arrays: the arrays, names to numpy arrays (which can't hold Python objects)
+        '''
+
+        directory = self.root / name
+        generation = f"gen-{time_ns()}-{os.getpid()}"
+
+        # write everything under a temporary name, then move it into place in one go
+        temp_directory = directory / f".{generation}"
+        temp_directory.mkdir(parents=True)
+        for array_name, array in arrays.items():
+            np.save(temp_directory / f"{array_name}.npy", array, allow_pickle=False)
+        with open(temp_directory / "meta.json", "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_directory, directory / generation)
+
+        temp_current = directory / f"current.{os.getpid()}"
+        temp_current.write_text(generation)
+        os.replace(temp_current, directory / "current")
+
+        # processes still using old generations keep their memory maps after the files are gone
+        for old in directory.iterdir():
+            if old.is_dir() and old.name != generation and not old.name.startswith("."):
+                shutil.rmtree(old, ignore_errors=True)
+
+    def remove_older(self, prefix: str, age: float):
+        '''Remove every set of arrays whose name starts with a prefix that hasn't been published to for a while
+
+        Inputs:
+            prefix: the start of the names of the sets
+            age: how many seconds since being published a set is kept
+        '''
+
+        for directory in self.root.glob(prefix + "*"):
+            try:
+                if time() - (directory / "current").stat().st_mtime > age:
+                    shutil.rmtree(directory, ignore_errors=True)
+            except OSError:
+                continue
+
+    @contextmanager
+    def loader(self, name: str):
+        '''Be the only process building a new generation of a set of arrays
+
+        Waits for any other process building one to finish, so check
+        whether what's needed was published while waiting (see read()).
+        '''
+
+        directory = self.root / name
+        directory.mkdir(parents=True, exist_ok=True)
+
+        with open(directory / "loader.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self, name: str, is_current, build) -> tuple[dict, dict[str, np.ndarray]]:
+        '''Get a set of arrays, building and publishing a new generation if it's out of date
+
+        Inputs:
+            name: the name of the set
+            is_current: a function that, given a generation's meta information, says if it is up to date
+            build: a function that builds the arrays, giving a tuple of meta information and the arrays
+
+        Outputs:
+            a tuple of the generation's meta information and its (read only, memory mapped) arrays
+        '''
+
+        shared = self.read(name)
+        if shared is not None and is_current(shared[0]):
+            return shared
+
+        with self.loader(name):
+            # another process may have published it while we waited
+            shared = self.read(name)
+            if shared is not None and is_current(shared[0]):
+                return shared
+
+            LOGGER.info(f"Building shared {name}")
+            meta, arrays = build()
+            self.publish(name, meta, arrays)
+
+        # the memory mapped copy, unless another process already replaced it,
+        # in which case what was just built is still up to date
+        shared = self.read(name)
+        return shared if shared is not None else (meta, arrays)
+
+# the store for this host
+SHARED = SharedArrays(SHARED_DATA_DIR)
@@ -0,0 +1,274 @@
+####################################################################
+# singleflight.py contains the coalescing of identical concurrent requests
+#
+# When many users ask for the same plot at the same time (e.g. a class
+# all loading the default query), only the first request does the work.
+# Every identical request that comes in while it is working waits for
+# it and gets the same result.
+#
+# Within a process, waiting is done on a concurrent.futures Future,
+# so both threads (sync views) and coroutines (async views) can wait.
+#
+# Optionally, requests can also be coalesced across processes on the
+# same host. The request doing the work holds a lock file for its key
+# and leaves the result next to it for a short time, so requests in
+# other processes wait on the lock and then pick up the result.
+# Lock files are removed as they are released and results once they
+# are older than the time they are kept for, so the directory only
+# holds the plots of the last few seconds.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import os
+import fcntl
+import pickle
+import asyncio
+from time import time
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import Future
+
+class SingleFlight:
+    '''Coalesces calls with the same key that happen at the same time'''
+
+    def __init__(self, lock_dir: str | Path = None, result_ttl: float = 10):
+        '''
+        Inputs:
+            lock_dir: directory for lock and result files, to coalesce across processes
+                      or None to only coalesce within this process
+            result_ttl: how many seconds a result is left for other processes to pick up
+        '''
+
+        self.lock_dir = Path(lock_dir) if lock_dir else None
+        self.result_ttl = result_ttl
+
+        if self.lock_dir is not None:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+
+        # keys are call keys, values are the futures of calls being worked on
+        self.__in_flight: dict[str, Future] = {}
+        self.__lock = Lock()
+
+        # when the lock directory was last cleaned up (see sweep())
+        self.__last_sweep = 0
+
+        # counters
+        self.leaders = 0
+        self.coalesced = 0
+        self.coalesced_across_processes = 0
+
+    def __claim(self, key: str) -> tuple[Future, bool]:
+        # get the future for a key and whether this call has to do the work
+        with self.__lock:
+            if (future := self.__in_flight.get(key)) is not None:
+                self.coalesced += 1
+                return future, False
+
+            future = Future()
+            self.__in_flight[key] = future
+            self.leaders += 1
+            return future, True
+
+    def __settle(self, key: str, future: Future, result = None, error: BaseException = None):
+        # hand the result to everyone waiting and stop coalescing on the key
+        with self.__lock:
+            del self.__in_flight[key]
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: str, func, *args):
+        '''Call a function, or wait for an identical call already happening
+
+        Inputs:
+            key: what identifies the call, identical calls have the same key
+            func: the function to call
+            args: the arguments to give the function
+
+        Outputs:
+            what the function returns
+        '''
+
+        future, leader = self.__claim(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = self.__across_processes(key, func, *args)
+        except BaseException as e:
+            self.__settle(key, future, error = e)
+            raise
+
+        self.__settle(key, future, result)
+        return result
+
+    async def do_async(self, key: str, coroutine_func, *args):
+        '''Await a coroutine function, or wait for an identical call already happening
+
+        When coalescing across processes, the function is called with the lock held
+        (see acquire_process_lock()), so it should not block the event loop waiting on it.
+
+        Inputs:
+            key: what identifies the call, identical calls have the same key
+            coroutine_func: the coroutine function to await
+            args: the arguments to give the function
+
+        Outputs:
+            what the coroutine function returns
+        '''
+
+        future, leader = self.__claim(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        loop = asyncio.get_running_loop()
+        try:
+            # waiting on the lock file blocks, so keep it off the event loop
+            if self.lock_dir is not None:
+                await loop.run_in_executor(None, self.sweep)
+            lock = await loop.run_in_executor(None, self.acquire_process_lock, key) if self.lock_dir is not None else None
+            try:
+                if lock is not None and (result := self.__shared_result(key)) is not None:
+                    result = result[0]
+                else:
+                    result = await coroutine_func(*args)
+                    if lock is not None:
+                        self.__share_result(key, result)
+            finally:
+                self.release_process_lock(lock)
+        except BaseException as e:
+            self.__settle(key, future, error = e)
+            raise
+
+        self.__settle(key, future, result)
+        return result
+
+    def pending(self, key: str) -> bool:
+        '''Whether a call with a key is happening in this process or another process just finished one'''
+
+        with self.__lock:
+            if key in self.__in_flight:
+                return True
+
+        if self.lock_dir is None:
+            return False
+        try:
+            return time() - (self.lock_dir / f"{key}.result").stat().st_mtime <= self.result_ttl
+        except OSError:
+            return False
+
+    def __across_processes(self, key: str, func, *args):
+        # do the work, unless another process just did it
+        self.sweep()
+        lock = self.acquire_process_lock(key)
+        try:
+            if lock is not None and (result := self.__shared_result(key)) is not None:
+                return result[0]
+
+            result = func(*args)
+            if lock is not None:
+                self.__share_result(key, result)
+            return result
+        finally:
+            self.release_process_lock(lock)
+
+    def acquire_process_lock(self, key: str):
+        '''Wait for and take the lock file for a key
+
+        Outputs:
+            the open lock file, to give to release_process_lock()
+            or None if not coalescing across processes
+        '''
+
+        if self.lock_dir is None:
+            return None
+
+        path = self.lock_dir / f"{key}.lock"
+        while True:
+            lock = open(path, "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # the holder before removes the file as it lets go (see release_process_lock()),
+            # so only a lock on the file still at the path counts
+            try:
+                if os.fstat(lock.fileno()).st_ino == path.stat().st_ino:
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def release_process_lock(self, lock):
+        '''Give up a lock file taken with acquire_process_lock(), removing it'''
+
+        if lock is not None:
+            # anyone waiting on it takes the lock on a new file instead
+            try:
+                os.unlink(lock.name)
+            except OSError:
+                pass
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def sweep(self):
+        '''Delete results older than result_ttl and abandoned lock files, at most once every result_ttl seconds'''
+
+        now = time()
+        if self.lock_dir is None or now - self.__last_sweep < self.result_ttl:
+            return
+        self.__last_sweep = now
+
+        for path in self.lock_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime <= self.result_ttl:
+                    continue
+                if path.suffix == ".lock":
+                    # only if no one holds it (e.g. left by a process that died)
+                    with open(path, "a") as lock:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        path.unlink()
+                else:
+                    # results, and half written ones
+                    path.unlink()
+            except OSError:
+                # held, or another process got to it first
+                continue
+
+    def __shared_result(self, key: str) -> tuple | None:
+        # a result another process left in the last result_ttl seconds
+        # in a tuple so that None results can be shared too
+        path = self.lock_dir / f"{key}.result"
+        try:
+            if time() - path.stat().st_mtime > self.result_ttl:
+                # too old to share, and no one else will want it either
+                path.unlink()
+                return None
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError):
+            return None
+
+        with self.__lock:
+            self.coalesced_across_processes += 1
+        return (result,)
+
+    def __share_result(self, key: str, result):
+        # write to a temporary file first so no one reads half a result
+        path = self.lock_dir / f"{key}.result"
+        temp_path = self.lock_dir / f"{key}.result.{os.getpid()}"
+        with open(temp_path, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(temp_path, path)
+
+    def stats(self) -> dict:
+        '''Get the counters of how many calls were coalesced'''
+
+        with self.__lock:
+            return dict(
+                leaders = self.leaders,
+                coalesced = self.coalesced,
+                coalesced_across_processes = self.coalesced_across_processes,
+                in_flight = len(self.__in_flight),
+            )
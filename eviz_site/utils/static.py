@@ -0,0 +1,292 @@
+####################################################################
+# static.py contains the store of static files (CSS, JS, images) and how they're served
+#
+# Every file under the static directory is read into memory once,
+# along with a hash of its contents and, for text, gzip and brotli
+# compressed copies, so serving one is just picking the bytes to send.
+#
+# Pages link to static files by hashed URLs (see StaticFiles.url() and
+# the static_url template tag), e.g. /static/css/toolbar.3f2a9c1b7d4e.css,
+# which change whenever the file does, so browsers can keep them forever.
+# Files asked for by their plain URL (e.g. imports between scripts or the
+# admin pages' files) are instead revalidated with their ETag every time,
+# which is answered with a bodiless 304 when they haven't changed.
+#
+# Authors:
+#       Kenny Howes - kmh67@calvin.edu
+#       Edom Maru - eam43@calvin.edu
+#####################
+import re
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+from threading import Lock
+from django.http import HttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from utils.logging import LOGGER
+from eviz_site.settings import STATIC_BASE, STATIC_MAX_AGE, STATIC_COMPRESS_MIN_BYTES
+
+try:
+    import brotli
+except ImportError:
+    # only gzip copies are made
+    brotli = None
+
+# types the mimetypes module gets wrong or doesn't know on every system
+mimetypes.add_type("text/javascript", ".js")
+mimetypes.add_type("text/javascript", ".mjs")
+mimetypes.add_type("image/svg+xml", ".svg")
+mimetypes.add_type("application/json", ".map")
+mimetypes.add_type("text/markdown", ".md")
+
+# types other than text/* worth compressing
+COMPRESSIBLE_TYPES = {"application/json", "application/xml", "image/svg+xml"}
+
+# the hash in a hashed URL, e.g. the "3f2a9c1b7d4e" of css/toolbar.3f2a9c1b7d4e.css
+HASHED_PATH = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})(?P<suffix>\.[^./]+)$")
+# a single range of a Range header, e.g. 0-499, 500- or -500
+BYTE_RANGE = re.compile(r"^(?P<first>\d*)-(?P<last>\d*)$")
+
+class StaticFile:
+    '''A static file's bytes, their compressed copies and what they are served with'''
+
+    def __init__(self, path: Path):
+        '''
+        Inputs:
+            path: where the file is on disk
+        '''
+
+        self.data = path.read_bytes()
+        self.hash = hashlib.sha256(self.data).hexdigest()[:12]
+        self.last_modified = http_date(path.stat().st_mtime)
+
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.compressible = content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+        self.content_type = content_type + "; charset=utf-8" if content_type.startswith("text/") else content_type
+
+        # keys are content codings, values are the file's bytes in that coding
+        # only copies that are actually smaller are kept
+        self.encoded: dict[str, bytes] = {}
+        if self.compressible and len(self.data) >= STATIC_COMPRESS_MIN_BYTES:
+            copies = {"gzip": gzip.compress(self.data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                copies["br"] = brotli.compress(self.data, quality=11)
+            self.encoded = {coding: copy for coding, copy in copies.items() if len(copy) < len(self.data) * 0.9}
+
+    def etag(self, coding: str = None) -> str:
+        '''Get the ETag of the file (as sent in a content coding)'''
+
+        return f'"{self.hash}-{coding}"' if coding else f'"{self.hash}"'
+
+class StaticFiles:
+    '''Every file under a directory, kept in memory to be served'''
+
+    def __init__(self, root: str | Path):
+        '''
+        Inputs:
+            root: the directory the static files are in
+        '''
+
+        self.root = Path(root)
+
+        # keys are paths relative to the root, e.g. css/toolbar.css
+        self.__files: dict[str, StaticFile] | None = None
+        self.__lock = Lock()
+
+    @property
+    def files(self) -> dict[str, StaticFile]:
+        '''Every static file, keyed by its path relative to the root, read in on first use'''
+
+        if self.__files is None:
+            with self.__lock:
+                if self.__files is None:
+                    self.__files = self.__load()
+        return self.__files
+
+    def __load(self) -> dict[str, StaticFile]:
+        files = {}
+        for path in sorted(self.root.rglob("*")):
+            if path.is_file():
+                files[path.relative_to(self.root).as_posix()] = StaticFile(path)
+
+        LOGGER.info(
+            f"Loaded {len(files)} static files: {sum(len(f.data) for f in files.values())} bytes, "
+            f"{sum(len(f.encoded.get('gzip', f.data)) for f in files.values())} gzipped"
+            + ("" if brotli is not None else " (brotli isn't installed)")
+        )
+        return files
+
+    def warm(self):
+        '''Read in every static file (and compress them) before the first request needs them'''
+
+        self.files
+
+    def url(self, path: str) -> str:
+        '''Get the hashed URL of a static file, which can be cached forever
+
+        Inputs:
+            path: the path of the file relative to the static directory, e.g. css/toolbar.css
+
+        Outputs:
+            the URL, or the plain URL of the path if there is no such file (or it has no extension)
+        '''
+
+        static_file = self.files.get(path)
+        directory, _, name = path.rpartition("/")
+        stem, dot, suffix = name.rpartition(".")
+        if static_file is None or not dot:
+            return "/static/" + path
+
+        return f"/static/{directory + '/' if directory else ''}{stem}.{static_file.hash}.{suffix}"
+
+    def find(self, path: str) -> tuple[StaticFile, bool] | None:
+        '''Find the static file a request path is for
+
+        Inputs:
+            path: the path asked for relative to the static directory, plain or hashed
+
+        Outputs:
+            a tuple of
+                the file
+                whether the path has the hash of the file's current contents (so can be cached forever)
+            or None if there is no such file
+        '''
+
+        static_file = self.files.get(path)
+        if static_file is not None:
+            return static_file, False
+
+        hashed = HASHED_PATH.match(path)
+        if hashed is None:
+            return None
+
+        static_file = self.files.get(hashed["stem"] + hashed["suffix"])
+        if static_file is None:
+            return None
+
+        # a page from before the file changed gets the current file, but only for now
+        return static_file, static_file.hash == hashed["hash"]
+
+    def response(self, request, path: str) -> HttpResponse | None:
+        '''Serve a static file, answering conditional and range requests
+
+        Inputs:
+            request: the GET or HEAD request for the file
+            path: the path asked for relative to the static directory, plain or hashed
+
+        Outputs:
+            the response, or None if there is no such file
+        '''
+
+        found = self.find(path)
+        if found is None:
+            return None
+        static_file, immutable = found
+
+        coding = _choose_coding(request.headers.get("Accept-Encoding", ""), static_file.encoded)
+        data = static_file.encoded[coding] if coding else static_file.data
+        etag = static_file.etag(coding)
+
+        headers = {
+            "Content-Type": static_file.content_type,
+            "ETag": etag,
+            "Last-Modified": static_file.last_modified,
+            "Cache-Control": f"public, max-age={STATIC_MAX_AGE}, immutable" if immutable else "no-cache",
+            "Accept-Ranges": "bytes",
+        }
+        if static_file.compressible:
+            headers["Vary"] = "Accept-Encoding"
+
+        if _not_modified(request, etag, static_file):
+            return HttpResponse(status=304, headers={k: v for k, v in headers.items() if k != "Content-Type"})
+
+        # ranges are of the file itself, not of a compressed copy
+        byte_range = _requested_range(request, static_file)
+        if byte_range is not None:
+            if byte_range == ():
+                return HttpResponse(status=416, headers={**headers, "Content-Range": f"bytes */{len(static_file.data)}"})
+
+            start, end = byte_range
+            data = static_file.data[start:end + 1]
+            headers.update(
+                {"ETag": static_file.etag(), "Content-Range": f"bytes {start}-{end}/{len(static_file.data)}"}
+            )
+            status = 206
+        else:
+            if coding:
+                headers["Content-Encoding"] = coding
+            status = 200
+
+        headers["Content-Length"] = str(len(data))
+        return HttpResponse(b"" if request.method == "HEAD" else data, status=status, headers=headers)
+
+def _choose_coding(accept_encoding: str, encoded: dict[str, bytes]) -> str | None:
+    # the best compressed copy the client accepts (see the Accept-Encoding header), or None to send the file as is
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+
+    for coding in ("br", "gzip"):
+        if coding in encoded and accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return None
+
+def _etags(header: str) -> list[str]:
+    # the ETags listed in an If-None-Match or If-Range header, compared weakly
+    return [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+def _not_modified(request, etag: str, static_file: StaticFile) -> bool:
+    # whether the client already has this version of the file
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = _etags(if_none_match)
+        return "*" in tags or etag in tags
+
+    if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    return if_modified_since is not None and parse_http_date_safe(static_file.last_modified) <= if_modified_since
+
+def _requested_range(request, static_file: StaticFile) -> tuple | None:
+    # the first and last byte asked for by a Range header,
+    # None to send the whole file or an empty tuple if the range can't be satisfied
+    header = request.headers.get("Range")
+    if header is None or not header.startswith("bytes="):
+        return None
+
+    # only range the file if it is still the version the client has part of
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != static_file.etag() and if_range != static_file.last_modified:
+        return None
+
+    # several ranges at once are rare enough to just send the whole file
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+
+    byte_range = BYTE_RANGE.match(spec)
+    if byte_range is None or byte_range["first"] == byte_range["last"] == "":
+        return None
+
+    size = len(static_file.data)
+    if byte_range["first"] == "":
+        # the last so many bytes
+        length = int(byte_range["last"])
+        if length == 0:
+            return ()
+        return max(size - length, 0), size - 1
+
+    start = int(byte_range["first"])
+    end = min(int(byte_range["last"]), size - 1) if byte_range["last"] else size - 1
+    if start >= size or start > end:
+        return ()
+    return start, end
+
+# the static files of the site
+STATIC_FILES = StaticFiles(STATIC_BASE)
@@ -5,43 +5,129 @@
 # Since the "translation" tables in the database are fairly small,
 # it's quicker to load them as dictionaries in memory and use them
 # instead of doing foreign key translation database-side.
+# For translating whole columns of IDs at once, the dictionaries
+# are also turned into dense numpy lookup arrays (see Translator.decode()).
 # 
 # Any results from the database are globally cached for 
 # TRANSLATOR_CACHE_TTL number of hours. All users use the same dictionaries
 # for translations, so little memory is used for this as possible.
 #
+# So that every process sees new entries (e.g. a new Version) at the same time,
+# there is also a generation stamp in a file shared by every process on the host
+# (see Translator.bump_generation()). When a process sees it change,
+# it reloads all of its translations at once.
+#
+# When the server starts, every model's translations are loaded up front
+# (see Translator.warm()) and saved to a snapshot in the shared store (see shared.py),
+# so that new processes can start from the snapshot instead of waiting on the databases.
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
 from bidict import bidict
+import numpy as np
+import pandas as pd
 from django.apps import apps
 from utils.logging import LOGGER
-from datetime import datetime, timedelta
+import os
+from time import monotonic, time, time_ns
+from pathlib import Path
+from threading import Lock, Thread
+from datetime import timedelta
+from django.db import connections
 from eviz.models import Dataset
-from eviz_site.settings import SANDBOX_PREFIX, IEA_TABLES
+from eviz_site.settings import SANDBOX_PREFIX, IEA_TABLES, TRANSLATOR_GENERATION_FILE, TRANSLATOR_GENERATION_CHECK
+from utils.shared import SHARED
 
 # how long to cache information from the database 
 # in *hours*
 TRANSLATOR_CACHE_TTL = 24
 
+# Mapping of attribute names to the model holding their translations
+# values are (model name, ID field, human readable name field)
+MODEL_MAPPINGS = {
+    'index': ('Index', 'IndexID', 'Index'),
+    'dataset': ('Dataset', 'DatasetID', 'Dataset'),
+    'version': ('Version', 'VersionID', 'Version'),
+    'country': ('Country', 'CountryID', 'FullName'),
+    'method': ('Method', 'MethodID', 'Method'),
+    'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
+    'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
+    'matname': ('matname', 'matnameID', 'matname'),
+    'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
+    'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
+}
+
+# Mapping of the columns Translator.get_all_available() works for to the attribute
+# (see MODEL_MAPPINGS) that translates them, None for columns that aren't translated
+AVAILABLE_COLUMNS = {
+    'Dataset': 'dataset',
+    'Version': 'version',
+    'Country': 'country',
+    'Method': 'method',
+    'EnergyType': 'energytype',
+    'LastStage': 'laststage',
+    'ProductAggregation': 'agglevel',
+    'IndustryAggregation': 'agglevel',
+    'GrossNet': 'grossnet',
+    'matname': 'matname',
+    'Year': None,
+}
+
+# the ID and name fields of each model, for reloading by model name
+_MODEL_FIELDS = {model_name: (id_field, name_field) for model_name, id_field, name_field in MODEL_MAPPINGS.values()}
+
+# bumped whenever what goes in a translation snapshot changes,
+# so old snapshots are ignored instead of misread
+_SNAPSHOT_FORMAT = 1
+
 class Translator:
     # A dictionary where keys are model names and
-    # values are tuples of date times and bidict objects
-    # the date times mark when the entry was cached
+    # values are tuples of times and bidict objects
+    # the times (from time.monotonic()) mark when the entry was cached
     # the bidict has the translation information
-    __translations: dict[str: tuple[datetime, bidict]] = {}
+    __translations: dict[str: tuple[float, bidict]] = {}
+
+    # A dictionary where keys are model names and
+    # values are tuples of the bidict the entry was built from,
+    # a numpy array where index ID holds the category code for that ID (-1 if no such ID)
+    # and the categories (human readable names) the codes refer to
+    __lookups: dict[str: tuple[bidict, np.ndarray, pd.Index]] = {}
 
-    # A tuple of a datetime of when this entry was cached
+    # A tuple of a time of when this entry was cached
     # and a list of strings for all the public datasets
-    __public_datasets: tuple[datetime, list[str]] = (None, [])
+    __public_datasets: tuple[float, list[str]] = (None, [])
 
     # how long entries are allowed to exist before getting refreshed
-    __cache_ttl = timedelta(hours=TRANSLATOR_CACHE_TTL)
+    # in *seconds*
+    __cache_ttl = timedelta(hours=TRANSLATOR_CACHE_TTL).total_seconds()
+
+    # the generation stamp the cached entries were loaded under
+    # and when the stamp was last checked
+    __generation: str | None = None
+    __generation_checked: float | None = None
+    __generation_lock = Lock()
+
+    # one lock per model so only one request loads it when it's missing or expired
+    __locks: dict[str: Lock] = {}
+    __locks_lock = Lock()
+
+    # counters for how well the cache is doing
+    __stats = dict(hits = 0, misses = 0, reloads = 0, generation_reloads = 0)
 
     def __init__(self, database: str):
         self._db = database
 
+    @staticmethod
+    def __expired(loaded_at: float) -> bool:
+        return monotonic() - loaded_at > Translator.__cache_ttl
+
+    @staticmethod
+    def __lock_for(key: str) -> Lock:
+        with Translator.__locks_lock:
+            return Translator.__locks.setdefault(key, Lock())
+
     @staticmethod
     def __load_bidict(model_name: str, id_field: str, name_field: str, database: str) -> bidict:
         """
@@ -56,38 +142,218 @@ class Translator:
             bidict: A bidirectional dictionary of translations for the model.
         """
 
-        # check if we have the desired information
-        if (database + ":" + model_name) not in Translator.__translations:
-            Translator.__load_and_cache(model_name, id_field, name_field, database)
-        
-        model_translations = Translator.__translations[database + ":" + model_name]
-        
-        # if the data's cache ttl is expired,
-        # recache and reload
-        if (datetime.today().date() - model_translations[0]) > Translator.__cache_ttl:
-            Translator.__load_and_cache(model_name, id_field, name_field, database)
-            model_translations = Translator.__translations[database + ":" + model_name]
-        
+        Translator.__check_generation()
+
+        key = database + ":" + model_name
+
+        # check if we have the desired information and it isn't expired
+        model_translations = Translator.__translations.get(key)
+        if model_translations is not None and not Translator.__expired(model_translations[0]):
+            Translator.__stats["hits"] += 1
+            return model_translations[1]
+
+        with Translator.__lock_for(key):
+            # someone else may have loaded it while we waited for the lock
+            model_translations = Translator.__translations.get(key)
+            if model_translations is None or Translator.__expired(model_translations[0]):
+                Translator.__stats["misses" if model_translations is None else "reloads"] += 1
+                model_translations = Translator.__load(model_name, id_field, name_field, database)
+                Translator.__translations[key] = model_translations
+
         # return the bidict of model translations
         return model_translations[1]
     
     @staticmethod
-    def __load_and_cache(model_name: str, id_field: str, name_field: str, database: str):
+    def __load(model_name: str, id_field: str, name_field: str, database: str) -> tuple[float, bidict]:
         LOGGER.info(f"Loading and caching {database}:{model_name} for {id_field} <-> {name_field}")
 
         # Get the model class dynamically
         model = apps.get_model(app_label='eviz', model_name=model_name)
 
         # Create a bidict with name:id pairs
-        Translator.__translations[database + ":" + model_name] = (
-            # a datetime to see how long this has been cached
-            datetime.today().date(),
+        return (
+            # a time to see how long this has been cached
+            monotonic(),
             # the bidict containing all the data information
             bidict(
                 {getattr(item, name_field): getattr(item, id_field) for item in model.objects.using(database).all()}
             )
         )
 
+    @staticmethod
+    def __load_all(database: str) -> dict[str: tuple[float, bidict]]:
+        # load every model's translations in one query, instead of one query per model
+        LOGGER.info(f"Loading and caching all translations for {database}")
+
+        connection = connections[database]
+        quote = connection.ops.quote_name
+        selects = []
+        for model_name, (id_field, name_field) in _MODEL_FIELDS.items():
+            model = apps.get_model(app_label='eviz', model_name=model_name)
+            selects.append(
+                f"SELECT CAST(%s AS text), CAST({quote(model._meta.get_field(id_field).column)} AS integer), "
+                f"CAST({quote(model._meta.get_field(name_field).column)} AS text) FROM {quote(model._meta.db_table)}"
+            )
+
+        with connection.cursor() as cursor:
+            cursor.execute(" UNION ALL ".join(selects), list(_MODEL_FIELDS))
+            rows = cursor.fetchall()
+
+        names_to_ids = {model_name: {} for model_name in _MODEL_FIELDS}
+        for model_name, item_id, name in rows:
+            names_to_ids[model_name][name] = item_id
+
+        loaded_at = monotonic()
+        return {database + ":" + model_name: (loaded_at, bidict(items)) for model_name, items in names_to_ids.items()}
+
+    @staticmethod
+    def __snapshot_name(database: str) -> str:
+        return f"translations-{database}-v{_SNAPSHOT_FORMAT}"
+
+    @staticmethod
+    def __snapshot_arrays(translations: dict[str: tuple[float, bidict]]) -> dict[str, np.ndarray]:
+        arrays = {}
+        for key, (_, items) in translations.items():
+            # names that aren't strings (e.g. missing names) can't go in a snapshot without pickling,
+            # those models are just loaded from the database when needed
+            if not all(isinstance(name, str) for name in items):
+                continue
+            model_name = key.split(":", 1)[1]
+            arrays[model_name + "__ids"] = np.fromiter(items.values(), dtype=np.int64, count=len(items))
+            arrays[model_name + "__names"] = np.array(list(items.keys()), dtype=str)
+        return arrays
+
+    @staticmethod
+    def __load_snapshot(database: str, generation: str | None, published_after: float = 0) -> dict[str: tuple[float, bidict]]:
+        # the translations in a database's snapshot, if there is one from this generation
+        shared = SHARED.read(Translator.__snapshot_name(database))
+        if shared is None:
+            return {}
+
+        meta, snapshot = shared
+        if meta.get("generation") != (generation or "") or meta.get("published", 0) < published_after:
+            return {}
+
+        loaded_at = monotonic()
+        return {
+            database + ":" + model_name: (
+                loaded_at,
+                bidict(zip(snapshot[model_name + "__names"].tolist(), snapshot[model_name + "__ids"].tolist()))
+            )
+            for model_name in _MODEL_FIELDS
+            if model_name + "__ids" in snapshot
+        }
+
+    @staticmethod
+    def warm(databases: list[str]):
+        """
+        Get every model's translations for some databases ready before they are needed.
+
+        Translations from the last snapshot are used right away,
+        then every database is queried (one query each) in the background
+        to bring the translations up to date and write a new snapshot.
+        Processes starting together share one query per database (see __revalidate()).
+
+        Inputs:
+            databases (list[str]): The names of the databases to get translations for.
+        """
+
+        # anything loaded from here on is from the current generation
+        generation = Translator.__read_generation()
+        Translator.__generation = generation
+        Translator.__generation_checked = monotonic()
+
+        for database in databases:
+            if snapshot := Translator.__load_snapshot(database, generation):
+                LOGGER.info(f"Using translation snapshot for {database}")
+                Translator.__translations = {**Translator.__translations, **snapshot}
+
+        Thread(target=Translator.__revalidate, args=(databases, generation, time()), name="eviz-translator-warmup", daemon=True).start()
+
+    @staticmethod
+    def __revalidate(databases: list[str], generation: str | None, started: float):
+        for database in databases:
+            try:
+                # only one process on the host queries the database at a time,
+                # the rest use what it published if it's newer than when they started
+                with SHARED.loader(Translator.__snapshot_name(database)):
+                    if translations := Translator.__load_snapshot(database, generation, started):
+                        Translator.__translations = {**Translator.__translations, **translations}
+                        continue
+
+                    translations = Translator.__load_all(database)
+                    Translator.__translations = {**Translator.__translations, **translations}
+                    SHARED.publish(
+                        Translator.__snapshot_name(database),
+                        dict(generation = generation or "", published = time()),
+                        Translator.__snapshot_arrays(translations),
+                    )
+            except Exception as e:
+                # translations will just be loaded when needed instead
+                LOGGER.error(f"Couldn't warm up translations for {database}: {e}")
+            finally:
+                # this thread is done with its connection
+                connections[database].close()
+
+    @staticmethod
+    def __read_generation() -> str | None:
+        try:
+            return Path(TRANSLATOR_GENERATION_FILE).read_text()
+        except OSError:
+            return None
+
+    @staticmethod
+    def __check_generation():
+        # only look at the stamp every so often, it's checked on every translation
+        checked = Translator.__generation_checked
+        if checked is not None and monotonic() - checked < TRANSLATOR_GENERATION_CHECK:
+            return
+        Translator.__generation_checked = monotonic()
+
+        generation = Translator.__read_generation()
+        if generation == Translator.__generation:
+            return
+
+        with Translator.__generation_lock:
+            # someone else may have reloaded while we waited for the lock
+            if generation == Translator.__generation:
+                return
+
+            LOGGER.info("Translation generation changed, reloading all translations")
+
+            # load everything for every database that was in use before swapping any of it in,
+            # so no one translates with a mix of old and new entries
+            translations = {}
+            for database in {key.split(":", 1)[0] for key in Translator.__translations}:
+                translations.update(Translator.__load_all(database))
+
+            Translator.__translations = translations
+            Translator.__public_datasets = (None, [])
+            Translator.__generation = generation
+            Translator.__stats["generation_reloads"] += 1
+
+    @staticmethod
+    def bump_generation():
+        """
+        Make every process reload its translations, e.g. after a new Version or Country is published.
+        """
+
+        path = Path(TRANSLATOR_GENERATION_FILE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first so no one reads half a stamp
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}")
+        temp_path.write_text(str(time_ns()))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def stats() -> dict:
+        """
+        Get the counters of the translation cache.
+        """
+
+        return dict(**Translator.__stats, cached = len(Translator.__translations), generation = Translator.__generation)
+
     def _translate(self, model_name, value, id_field, name_field):
         # Translate a value between its ID and name for a specific model.
         # value: The value to translate (can be either an ID or a name).
@@ -136,6 +402,73 @@ class Translator:
     def includesNEU_translate(self, value):
         return int(value) if isinstance(value, bool) else int(bool(value))
 
+    def lookup(self, attribute: str) -> tuple[np.ndarray, pd.Index]:
+        """
+        Get dense lookup arrays for translating many IDs at once.
+
+        Inputs:
+            attribute (str): The name of the attribute to get the lookup for (see MODEL_MAPPINGS).
+
+        Outputs:
+            A tuple of
+                a numpy array where the value at index ID is the category code of that ID, or -1 if there is no such ID
+                a pandas Index of the categories (human readable names) the codes refer to
+        """
+
+        if attribute not in MODEL_MAPPINGS:
+            raise ValueError(f"Unknown attribute: {attribute}")
+
+        model_name, id_field, name_field = MODEL_MAPPINGS[attribute]
+        translations = self.__load_bidict(model_name, id_field, name_field, self._db)
+
+        # rebuild the lookup if the translations it was built from were reloaded
+        key = self._db + ":" + model_name
+        cached = Translator.__lookups.get(key)
+        if cached is None or cached[0] is not translations:
+            ids = np.fromiter(translations.inverse.keys(), dtype=np.int64, count=len(translations))
+            order = np.argsort(ids)
+            names = list(translations.inverse.values())
+
+            codes = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int32)
+            codes[ids[order]] = np.arange(len(ids), dtype=np.int32)
+
+            cached = (translations, codes, pd.Index([names[k] for k in order]))
+            Translator.__lookups[key] = cached
+
+        return cached[1], cached[2]
+
+    def decode(self, attribute: str, ids) -> pd.Categorical:
+        """
+        Translate many IDs to their human readable names at once.
+
+        Inputs:
+            attribute (str): The name of the attribute the IDs are for (see MODEL_MAPPINGS).
+            ids: An array-like of IDs to translate.
+
+        Outputs:
+            A pandas Categorical of the names for each ID
+        """
+
+        codes, categories = self.lookup(attribute)
+
+        ids = np.asarray(ids)
+        if not np.issubdtype(ids.dtype, np.integer):
+            try:
+                ids = ids.astype(np.int64)
+            except (TypeError, ValueError):
+                raise KeyError("Unrecognized non-integer key for " + MODEL_MAPPINGS[attribute][0])
+
+        # IDs outside of the lookup are unknown
+        unknown = (ids < 0) | (ids >= len(codes))
+        # as are IDs in it without a category
+        taken = codes[np.where(unknown, 0, ids)] if len(codes) else np.full(ids.shape, -1, dtype=np.int32)
+        unknown |= taken < 0
+
+        if unknown.any():
+            raise KeyError("Unrecognized key '" + str(ids[unknown][0]) + "' for " + MODEL_MAPPINGS[attribute][0])
+
+        return pd.Categorical.from_codes(taken, categories=categories)
+
     @staticmethod
     def get_all(attribute, database = "default"):
         """
@@ -154,38 +487,27 @@ class Translator:
         if attribute == "datasets:admin":
             return Translator.__fetch_admin_datasets()
         
-        # Dictionary mapping attribute names to model details
-        model_mappings = {
-            'dataset': ('Dataset', 'DatasetID', 'Dataset'),
-            'version': ('Version', 'VersionID', 'Version'),
-            'country': ('Country', 'CountryID', 'FullName'),
-            'method': ('Method', 'MethodID', 'Method'),
-            'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
-            'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
-            'matname': ('matname', 'matnameID', 'matname'),
-            'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
-            'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
-        }
-        
-        if attribute not in model_mappings:
+        if attribute not in MODEL_MAPPINGS:
             raise ValueError(f"Unknown attribute: {attribute}")
         
         # Get model details and load translations
-        model_name, id_field, name_field = model_mappings[attribute]
+        model_name, id_field, name_field = MODEL_MAPPINGS[attribute]
         translations = Translator.__load_bidict(model_name, id_field, name_field, database)
         return list(translations.keys())
     
     @staticmethod
     def __fetch_public_datasets():
+        Translator.__check_generation()
+
         if (
             # the list is empty and needs to be filled
             len(Translator.__public_datasets[1]) == 0
             # the entry needs to be recached
-            or (datetime.today().date() - Translator.__public_datasets[0]) > Translator.__cache_ttl
+            or Translator.__expired(Translator.__public_datasets[0])
         ):
             # reload and recache
             Translator.__public_datasets = (
-                datetime.today().date(),
+                monotonic(),
                 list(Dataset.objects.filter(Public = True).values_list("Dataset", flat = True))
             )
 
@@ -205,35 +527,45 @@ class Translator:
     def get_includesNEUs():
         return [True, False]
 
-    # TODO: This needs to be finished...
     @staticmethod
-    def get_all_available(attribute):
-        """Get all available values for a given attribute from the PSUT model.
-        
+    def get_all_available(column: str, target = None, query: dict = None) -> list:
+        """Get the values of a column there is data for, given the rest of a query.
+
         Inputs:
-            attribute (str): The name of the attribute to get values for.
-        
+            column (str): The column to get values for (a key of AVAILABLE_COLUMNS).
+            target (DatabaseTarget): The database target to look in, the default database's PSUT table if not given.
+            query (dict): A translated query narrowing down the data (see translate_query()),
+                          its conditions on the column are ignored.
+
         Outputs:
-            A list of distinct values for the attribute from the PSUT model.
+            A list of the values (names, or numbers for Year) there is data for.
         """
-        # Dictionary mapping attribute names to model details
-        model_mappings = {
-            'dataset': ('Dataset', 'DatasetID', 'Dataset'),
-            'version': ('Version', 'VersionID', 'Version'),
-            'country': ('Country', 'CountryID', 'FullName'),
-            'method': ('Method', 'MethodID', 'Method'),
-            'energytype': ('EnergyType', 'EnergyTypeID', 'FullName'),
-            'laststage': ('LastStage', 'ECCStageID', 'ECCStage'),
-            'matname': ('matname', 'matnameID', 'matname'),
-            'agglevel': ('AggLevel', 'AggLevelID', 'AggLevel'),
-            'grossnet': ('GrossNet', 'GrossNetID', 'GrossNet'),
-        }
-        
-        if attribute not in model_mappings:
-            raise ValueError(f"Unknown attribute: {attribute}")
-        
-        model_name, id_field, name_field = model_mappings[attribute]
-        translations = Translator.__load_bidict(model_name, id_field, name_field)
 
-        # Print distinct values for the attribute from the PSUT model
-        # print(PSUT.objects.order_by().values_list(model_name, flat=True).distinct())
\ No newline at end of file
+        # imported here since the availability index gets its data through utils.data, which uses the translator
+        from utils.availability import get_availability
+        from eviz.models import PSUT
+
+        if column not in AVAILABLE_COLUMNS:
+            raise ValueError(f"Unknown column: {column}")
+
+        target = target or ("default", PSUT)
+        query = query or {}
+        attribute = AVAILABLE_COLUMNS[column]
+
+        index = get_availability(target)
+        if index is None or (column not in index.columns and column not in index.bitsets and column != "Version"):
+            # no index for the target, so anything might be available
+            return Translator.get_all(attribute, target[0]) if attribute else []
+
+        if attribute is None:
+            return index.values(column, query).tolist()
+
+        codes, categories = Translator(target[0]).lookup(attribute)
+        if column == "Version":
+            ids = np.array(index.versions(query, np.flatnonzero(codes >= 0)), dtype=np.int64)
+        else:
+            ids = index.values(column, query).astype(np.int64)
+
+        # leave out IDs with no translation
+        ids = codes[ids[(ids >= 0) & (ids < len(codes))]]
+        return categories[ids[ids >= 0]].tolist()
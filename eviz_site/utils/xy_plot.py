@@ -5,14 +5,102 @@
 # together a plotly Figure object, which can then be turned 
 # into HTML or further modified.
 #
+# Plots with many points (e.g. every country over every year, split by
+# color, dash and facets) are drawn with WebGL instead of SVG, and each
+# line is downsampled (largest triangle three buckets) so the whole
+# plot stays within a budget of points. The plot says when that happened.
+#
 # Authors:
 #       Kenny Howes - kmh67@calvin.edu
 #       Edom Maru - eam43@calvin.edu 
 #####################
 import plotly.express as px
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from utils.data import get_translated_dataframe, DatabaseTarget
+from eviz_site.settings import XY_WEBGL_POINTS, XY_WEBGL_TRACES, XY_POINT_BUDGET
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    '''Downsample a line with the largest triangle three buckets algorithm
+
+    The first and last points are always kept, and one point is kept from each
+    bucket in between: the one making the largest triangle with the point kept
+    before it and the average of the next bucket, which keeps the line's shape.
+
+    Inputs:
+        x: the x values of the line, in order
+        y: the y values of the line
+        threshold: how many points to keep
+
+    Outputs:
+        the (ordered) indices of the points kept
+    '''
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    # missing values are only gaps, they shouldn't decide which points are kept
+    y = np.nan_to_num(y.astype(np.float64))
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+
+    # the edges of the buckets between the first and last points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (end, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+
+    return kept
+
+def _downsample(df: pd.DataFrame, y: str, traces: list[str], budget: int) -> pd.DataFrame:
+    # downsample every trace (the rows sharing values of the split columns) to fit the budget together
+    groups = df.groupby(traces, sort=False, dropna=False).indices if traces else {None: np.arange(len(df))}
+    per_trace = max(budget // len(groups), 3)
+
+    kept = []
+    for rows in groups.values():
+        kept.append(rows[lttb(df["Year"].to_numpy()[rows], df[y].to_numpy()[rows], per_trace)])
+
+    return df.iloc[np.sort(np.concatenate(kept))]
+
+# Map the names to the actual database field names
+FIELD_MAPPING = {
+    'country': 'Country',
+    'energy_type': 'EnergyType'
+}
+
+def _with_note(hovertemplate: str | None) -> str:
+    # a hover template that also shows the trace's note (its meta)
+    note = "<br><i>%{meta}</i>"
+    if not hovertemplate:
+        return "%{x|%Y}: %{y}" + note
+    if "<extra>" in hovertemplate:
+        return hovertemplate.replace("<extra>", note + "<extra>", 1)
+    return hovertemplate + note
+
+def xy_columns(efficiency_metric: str, color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None) -> list[str]:
+    '''Get the columns an xy plot is made from (see get_xy() for the inputs)'''
+
+    # Create a list of fields to select, always including 'Year' and the efficiency metric
+    fields_to_select = ["Year", efficiency_metric]
+    
+    # Add color_by, line_by, facet_col_by, and facet_row_by fields to the selection list
+    for field in {color_by, line_by, facet_col_by, facet_row_by}:
+        if field in FIELD_MAPPING:
+            fields_to_select.append(FIELD_MAPPING[field])
+
+    return fields_to_select
 
 def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
            color_by: str, line_by: str, facet_col_by: str = None, facet_row_by: str = None, energy_type: str = None) -> go.Figure:
@@ -31,19 +119,7 @@ def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
         go.Figure: A Plotly figure object containing the generated plot.
     """
 
-    # Create a list of fields to select, always including 'Year' and the efficiency metric
-    fields_to_select = ["Year", efficiency_metric]
-
-    # Map the names to the actual database field names
-    field_mapping = {
-        'country': 'Country',
-        'energy_type': 'EnergyType'
-    }
-    
-    # Add color_by, line_by, facet_col_by, and facet_row_by fields to the selection list
-    for field in {color_by, line_by, facet_col_by, facet_row_by}:
-        if field in field_mapping:
-            fields_to_select.append(field_mapping[field])
+    fields_to_select = xy_columns(efficiency_metric, color_by, line_by, facet_col_by, facet_row_by)
 
     # get the respective data from the database
     df = get_translated_dataframe(target, query, fields_to_select)
@@ -51,22 +127,63 @@ def get_xy(efficiency_metric: str, target: DatabaseTarget, query: dict,
     
     if df.empty: return None # if no data, return as such
 
+    return xy_figure(df, efficiency_metric, color_by, line_by, facet_col_by, facet_row_by, energy_type)
+
+def xy_figure(df: pd.DataFrame, efficiency_metric: str, color_by: str, line_by: str, facet_col_by: str = None,
+              facet_row_by: str = None, energy_type: str = None, point_budget: int | None = XY_POINT_BUDGET) -> go.Figure:
+    """ Draw an xy plot of data already fetched (see get_xy() for the inputs)
+
+    Inputs:
+        df: the plot's data, with the columns from xy_columns()
+        point_budget: how many points a large plot is downsampled to,
+                      or None to draw every point with SVG however many there are
+
+    Outputs:
+        go.Figure: A Plotly figure object containing the generated plot.
+    """
+
+    # each line (trace) is one combination of the columns the plot is split by
+    traces = xy_columns(efficiency_metric, color_by, line_by, facet_col_by, facet_row_by)[2:]
+    trace_count = len(df.drop_duplicates(traces)) if traces else 1
+    total_points = len(df)
+
+    # big plots are drawn with WebGL and downsampled to the point budget
+    large = point_budget is not None and (total_points > XY_WEBGL_POINTS or trace_count > XY_WEBGL_TRACES)
+    if large and total_points > point_budget:
+        df = _downsample(df.sort_values(by="Year", kind="stable"), efficiency_metric, traces, point_budget)
+
     # convert year column to datetime if present
     # and sort on that so that the xy plots come out right
-    df["Year"] = pd.to_datetime(df["Year"], format="%Y")
+    # (straight from the year numbers, without going through strings)
+    df["Year"] = pd.to_datetime((df["Year"].to_numpy().astype(np.int64) - 1970).astype("datetime64[Y]"))
     df = df.sort_values(by="Year")
     
     try:
         # Create the line plot using Plotly Express
         fig = px.line(
             df, x="Year", y=efficiency_metric, 
-            color=field_mapping.get(color_by),
-            line_dash=field_mapping.get(line_by),
-            facet_col=field_mapping.get(facet_col_by),
-            facet_row=field_mapping.get(facet_row_by),
+            color=FIELD_MAPPING.get(color_by),
+            line_dash=FIELD_MAPPING.get(line_by),
+            facet_col=FIELD_MAPPING.get(facet_col_by),
+            facet_row=FIELD_MAPPING.get(facet_row_by),
             facet_col_spacing=0.05,
             category_orders={"EnergyType": ["Energy", "Exergy"]},
+            render_mode="webgl" if large else "svg",
         )
+
+        # say when not every point is shown
+        if len(df) < total_points:
+            note = f"Showing {len(df):,} of {total_points:,} points"
+            # added to what plotly express already shows (color, dash and facet values)
+            fig.for_each_trace(lambda trace: trace.update(
+                meta=note,
+                hovertemplate=_with_note(trace.hovertemplate),
+            ))
+            fig.add_annotation(
+                text=note, showarrow=False,
+                xref="paper", yref="paper", x=1, y=1.02,
+                xanchor="right", yanchor="bottom", font=dict(size=11, color="gray"),
+            )
         
         # Set the y-axis title based on the energy type
         if 'Energy' in energy_type and 'Exergy' in energy_type: